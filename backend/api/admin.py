@@ -3,4 +3,6 @@ from .models import *
 # Register your models here.
 
 admin.site.register(Task)
-admin.site.register(Script)
\ No newline at end of file
+admin.site.register(Script)
+admin.site.register(TaskLogEntry)
+admin.site.register(TaskBatch)
\ No newline at end of file
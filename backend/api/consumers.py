@@ -1,42 +1,340 @@
+import asyncio
 import json
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from executor.streaming import stream_group_name, register_viewer, unregister_viewer
+from .models import Task
+from .device_registry import registry as device_registry, DEVICES_GROUP
+
+
+def task_group_name(task_id):
+    """订阅单个任务的组：接收该任务的状态变化和增量日志"""
+    return f"task_{task_id}"
+
+
+def owner_group_name(user_id):
+    """订阅某个用户全部任务的组：只接收状态变化，不含日志"""
+    return f"owner_{user_id}_tasks"
+
+
+def parse_query(scope):
+    return dict(pair.split('=', 1) for pair in scope.get('query_string', b'').decode().split('&') if '=' in pair)
+
+
+def parse_id(value):
+    """客户端传来的任务ID或日志序号（非负整数或数字字符串）转为 int，格式不对时返回 None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value if value >= 0 else None
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    return None
+
+
+def parse_id_list(value):
+    """任务ID数组转为 [int]，不是数组或含有无效ID时返回 None"""
+    if not isinstance(value, list):
+        return None
+    ids = [parse_id(item) for item in value]
+    return None if None in ids else ids
+
+
+def parse_after_seq(value):
+    """{"任务ID": 序号} 转为 {int: int}，格式不对时返回 None"""
+    if not isinstance(value, dict):
+        return None
+    parsed = {parse_id(key): parse_id(seq) for key, seq in value.items()}
+    return None if None in parsed or None in parsed.values() else parsed
+
+
+def user_can_view(user, owner_id):
+    """没有所有者的任务所有人可见，否则只有所有者可见"""
+    if owner_id is None:
+        return True
+    return bool(user and user.is_authenticated and user.id == owner_id)
+
+
+@database_sync_to_async
+def get_task_owner_id(task_id):
+    """返回任务的所有者ID；任务不存在时返回 False"""
+    owner_ids = list(Task.objects.filter(id=task_id).values_list('owner_id', flat=True))
+    return owner_ids[0] if owner_ids else False
+
 
 class TaskStatusConsumer(AsyncWebsocketConsumer):
-    # 定义一个组名，所有客户端都将加入这个组
-    GROUP_NAME = 'task_updates'
+    """
+    任务实时更新。客户端连接后通过发送 JSON 指令来选择订阅范围：
+
+    * {"action": "subscribe", "task_ids": [1, 2], "after_seq": {"1": 40}}  订阅指定任务，
+      可选的 after_seq 会立即对这些任务做一次 resync
+    * {"action": "unsubscribe", "task_ids": [1]}
+    * {"action": "subscribe_owner"} / {"action": "unsubscribe_owner"}      订阅/退订当前用户的全部任务
+    * {"action": "resync", "task_id": 1, "after_seq": 40}                 断线重连后补齐状态和日志
+
+    服务端推送的消息：
+    * {"type": "task.status", "task": {...}}                               任务摘要（不含日志）
+    * {"type": "task.log", "task_id": 1, "entries": [...], "last_seq": 42}  新增的日志条目
+    * {"type": "task.resync", "task": {...}, "entries": [...], "last_seq": 42}
+    """
 
     async def connect(self):
-        print(">>> [Consumer] WebSocket connect()方法被调用。")
+        self.task_ids = set()
+        self.owner_group = None
+        await self.accept()
+
+        # 兼容通过查询参数直接订阅: ws/task-updates/?tasks=1,2
+        query = parse_query(self.scope)
+        if query.get('tasks'):
+            task_ids = [int(task_id) for task_id in query['tasks'].split(',') if task_id.isdigit()]
+            await self.subscribe_tasks(task_ids)
+        if query.get('owner') in ('1', 'true'):
+            await self.subscribe_owner()
+
+    async def disconnect(self, close_code):
+        """当WebSocket连接断开时调用"""
+        for task_id in self.task_ids:
+            await self.channel_layer.group_discard(task_group_name(task_id), self.channel_name)
+        if self.owner_group:
+            await self.channel_layer.group_discard(self.owner_group, self.channel_name)
+
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            print(">>> [Consumer] 准备加入组...")
-            await self.channel_layer.group_add(
-                self.GROUP_NAME,
-                self.channel_name
-            )
-            print(">>> [Consumer] 成功加入组！")
-        except Exception as e:
-            print(f">>> [Consumer] 加入组时发生严重错误: {e}")
-            # 如果出错了，拒绝连接
+            command = json.loads(text_data or '{}')
+        except json.JSONDecodeError:
+            await self.send_error('无法解析的指令')
+            return
+
+        if not isinstance(command, dict):
+            await self.send_error('指令必须是一个 JSON 对象')
+            return
+
+        action = command.get('action')
+        if action == 'subscribe':
+            task_ids = parse_id_list(command.get('task_ids', []))
+            after_seq = parse_after_seq(command.get('after_seq') or {})
+            if task_ids is None:
+                await self.send_error("'task_ids' 必须是任务ID数组")
+            elif after_seq is None:
+                await self.send_error("'after_seq' 必须是 {任务ID: 序号} 形式的对象")
+            else:
+                await self.subscribe_tasks(task_ids, after_seq)
+        elif action == 'unsubscribe':
+            task_ids = parse_id_list(command.get('task_ids', []))
+            if task_ids is None:
+                await self.send_error("'task_ids' 必须是任务ID数组")
+                return
+            for task_id in task_ids:
+                if task_id in self.task_ids:
+                    self.task_ids.discard(task_id)
+                    await self.channel_layer.group_discard(task_group_name(task_id), self.channel_name)
+        elif action == 'subscribe_owner':
+            await self.subscribe_owner()
+        elif action == 'unsubscribe_owner':
+            if self.owner_group:
+                await self.channel_layer.group_discard(self.owner_group, self.channel_name)
+                self.owner_group = None
+        elif action == 'resync':
+            task_id, after_seq = parse_id(command.get('task_id')), parse_id(command.get('after_seq', 0))
+            if task_id is None or after_seq is None:
+                await self.send_error("'task_id' 和 'after_seq' 必须是非负整数")
+            else:
+                await self.resync(task_id, after_seq)
+        else:
+            await self.send_error(f"未知的指令: {action}")
+
+    async def subscribe_tasks(self, task_ids, after_seq=None):
+        """task_ids 为 [int]，after_seq 为 {任务ID: 序号}，均已校验"""
+        after_seq = after_seq or {}
+        for task_id in task_ids:
+            owner_id = await get_task_owner_id(task_id)
+            if owner_id is False or not self.can_view(owner_id):
+                await self.send_error(f"无权订阅任务 #{task_id}")
+                continue
+            if task_id not in self.task_ids:
+                self.task_ids.add(task_id)
+                await self.channel_layer.group_add(task_group_name(task_id), self.channel_name)
+            if task_id in after_seq:
+                await self.resync(task_id, after_seq[task_id])
+
+    async def subscribe_owner(self):
+        user = self.scope.get('user')
+        if not user or not user.is_authenticated:
+            await self.send_error('订阅自己的任务需要先登录')
+            return
+        if not self.owner_group:
+            self.owner_group = owner_group_name(user.id)
+            await self.channel_layer.group_add(self.owner_group, self.channel_name)
+
+    async def resync(self, task_id, after_seq):
+        payload = await self.build_resync_payload(task_id, after_seq)
+        if payload is None:
+            await self.send_error(f"无权查看任务 #{task_id}")
+            return
+        await self.send(text_data=json.dumps(payload))
+
+    def can_view(self, owner_id):
+        return user_can_view(self.scope.get('user'), owner_id)
+
+    @database_sync_to_async
+    def build_resync_payload(self, task_id, after_seq):
+        from .serializers import TaskSummarySerializer, TaskLogEntrySerializer
+        task = Task.objects.select_related('script').filter(id=task_id).first()
+        if task is None or not self.can_view(task.owner_id):
+            return None
+        # 日志可能已归档，与其他读取方一样经 log_entries_after 合并归档和数据库中的日志
+        entries = TaskLogEntrySerializer(task.log_entries_after(after_seq), many=True).data
+        return {
+            'type': 'task.resync',
+            'task': TaskSummarySerializer(task).data,
+            'entries': entries,
+            'last_seq': entries[-1]['seq'] if entries else after_seq,
+        }
+
+    async def send_error(self, message):
+        await self.send(text_data=json.dumps({'type': 'error', 'message': message}))
+
+    async def task_status(self, event):
+        """处理频道层中类型为 'task.status' 的消息"""
+        await self.send(text_data=json.dumps({'type': 'task.status', 'task': event['task']}))
+
+    async def task_log(self, event):
+        """处理频道层中类型为 'task.log' 的消息，只转发新增的日志条目"""
+        await self.send(text_data=json.dumps({
+            'type': 'task.log',
+            'task_id': event['task_id'],
+            'entries': event['entries'],
+            'last_seq': event['last_seq'],
+        }))
+
+
+
+class DeviceStatusConsumer(AsyncWebsocketConsumer):
+    """
+    设备列表实时更新。连接后先收到一份完整列表，之后设备上线/离线时收到：
+    {"type": "devices.changed", "devices": [...在线设备], "changes": [{"serial": ..., "status": ...}]}
+    """
+
+    async def connect(self):
+        await self.accept()
+        await self.channel_layer.group_add(DEVICES_GROUP, self.channel_name)
+        devices = await sync_to_async(device_registry.devices)()
+        await self.send(text_data=json.dumps({
+            'type': 'devices.snapshot',
+            'devices': devices,
+            'error': device_registry.error,
+        }))
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(DEVICES_GROUP, self.channel_name)
+
+    async def devices_changed(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'devices.changed',
+            'devices': event['devices'],
+            'changes': event['changes'],
+        }))
+
+
+
+class TaskStreamConsumer(AsyncWebsocketConsumer):
+    """
+    任务实时画面：ws/tasks/<task_id>/stream/?fps=2
+
+    每一帧先发送一条文本消息 {"type": "stream.frame", "seq", "width", "height", "mime", "dropped"}，
+    紧接着发送图片的二进制数据；任务结束时发送 {"type": "stream.end"}。
+    客户端每显示完一帧回复 {"action": "ack"}。未确认的帧达到 STREAM_MAX_IN_FLIGHT 时，
+    后续的帧只保留最新一帧，等收到确认后再发送，中间的帧直接丢弃。
+    """
+
+    async def connect(self):
+        self.task_id = int(self.scope['url_route']['kwargs']['task_id'])
+        owner_id = await get_task_owner_id(self.task_id)
+        if owner_id is False or not user_can_view(self.scope.get('user'), owner_id):
             await self.close()
             return
 
+        max_fps = getattr(settings, 'STREAM_FPS', 5)
+        try:
+            fps = min(float(parse_query(self.scope).get('fps', max_fps)), max_fps)
+        except ValueError:
+            fps = max_fps
+        self.min_interval = 1 / fps if fps > 0 else 1 / max_fps
+        self.max_in_flight = getattr(settings, 'STREAM_MAX_IN_FLIGHT', 2)
+        self.in_flight = 0
+        self.pending = None
+        self.dropped = 0
+        self.last_sent_at = 0
+        self.flush_task = None
+
+        self.group_name = stream_group_name(self.task_id)
         await self.accept()
-        print(f">>> [Consumer] WebSocket连接已接受！客户端: {self.channel_name}")
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await sync_to_async(register_viewer)(self.task_id, self.channel_name)
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
 
     async def disconnect(self, close_code):
-        """当WebSocket连接断开时调用"""
-        # 将当前连接从组中移除
-        await self.channel_layer.group_discard(
-            self.GROUP_NAME,
-            self.channel_name
-        )
-        print(f"WebSocket客户端 {self.channel_name} 已断开")
-
-    async def task_update(self, event):
-        """
-        这是一个自定义的事件处理器。
-        当从频道层收到类型为'task.update'的消息时，这个方法会被调用。
-        """
-        # 将从频道层收到的消息，通过WebSocket发送给前端客户端
-        await self.send(text_data=json.dumps(event['message']))
-        print(f"已向客户端发送任务更新: {event['message']}")
+        if not hasattr(self, 'group_name'):
+            return
+        self.heartbeat_task.cancel()
+        if self.flush_task:
+            self.flush_task.cancel()
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        await sync_to_async(unregister_viewer)(self.task_id, self.channel_name)
+
+    async def heartbeat(self):
+        interval = getattr(settings, 'STREAM_VIEWER_TTL', 15) / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await sync_to_async(register_viewer)(self.task_id, self.channel_name)
+            except Exception as e:
+                print(f"续期任务 #{self.task_id} 的观看者失败: {e}")
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            command = json.loads(text_data or '{}')
+        except json.JSONDecodeError:
+            return
+        if command.get('action') == 'ack':
+            self.in_flight = max(self.in_flight - 1, 0)
+            await self.send_pending()
+
+    async def stream_frame(self, event):
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = event
+        await self.send_pending()
+
+    async def stream_end(self, event):
+        await self.send(text_data=json.dumps({'type': 'stream.end'}))
+
+    async def send_pending(self):
+        if self.pending is None or self.in_flight >= self.max_in_flight:
+            return
+        loop = asyncio.get_running_loop()
+        wait = self.min_interval - (loop.time() - self.last_sent_at)
+        if wait > 0:
+            # 超过客户端要求的帧率：到点后再发送届时最新的一帧
+            if self.flush_task is None or self.flush_task.done():
+                self.flush_task = asyncio.ensure_future(self.send_later(wait))
+            return
+
+        event, self.pending = self.pending, None
+        self.in_flight += 1
+        self.last_sent_at = loop.time()
+        await self.send(text_data=json.dumps({
+            'type': 'stream.frame',
+            'seq': event['seq'],
+            'width': event['width'],
+            'height': event['height'],
+            'mime': event['mime'],
+            'dropped': self.dropped,
+        }))
+        await self.send(bytes_data=event['data'])
+
+    async def send_later(self, delay):
+        await asyncio.sleep(delay)
+        await self.send_pending()
@@ -0,0 +1,181 @@
+"""
+设备注册表。
+
+后台线程通过 adb server 的 host:track-devices-l 协议长连接跟踪设备：adb server 会在设备
+上线、离线或状态变化时主动推送完整的设备列表，无需定时启动 adb 子进程。
+adb server 不可用时（例如尚未启动），退回为每 DEVICE_REGISTRY_POLL_INTERVAL 秒执行一次
+`adb devices -l`（该命令同时会拉起 adb server），随后再尝试建立跟踪连接。
+跟踪连接中断后先等待再重连，连续中断时等待时间逐次加倍，最长 TRACK_RECONNECT_MAX_DELAY 秒。
+
+/api/devices/ 直接读取内存中的设备列表；设备变化时通过 Channels 的 "devices" 组推送给
+DeviceStatusConsumer，因此无论多少个页面在看设备列表，都只有这一个后台连接。
+"""
+import re
+import socket
+import subprocess
+import threading
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+DEVICES_GROUP = 'devices'
+# 跟踪连接反复中断时重连等待时间的上限（秒）
+TRACK_RECONNECT_MAX_DELAY = 30
+
+
+def parse_device_list(text):
+    """解析 `adb devices -l` / track-devices-l 的输出，返回 {serial: 设备信息}"""
+    devices = {}
+    for line in text.splitlines():
+        parts = line.split()
+        if len(parts) < 2 or line.startswith('List of devices'):
+            continue
+        model_match = re.search(r'model:(\S+)', line)
+        devices[parts[0]] = {
+            'uri': f"Android:///{parts[0]}",
+            'serial': parts[0],
+            'status': parts[1],
+            'model': model_match.group(1) if model_match else 'Unknown',
+        }
+    return devices
+
+
+class AdbTrackConnection:
+    """与 adb server 之间的一条 track-devices-l 长连接"""
+
+    def __init__(self, host, port, timeout=5):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        request = b'host:track-devices-l'
+        self.sock.sendall(b'%04x' % len(request) + request)
+        status = self._read_exact(4)
+        if status != b'OKAY':
+            raise ConnectionError(f"adb server 拒绝了 track-devices 请求: {self._read_message()}")
+        # 之后 adb server 只在设备变化时才推送，读取不再设超时
+        self.sock.settimeout(None)
+
+    def _read_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("adb server 关闭了连接")
+            data += chunk
+        return data
+
+    def _read_message(self):
+        length = int(self._read_exact(4), 16)
+        return self._read_exact(length).decode('utf-8', errors='replace') if length else ''
+
+    def __iter__(self):
+        """逐次产出 adb server 推送的完整设备列表"""
+        while True:
+            yield parse_device_list(self._read_message())
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class DeviceRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._devices = {}
+        # 第一次拿到设备列表（或确认无法获取）后置位
+        self._ready = threading.Event()
+        self.error = None
+        self.mode = None
+
+    @property
+    def poll_interval(self):
+        return getattr(settings, 'DEVICE_REGISTRY_POLL_INTERVAL', 2)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='device-registry', daemon=True)
+                self._thread.start()
+
+    def devices(self, wait=2):
+        """当前在线（状态为 device）的设备。首次调用时启动后台线程，并最多等待 wait 秒拿到第一份列表"""
+        self.start()
+        self._ready.wait(wait)
+        with self._lock:
+            return [info for info in self._devices.values() if info['status'] == 'device']
+
+    def _run(self):
+        host = getattr(settings, 'ADB_SERVER_HOST', '127.0.0.1')
+        port = getattr(settings, 'ADB_SERVER_PORT', 5037)
+        stop = threading.Event()
+        reconnect_delay = self.poll_interval
+        while True:
+            try:
+                connection = AdbTrackConnection(host, port)
+            except OSError as e:
+                if self.mode != 'poll':
+                    print(f"无法连接 adb server ({e})，改为轮询 adb devices")
+                self.mode = 'poll'
+                self._poll_once()
+                stop.wait(self.poll_interval)
+                continue
+
+            print("设备注册表已通过 track-devices 连接到 adb server")
+            self.mode = 'track'
+            received = False
+            try:
+                for devices in connection:
+                    received = True
+                    self.error = None
+                    self._update(devices)
+            except (OSError, ValueError) as e:
+                print(f"track-devices 连接中断: {e}")
+            finally:
+                connection.close()
+
+            # 连接曾正常推送过设备列表时从最短间隔重新开始，否则（连上即断开）逐次加倍，避免空转
+            reconnect_delay = self.poll_interval if received else min(reconnect_delay * 2, TRACK_RECONNECT_MAX_DELAY)
+            stop.wait(reconnect_delay)
+
+    def _poll_once(self):
+        try:
+            result = subprocess.run(['adb', 'devices', '-l'], capture_output=True, text=True, check=True,
+                                    encoding='utf-8', timeout=10)
+        except FileNotFoundError:
+            self.error = "未找到 'adb' 命令。"
+            self._ready.set()
+            return
+        except Exception as e:
+            self.error = f"发生未知错误: {str(e)}"
+            self._ready.set()
+            return
+        self.error = None
+        self._update(parse_device_list(result.stdout))
+
+    def _update(self, devices):
+        with self._lock:
+            previous, self._devices = self._devices, devices
+            online = [info for info in devices.values() if info['status'] == 'device']
+        self._ready.set()
+
+        changes = [
+            {'serial': serial, 'status': info['status']}
+            for serial, info in devices.items()
+            if previous.get(serial, {}).get('status') != info['status']
+        ] + [{'serial': serial, 'status': 'removed'} for serial in previous if serial not in devices]
+        if changes:
+            self._broadcast(online, changes)
+
+    def _broadcast(self, online, changes):
+        try:
+            async_to_sync(get_channel_layer().group_send)(DEVICES_GROUP, {
+                'type': 'devices.changed',
+                'devices': online,
+                'changes': changes,
+            })
+        except Exception as e:
+            print(f"推送设备变化失败: {e}")
+
+
+registry = DeviceRegistry()
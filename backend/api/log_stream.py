@@ -0,0 +1,93 @@
+"""
+任务日志的 Server-Sent Events 流。
+
+先从数据库补发 after_seq 之后的日志，随后加入任务的频道组，直接转发 TaskLogger 广播的
+task.log / task.status 消息，运行中的任务不需要反复查询数据库。任务结束且日志发完后发送
+end 事件并关闭连接。
+"""
+import asyncio
+import json
+import time
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .consumers import task_group_name
+from .models import Task, TaskLogEntry
+from .serializers import TaskLogEntrySerializer
+
+FINISHED_STATUSES = ('SUCCESS', 'FAILED', 'CANCELED')
+
+
+def sse_event(event, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+@database_sync_to_async
+def fetch_entries(task_id, after_seq, limit):
+    entries = list(TaskLogEntry.objects.filter(task_id=task_id, seq__gt=after_seq).order_by('seq')[:limit])
+    if not entries:
+        # 日志可能已被归档（见 executor/log_archive.py）
+        task = Task.objects.filter(id=task_id, log_archive__isnull=False).first()
+        if task is not None:
+            entries = task.log_entries_after(after_seq, limit)
+    return TaskLogEntrySerializer(entries, many=True).data
+
+
+@database_sync_to_async
+def fetch_status(task_id):
+    return Task.objects.filter(id=task_id).values_list('status', flat=True).first()
+
+
+async def task_log_events(task_id, after_seq):
+    """按 SSE 格式逐条产出 after_seq 之后的日志，直到任务结束或超过 LOG_STREAM_MAX_SECONDS"""
+    channel_layer = get_channel_layer()
+    keepalive = getattr(settings, 'LOG_STREAM_KEEPALIVE', 15)
+    deadline = time.time() + getattr(settings, 'LOG_STREAM_MAX_SECONDS', 60 * 60)
+    batch_size = getattr(settings, 'LOG_TAIL_MAX_ENTRIES', 1000)
+    last_seq = after_seq
+
+    # 先加入频道组再查询历史，两者之间产生的日志可能重复出现，按 seq 去重即可
+    channel = await channel_layer.new_channel()
+    group = task_group_name(task_id)
+    await channel_layer.group_add(group, channel)
+    try:
+        while True:
+            entries = await fetch_entries(task_id, last_seq, batch_size)
+            for entry in entries:
+                yield sse_event('log', entry, entry['seq'])
+            if entries:
+                last_seq = entries[-1]['seq']
+            if len(entries) < batch_size:
+                break
+
+        status = await fetch_status(task_id)
+        while status is not None and status not in FINISHED_STATUSES and time.time() < deadline:
+            try:
+                message = await asyncio.wait_for(channel_layer.receive(channel), keepalive)
+            except asyncio.TimeoutError:
+                # 长时间没有消息：发送注释保持连接，并确认任务是否已经结束（广播可能丢失）
+                yield b': keepalive\n\n'
+                status = await fetch_status(task_id)
+                continue
+
+            if message['type'] == 'task.log':
+                for entry in message['entries']:
+                    if entry['seq'] > last_seq:
+                        yield sse_event('log', entry, entry['seq'])
+                        last_seq = entry['seq']
+            elif message['type'] == 'task.status':
+                status = message['task']['status']
+                yield sse_event('status', message['task'])
+
+        # 结束前补齐可能尚未收到广播的日志
+        for entry in await fetch_entries(task_id, last_seq, batch_size):
+            yield sse_event('log', entry, entry['seq'])
+            last_seq = entry['seq']
+        yield sse_event('end', {'status': status, 'last_seq': last_seq})
+    finally:
+        await channel_layer.group_discard(group, channel)
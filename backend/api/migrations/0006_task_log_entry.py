@@ -0,0 +1,63 @@
+# Generated by Django 4.2.26 on 2026-10-18 14:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def split_task_logs(apps, schema_editor):
+    """把旧的 Task.log 文本按行拆分为日志条目"""
+    Task = apps.get_model('api', 'Task')
+    TaskLogEntry = apps.get_model('api', 'TaskLogEntry')
+    for task in Task.objects.exclude(log__isnull=True).exclude(log='').iterator():
+        lines = task.log.rstrip('\n').split('\n')
+        timestamp = task.completed_at or task.started_at or task.created_at
+        TaskLogEntry.objects.bulk_create([
+            TaskLogEntry(task_id=task.id, seq=seq, timestamp=timestamp, message=line)
+            for seq, line in enumerate(lines, start=1)
+        ], batch_size=500)
+
+
+def join_task_logs(apps, schema_editor):
+    """回滚时把日志条目重新拼接回 Task.log"""
+    Task = apps.get_model('api', 'Task')
+    TaskLogEntry = apps.get_model('api', 'TaskLogEntry')
+    for task in Task.objects.iterator():
+        messages = TaskLogEntry.objects.filter(task_id=task.id).order_by('seq').values_list('message', flat=True)
+        if messages:
+            task.log = ''.join(f"{message}\n" for message in messages)
+            task.save(update_fields=['log'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_script_owner_task_owner_alter_task_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskLogEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField(verbose_name='序号')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now, verbose_name='记录时间')),
+                ('level', models.CharField(choices=[('INFO', '信息'), ('WARNING', '警告'), ('ERROR', '错误')], default='INFO', max_length=10, verbose_name='级别')),
+                ('node_path', models.CharField(blank=True, default='', help_text='产生该日志的脚本节点位置，例如 steps.2.if_true.0', max_length=255, verbose_name='节点路径')),
+                ('message', models.TextField(verbose_name='日志内容')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='log_entries', to='api.task', verbose_name='关联任务')),
+            ],
+            options={
+                'ordering': ['seq'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='tasklogentry',
+            constraint=models.UniqueConstraint(fields=('task', 'seq'), name='unique_task_log_seq'),
+        ),
+        migrations.RunPython(split_task_logs, join_task_logs),
+        migrations.RemoveField(
+            model_name='task',
+            name='log',
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.26 on 2026-10-18 14:27
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0006_task_log_entry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('owner', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='task_batches', to=settings.AUTH_USER_MODEL, verbose_name='所有者')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='batch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tasks', to='api.taskbatch', verbose_name='所属批次'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.26 on 2026-10-18 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_task_batch'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='log_archive',
+            field=models.CharField(blank=True, help_text='日志归档在归档存储中的键，见 executor/log_archive.py', max_length=255, null=True, verbose_name='日志归档'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='log_archive_size',
+            field=models.PositiveIntegerField(blank=True, help_text='压缩后的字节数', null=True, verbose_name='日志归档大小'),
+        ),
+    ]
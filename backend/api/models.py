@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models import Max
+from django.utils import timezone
+from collections import Counter
 import os
 from django.conf import settings
 from django.contrib.auth.models import User
@@ -17,6 +20,36 @@ class Script(models.Model):
     def __str__(self):
         return self.name
 
+class TaskBatch(models.Model):
+    """
+    批量运行：一次请求把若干脚本分发到若干台设备，每个 (脚本, 设备) 组合对应一个 Task
+    """
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    owner = models.ForeignKey(User, related_name='task_batches', on_delete=models.CASCADE, null=True, blank=True,
+                              verbose_name="所有者")
+
+    @property
+    def status_counts(self):
+        """各状态的任务数；配合 prefetch_related('tasks') 使用时不产生额外查询"""
+        return dict(Counter(task.status for task in self.tasks.all()))
+
+    @property
+    def status(self):
+        """批次的汇总状态：全部成功为 SUCCESS；全部结束但有失败 / 取消时为 FAILED / CANCELED"""
+        counts = self.status_counts
+        total = sum(counts.values())
+        if total == 0 or counts.get('PENDING', 0) == total:
+            return 'PENDING'
+        if counts.get('PENDING', 0) or counts.get('RUNNING', 0) or counts.get('PAUSED', 0):
+            return 'RUNNING'
+        if counts.get('SUCCESS', 0) == total:
+            return 'SUCCESS'
+        return 'FAILED' if counts.get('FAILED', 0) else 'CANCELED'
+
+    def __str__(self):
+        return f"批次 #{self.id}"
+
+
 class Task(models.Model):
     """
     自动化任务模型
@@ -32,7 +65,6 @@ class Task(models.Model):
 
     script = models.ForeignKey(Script, on_delete=models.CASCADE, verbose_name="关联脚本")
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING', verbose_name="任务状态")
-    log = models.TextField(blank=True, null=True, verbose_name="任务日志")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
     started_at = models.DateTimeField(null=True, blank=True, verbose_name="开始时间")
     completed_at = models.DateTimeField(null=True, blank=True, verbose_name="完成时间")
@@ -44,6 +76,53 @@ class Task(models.Model):
 
     owner = models.ForeignKey(User, related_name='tasks', on_delete=models.CASCADE, null=True, blank=True,
                               verbose_name="所有者")
+    batch = models.ForeignKey(TaskBatch, related_name='tasks', on_delete=models.SET_NULL, null=True, blank=True,
+                              verbose_name="所属批次")
+    # 日志归档后，TaskLogEntry 中的日志行被删除，只保留归档存储中的键和压缩后的大小
+    log_archive = models.CharField("日志归档", max_length=255, null=True, blank=True,
+                                   help_text="日志归档在归档存储中的键，见 executor/log_archive.py")
+    log_archive_size = models.PositiveIntegerField("日志归档大小", null=True, blank=True,
+                                                   help_text="压缩后的字节数")
+
+    def archived_log_entries(self):
+        """从归档中取回并解压的日志条目（不保存在数据库中），同一对象只读取一次"""
+        if not self.log_archive:
+            return []
+        if getattr(self, '_archived_log_entries', None) is None:
+            from executor.log_archive import load_entries
+            self._archived_log_entries = [TaskLogEntry(task_id=self.id, **entry)
+                                          for entry in load_entries(self.log_archive)]
+        return self._archived_log_entries
+
+    def log_entries_after(self, after_seq, limit=None):
+        """
+        序号大于 after_seq 的日志条目，最多 limit 条（None 表示不限）；
+        已归档的任务先读归档，再读之后追加的日志
+        """
+        entries = [entry for entry in self.archived_log_entries() if entry.seq > after_seq][:limit]
+        if limit is None or len(entries) < limit:
+            last_seq = entries[-1].seq if entries else after_seq
+            remaining = self.log_entries.filter(seq__gt=last_seq).order_by('seq')
+            entries += list(remaining if limit is None else remaining[:limit - len(entries)])
+        return entries
+
+    @property
+    def log(self):
+        """
+        按序号拼接日志条目，得到完整的日志文本（每次访问时才查询，已归档的日志按需解压）
+        """
+        entries = self.archived_log_entries() + list(self.log_entries.all())
+        return ''.join(f"{entry.message}\n" for entry in entries)
+
+    @property
+    def log_last_seq(self):
+        """最后一条日志的序号，客户端据此请求增量日志"""
+        last_seq = self.log_entries.aggregate(last=Max('seq'))['last']
+        if last_seq is None and self.log_archive:
+            archived = self.archived_log_entries()
+            last_seq = archived[-1].seq if archived else None
+        return last_seq or 0
+
     @property
     def latest_screenshot_url(self):
         if self.latest_screenshot:
@@ -51,5 +130,68 @@ class Task(models.Model):
             return f"{settings.MEDIA_URL}{url_path}"
         return None
 
+    @property
+    def latest_screenshot_thumbnail_url(self):
+        """截图存储生成的缩略图；旧版截图没有缩略图，直接使用原图"""
+        from executor.screenshot_store import thumbnail_path
+        thumbnail = thumbnail_path(self.latest_screenshot)
+        if thumbnail:
+            return f"{settings.MEDIA_URL}{thumbnail}"
+        return self.latest_screenshot_url
+
+    class Meta:
+        indexes = [
+            # 任务列表：按所有者过滤、按创建时间倒序的游标分页，以及附加的状态 / 设备过滤
+            models.Index(fields=['owner', '-created_at', '-id'], name='task_owner_created_idx'),
+            models.Index(fields=['owner', 'status', '-created_at'], name='task_owner_status_idx'),
+            models.Index(fields=['device_uri', '-created_at'], name='task_device_created_idx'),
+            # 按状态查询，以及日志归档 / 保留策略按结束时间挑选已结束的任务
+            models.Index(fields=['status', 'completed_at'], name='task_status_completed_idx'),
+        ]
+
     def __str__(self):
         return f"任务 #{self.id} - {self.script.name} ({self.get_status_display()})"
+
+
+
+class TaskLogEntryManager(models.Manager):
+    def next_seq(self, task_id):
+        """返回该任务下一条日志应使用的序号"""
+        last_seq = self.filter(task_id=task_id).aggregate(last=Max('seq'))['last']
+        if last_seq is None:
+            # 日志已归档的任务从归档中的最后一条继续编号
+            task = Task.objects.filter(id=task_id, log_archive__isnull=False).first()
+            if task is not None:
+                archived = task.archived_log_entries()
+                last_seq = archived[-1].seq if archived else None
+        return (last_seq or 0) + 1
+
+
+class TaskLogEntry(models.Model):
+    """
+    任务日志条目：只追加、不修改，一行日志对应一条记录
+    """
+    LEVEL_CHOICES = [
+        ('INFO', '信息'),
+        ('WARNING', '警告'),
+        ('ERROR', '错误'),
+    ]
+
+    task = models.ForeignKey(Task, related_name='log_entries', on_delete=models.CASCADE, verbose_name="关联任务")
+    seq = models.PositiveIntegerField(verbose_name="序号")
+    timestamp = models.DateTimeField(default=timezone.now, verbose_name="记录时间")
+    level = models.CharField(max_length=10, choices=LEVEL_CHOICES, default='INFO', verbose_name="级别")
+    node_path = models.CharField(max_length=255, blank=True, default='', verbose_name="节点路径",
+                                 help_text="产生该日志的脚本节点位置，例如 steps.2.if_true.0")
+    message = models.TextField(verbose_name="日志内容")
+
+    objects = TaskLogEntryManager()
+
+    class Meta:
+        ordering = ['seq']
+        constraints = [
+            models.UniqueConstraint(fields=['task', 'seq'], name='unique_task_log_seq'),
+        ]
+
+    def __str__(self):
+        return f"任务 #{self.task_id} [{self.seq}] {self.message}"
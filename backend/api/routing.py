@@ -3,4 +3,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/task-updates/$', consumers.TaskStatusConsumer.as_asgi()),
+    re_path(r'ws/devices/$', consumers.DeviceStatusConsumer.as_asgi()),
+    re_path(r'ws/tasks/(?P<task_id>\d+)/stream/$', consumers.TaskStreamConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -1,19 +1,72 @@
 from rest_framework import serializers
-from .models import Script, Task
+from django.conf import settings
+from .models import Script, Task, TaskLogEntry, TaskBatch
+from executor.compiler import compile_script, ScriptCompileError
 
 class ScriptSerializer(serializers.ModelSerializer):
     class Meta:
         model = Script
         fields = '__all__'
 
-class TaskSerializer(serializers.ModelSerializer):
+    def validate_content(self, value):
+        """保存前先编译一遍脚本，结构不合法的脚本直接拒绝"""
+        try:
+            compile_script(value)
+        except ScriptCompileError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+class TaskSummarySerializer(serializers.ModelSerializer):
+    """不含日志的任务摘要，用于状态广播等高频场景"""
     script_name = serializers.StringRelatedField(source='script.name', read_only=True)
 
     class Meta:
         model = Task
-        read_only_fields = ('status', 'started_at', 'completed_at', 'latest_screenshot','latest_screenshot_url', )
+        read_only_fields = ('status', 'started_at', 'completed_at', 'latest_screenshot','latest_screenshot_url',
+                            'latest_screenshot_thumbnail_url', )
 
         fields = [
-            'id', 'script', 'script_name', 'status', 'log','created_at', 'started_at',
-            'completed_at', 'latest_screenshot','latest_screenshot_url'
+            'id', 'script', 'script_name', 'status', 'device_uri', 'created_at', 'started_at',
+            'completed_at', 'latest_screenshot','latest_screenshot_url', 'latest_screenshot_thumbnail_url'
         ]
+
+class TaskSerializer(TaskSummarySerializer):
+    # log 不再是数据库字段，而是由 TaskLogEntry 按需拼接出来的
+    log = serializers.CharField(read_only=True)
+    log_last_seq = serializers.IntegerField(read_only=True)
+
+    class Meta(TaskSummarySerializer.Meta):
+        fields = [
+            'id', 'script', 'script_name', 'status', 'device_uri', 'log', 'log_last_seq', 'log_archive_size',
+            'created_at', 'started_at', 'completed_at', 'latest_screenshot','latest_screenshot_url',
+            'latest_screenshot_thumbnail_url'
+        ]
+
+class TaskLogEntrySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = TaskLogEntry
+        fields = ['seq', 'timestamp', 'level', 'node_path', 'message']
+
+
+class TaskBatchSerializer(serializers.ModelSerializer):
+    status = serializers.CharField(read_only=True)
+    status_counts = serializers.DictField(child=serializers.IntegerField(), read_only=True)
+    tasks = TaskSummarySerializer(many=True, read_only=True)
+
+    class Meta:
+        model = TaskBatch
+        fields = ['id', 'created_at', 'status', 'status_counts', 'tasks']
+
+
+class TaskBatchCreateSerializer(serializers.Serializer):
+    """批量运行的请求：script_ids 中每个脚本都会在 device_uris 中的每台设备上运行一次"""
+    script_ids = serializers.ListField(child=serializers.IntegerField(), min_length=1)
+    device_uris = serializers.ListField(child=serializers.CharField(max_length=255), min_length=1)
+
+    def validate(self, attrs):
+        attrs['script_ids'] = list(dict.fromkeys(attrs['script_ids']))
+        attrs['device_uris'] = list(dict.fromkeys(attrs['device_uris']))
+        max_tasks = getattr(settings, 'BATCH_MAX_TASKS', 500)
+        if len(attrs['script_ids']) * len(attrs['device_uris']) > max_tasks:
+            raise serializers.ValidationError(f"单个批次最多包含 {max_tasks} 个任务")
+        return attrs
@@ -1,3 +1,72 @@
-from django.test import TestCase
+from unittest import mock
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from .consumers import TaskStatusConsumer
+from .models import Script, Task, TaskLogEntry
+from .views import metrics_view
 
-# Create your tests here.
+
+class TaskLogEntryManagerTests(TestCase):
+    def setUp(self):
+        script = Script.objects.create(name='demo', content={'steps': []})
+        self.task = Task.objects.create(script=script)
+        self.other = Task.objects.create(script=script)
+
+    def add_entries(self, task, *seqs):
+        TaskLogEntry.objects.bulk_create(TaskLogEntry(task=task, seq=seq, message=f"line {seq}") for seq in seqs)
+
+    def test_first_seq_is_one(self):
+        self.assertEqual(TaskLogEntry.objects.next_seq(self.task.id), 1)
+
+    def test_continues_after_last_entry_of_the_task(self):
+        self.add_entries(self.task, 1, 2, 5)
+        self.add_entries(self.other, 1, 2, 3, 4, 5, 6, 7)
+        self.assertEqual(TaskLogEntry.objects.next_seq(self.task.id), 6)
+
+
+@mock.patch('executor.metrics.worker_snapshots', return_value=[])
+class MetricsViewTests(SimpleTestCase):
+    def setUp(self):
+        self.url = reverse(metrics_view)
+
+    def test_local_address_is_allowed(self, _):
+        response = self.client.get(self.url, REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE autoplay_node_seconds histogram', response.content.decode())
+
+    def test_other_address_is_denied_without_token(self, _):
+        self.assertEqual(self.client.get(self.url, REMOTE_ADDR='10.0.0.5').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_bearer_token(self, _):
+        ok = self.client.get(self.url, REMOTE_ADDR='10.0.0.5', HTTP_AUTHORIZATION='Bearer secret')
+        wrong = self.client.get(self.url, REMOTE_ADDR='10.0.0.5', HTTP_AUTHORIZATION='Bearer guess')
+        self.assertEqual(ok.status_code, 200)
+        self.assertEqual(wrong.status_code, 403)
+
+
+class TaskStatusConsumerTests(SimpleTestCase):
+    async def test_invalid_commands_are_answered_with_errors(self):
+        communicator = WebsocketCommunicator(TaskStatusConsumer.as_asgi(), '/ws/task-updates/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        commands = [
+            ['subscribe'],
+            {'action': 'subscribe', 'task_ids': ['x']},
+            {'action': 'subscribe', 'task_ids': 1},
+            {'action': 'subscribe', 'task_ids': [], 'after_seq': [40]},
+            {'action': 'subscribe', 'task_ids': [], 'after_seq': {'1': 'x'}},
+            {'action': 'unsubscribe', 'task_ids': [None]},
+            {'action': 'resync', 'task_id': None},
+            {'action': 'resync', 'task_id': 1, 'after_seq': -1},
+        ]
+        for command in commands:
+            with self.subTest(command=command):
+                await communicator.send_json_to(command)
+                response = await communicator.receive_json_from()
+                self.assertEqual(response['type'], 'error')
+        # 连接仍然可用
+        await communicator.send_json_to({'action': 'unsubscribe', 'task_ids': ['1', 2]})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
@@ -1,17 +1,21 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ScriptViewSet, TaskViewSet, list_devices, manual_screenshot, cancel_task
+from .views import ScriptViewSet, TaskViewSet, TaskBatchViewSet, list_devices, device_queues, manual_screenshot, cancel_task, \
+    metrics_view
 
 # 创建一个路由器，并注册我们的视图集
 router = DefaultRouter()
 router.register(r'scripts', ScriptViewSet,basename='script')
 router.register(r'tasks', TaskViewSet, basename='task')
+router.register(r'batches', TaskBatchViewSet, basename='batch')
 
 # API的URL由路由器自动确定
 urlpatterns = [
     path('', include(router.urls)),
 
     path('devices/',list_devices,name='devices-list'),
+    path('devices/queues/', device_queues, name='device-queues'),
+    path('metrics/', metrics_view, name='metrics'),
     path('tasks/<int:pk>/screenshot/', manual_screenshot, name='task-screenshot'),
 
     path('tasks/<int:pk>/cancel/', cancel_task, name='task-cancel'),
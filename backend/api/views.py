@@ -1,15 +1,29 @@
 from rest_framework import viewsets, status,permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .models import Script, Task
-from .serializers import ScriptSerializer, TaskSerializer
-from executor.tasks import execute_automation_task, take_manual_screenshot_task
-import subprocess
-import re
-from rest_framework.decorators import api_view
+from rest_framework.pagination import CursorPagination
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db import transaction
+from django.db.models import Prefetch
+from celery import group
+from celery.utils import uuid
+from django.conf import settings
+from .models import Script, Task, TaskLogEntry, TaskBatch
+from .device_registry import registry as device_registry
+from .serializers import (ScriptSerializer, TaskSerializer, TaskSummarySerializer, TaskLogEntrySerializer,
+                          TaskBatchSerializer, TaskBatchCreateSerializer)
+from .log_stream import task_log_events
+from executor.tasks import execute_automation_task
+from rest_framework.decorators import api_view, renderer_classes, authentication_classes, permission_classes
 from django.utils import timezone
 from executor.task_logger import TaskLogger
+from executor.cancellation import request_cancel, send_command
+from executor.scheduler import get_lease_manager
+from executor import metrics
 from backend.celery import app as celery_app
+import redis
+import json
 
 
 class ScriptViewSet(viewsets.ModelViewSet):
@@ -46,70 +60,233 @@ class ScriptViewSet(viewsets.ModelViewSet):
         # ★ 4. 在创建Task时，也记录下任务的所有者
         owner = request.user if request.user.is_authenticated else None
 
+        # 预先生成 Celery ID，一次 INSERT 即可，不必创建后再回写
+        celery_task_id = uuid()
         new_task = Task.objects.create(
             script=script,
             status='PENDING',
             device_uri=device_uri,
-            owner=owner
+            owner=owner,
+            celery_task_id=celery_task_id,
         )
+        transaction.on_commit(lambda: execute_automation_task.apply_async(
+            (new_task.id, device_uri), task_id=celery_task_id))
 
-        task_result = execute_automation_task.delay(new_task.id, device_uri)
-        new_task.celery_task_id = task_result.id
-        new_task.save()
-
-        print(f"创建任务 #{new_task.id}，Celery ID: {task_result.id}")
+        print(f"创建任务 #{new_task.id}，Celery ID: {celery_task_id}")
         serializer = TaskSerializer(new_task)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+class TaskBatchViewSet(viewsets.ModelViewSet):
+    """
+    批量运行：一次请求把若干脚本分发到若干设备上，每个 (脚本, 设备) 组合对应一个任务。
+    任务一次性批量写库，再以一个 Celery group 批量投递。
+    """
+    serializer_class = TaskBatchSerializer
+    permission_classes = [permissions.IsAuthenticated]
+    http_method_names = ['get', 'post', 'head', 'options']
+
+    def get_queryset(self):
+        tasks = Task.objects.select_related('script').order_by('id')
+        return TaskBatch.objects.filter(owner=self.request.user).prefetch_related(
+            Prefetch('tasks', queryset=tasks)).order_by('-created_at')
+
+    def create(self, request, *args, **kwargs):
+        params = TaskBatchCreateSerializer(data=request.data)
+        params.is_valid(raise_exception=True)
+        script_ids = params.validated_data['script_ids']
+        device_uris = params.validated_data['device_uris']
+
+        scripts = {script.id: script for script in Script.objects.filter(owner=request.user, id__in=script_ids)}
+        missing = [script_id for script_id in script_ids if script_id not in scripts]
+        if missing:
+            return Response({'error': f"脚本不存在: {missing}"}, status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
+            batch = TaskBatch.objects.create(owner=request.user)
+            Task.objects.bulk_create([
+                Task(script=scripts[script_id], device_uri=device_uri, status='PENDING',
+                     owner=request.user, batch=batch, celery_task_id=uuid())
+                for script_id in script_ids
+                for device_uri in device_uris
+            ])
+            # MySQL 的 bulk_create 不回填主键，重新查询拿到任务 ID
+            jobs = list(batch.tasks.values_list('id', 'device_uri', 'celery_task_id'))
+            transaction.on_commit(lambda: group(
+                execute_automation_task.signature((task_id, device_uri), task_id=celery_task_id)
+                for task_id, device_uri, celery_task_id in jobs
+            ).apply_async())
+
+        print(f"创建批次 #{batch.id}，共 {len(jobs)} 个任务")
+        batch = self.get_queryset().get(pk=batch.pk)
+        return Response(self.get_serializer(batch).data, status=status.HTTP_201_CREATED)
+
+
+class TaskCursorPagination(CursorPagination):
+    """按创建时间倒序的游标分页，翻页代价与任务总数无关"""
+    ordering = ('-created_at', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class EventStreamRenderer(BaseRenderer):
+    """让 DRF 的内容协商接受 Accept: text/event-stream，实际响应由 StreamingHttpResponse 直接输出"""
+    media_type = 'text/event-stream'
+    format = 'sse'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+def _query_int(params, key, default=0):
+    value = params.get(key, '')
+    return int(value) if value.isdigit() else default
+
+
+# 列表只查询摘要需要的列，script_name 通过 select_related 一并取出
+TASK_SUMMARY_FIELDS = (
+    'id', 'script_id', 'script__name', 'status', 'device_uri', 'created_at', 'started_at', 'completed_at',
+    'latest_screenshot', 'owner_id',
+)
+
+
 class TaskViewSet(viewsets.ModelViewSet):
     serializer_class = TaskSerializer
     # ★ 5. 同样为Task视图集设置权限和数据隔离
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     http_method_names = ['get', 'head', 'options']
-    pagination_class = None
+    pagination_class = TaskCursorPagination
+
+    def get_serializer_class(self):
+        # 列表使用不含日志的摘要；详情仍返回完整日志
+        if self.action == 'list':
+            return TaskSummarySerializer
+        return TaskSerializer
 
     def get_queryset(self):
         """为Task实现数据隔离"""
         user = self.request.user
-        if user.is_authenticated:
-            return Task.objects.filter(owner=user).order_by('-created_at')
-        return Task.objects.none()
+        if not user.is_authenticated:
+            return Task.objects.none()
+
+        queryset = Task.objects.filter(owner=user).select_related('script')
+        if self.action == 'list':
+            queryset = queryset.only(*TASK_SUMMARY_FIELDS)
+            params = self.request.query_params
+            # ?status=RUNNING,PENDING&script=3&device_uri=Android:///xxx
+            if params.get('status'):
+                queryset = queryset.filter(status__in=params['status'].upper().split(','))
+            if params.get('script', '').isdigit():
+                queryset = queryset.filter(script_id=params['script'])
+            if params.get('device_uri'):
+                queryset = queryset.filter(device_uri=params['device_uri'])
+        return queryset.order_by('-created_at', '-id')
+
+    @action(detail=True, methods=['get'], url_path='log')
+    def log_tail(self, request, pk=None):
+        """
+        增量日志：GET /api/tasks/{id}/log/?after=<seq>&limit=<n>
+        只返回序号大于 after 的日志条目，has_more 为 true 时用返回的 last_seq 继续请求。
+        """
+        task = self.get_object()
+        after_seq = _query_int(request.query_params, 'after')
+        max_entries = getattr(settings, 'LOG_TAIL_MAX_ENTRIES', 1000)
+        limit = min(_query_int(request.query_params, 'limit', max_entries) or max_entries, max_entries)
+
+        # 已归档的任务从归档中按需解压
+        entries = task.log_entries_after(after_seq, limit + 1)
+        has_more = len(entries) > limit
+        entries = entries[:limit]
+        return Response({
+            'task_id': task.id,
+            'status': task.status,
+            'entries': TaskLogEntrySerializer(entries, many=True).data,
+            'last_seq': entries[-1].seq if entries else after_seq,
+            'has_more': has_more,
+        })
+
+    @action(detail=True, methods=['get'], url_path='log/stream',
+            renderer_classes=[EventStreamRenderer, JSONRenderer])
+    def log_stream(self, request, pk=None):
+        """
+        日志流（Server-Sent Events）：GET /api/tasks/{id}/log/stream/?after=<seq>
+        事件类型为 log（id 为日志序号）、status（任务摘要）和 end。断线重连时浏览器会带上
+        Last-Event-ID，从该序号之后继续。
+        """
+        task = self.get_object()
+        after_seq = _query_int(request.query_params, 'after')
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        if last_event_id.isdigit():
+            after_seq = max(after_seq, int(last_event_id))
+
+        response = StreamingHttpResponse(task_log_events(task.id, after_seq), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # 关闭 nginx 等反向代理的响应缓冲
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 
 
-# ... (list_devices 和 manual_screenshot 函数保持不变) ...
 @api_view(['GET'])
 def list_devices(request):
+    """在线设备列表，直接读取后台设备注册表，不再为每次请求启动 adb 子进程"""
+    devices = device_registry.devices()
+    if device_registry.error and not devices:
+        return Response({'error': device_registry.error}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    return Response(devices)
+
+@api_view(['GET'])
+def device_queues(request):
+    """每台设备当前的占用任务、排队深度和等待时间"""
     try:
-        result = subprocess.run(['adb', 'devices', '-l'], capture_output=True, text=True, check=True, encoding='utf-8')
-        devices = []
-        lines = result.stdout.strip().split('\n')[1:]
-        for line in lines:
-            if not line.strip():
-                continue
-            parts = line.split()
-            if len(parts) >= 2 and parts[1] == 'device':
-                uri = f"Android:///{parts[0]}"
-                model_match = re.search(r'model:(\S+)', line)
-                model = model_match.group(1) if model_match else 'Unknown'
-                devices.append({'uri': uri, 'serial': parts[0], 'status': parts[1], 'model': model})
-        return Response(devices)
-    except FileNotFoundError:
-        return Response({'error': "未找到 'adb' 命令。"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response(get_lease_manager().stats())
     except Exception as e:
-        return Response({'error': f"发生未知错误: {str(e)}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return Response({'error': f"读取设备队列失败: {str(e)}"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class PrometheusTextRenderer(BaseRenderer):
+    """让 DRF 的内容协商接受 Prometheus 抓取时的 Accept: text/plain"""
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data.encode('utf-8') if isinstance(data, str) else json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+
+class MetricsPermission(permissions.BasePermission):
+    """只允许 METRICS_ALLOWED_IPS 中的地址，或携带 Bearer METRICS_TOKEN 的请求（见 executor/metrics.py）"""
+
+    def has_permission(self, request, view):
+        return metrics.is_authorized(request.META.get('REMOTE_ADDR'), request.META.get('HTTP_AUTHORIZATION'))
+
+
+@api_view(['GET'])
+@renderer_classes([PrometheusTextRenderer, JSONRenderer])
+# 不走 JWT 认证：Prometheus 携带的 Bearer METRICS_TOKEN 不是 JWT，由 MetricsPermission 校验
+@authentication_classes([])
+@permission_classes([MetricsPermission])
+def metrics_view(request):
+    """执行器指标（Prometheus 文本格式），合并了本进程和各 Celery worker 推送到 Redis 的快照"""
+    return HttpResponse(metrics.render(metrics.farm_snapshot()), content_type=metrics.CONTENT_TYPE)
 
 
 @api_view(['POST'])
 def manual_screenshot(request, pk):
     try:
         task = Task.objects.get(pk=pk)
-        if task.status not in ['RUNNING', 'PENDING']:
+        if task.status == 'PENDING':
+            return Response({'error': '任务尚未开始执行（可能正在排队等待设备），暂时无法截图'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if task.status != 'RUNNING':
             return Response({'error': '任务已结束，无法截图'}, status=status.HTTP_400_BAD_REQUEST)
-        take_manual_screenshot_task.delay(task.id)
+        # 由正在执行该任务的 worker 用它已持有的设备连接截图，结果通过 WebSocket 推送
+        send_command(task.id, 'screenshot')
         return Response({'status': '截图指令已发送'})
     except Task.DoesNotExist:
         return Response({'error': '任务不存在'}, status=status.HTTP_404_NOT_FOUND)
+    except redis.RedisError as e:
+        return Response({'error': f'任务控制通道不可用: {e}'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
 
 # ↓↓↓ 这是我们修正后的 cancel_task 视图 ↓↓↓
@@ -126,16 +303,13 @@ def cancel_task(request, pk):
         if task.status not in ['PENDING', 'RUNNING']:
             return Response({'error': f'任务状态为 {task.status}，无法取消'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # 我们用这个实例来发送 revoke 指令
-        celery_app.control.revoke(task.celery_task_id, terminate=True, signal='SIGKILL')
-        # 立即更新数据库状态为CANCELED
-        task.status = 'CANCELED'
-        task.completed_at = timezone.now()
-        task.log = (task.log or '') + "\n--- [任务已被用户手动取消] ---"
-        task.save()
-        # 通过WebSocket广播最终状态
-        logger = TaskLogger(task.id)
-        logger.broadcast(task)
+        # revoke 只阻止尚未开始的任务；运行中的任务由执行器轮询取消标记后自行停止，
+        # 不能 terminate：gevent 执行池中同一进程还在执行其他任务，强杀会连带杀掉它们，也来不及释放设备
+        celery_app.control.revoke(task.celery_task_id)
+        request_cancel(task.id)
+        # 立即更新数据库状态为CANCELED，记录日志并通过WebSocket广播最终状态
+        logger = TaskLogger(task.id, buffered=False)
+        logger.log("--- [任务已被用户手动取消] ---", status='CANCELED', level='WARNING')
         return Response({'status': '取消指令已发送'})
 
     except Task.DoesNotExist:
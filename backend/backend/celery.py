@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_init, worker_ready
 
 # 为celery程序设置django settings
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
@@ -15,4 +16,21 @@ app.autodiscover_tasks()
 
 @app.task(bind=True)
 def debug_task(self):
-    print(f'Request: {self.request!r}')
\ No newline at end of file
+    print(f'Request: {self.request!r}')
+
+
+# 执行器指标导出（见 executor/metrics.py）。prefork 执行池的任务在子进程中运行，
+# 由 worker_process_init 在每个子进程中启动；gevent / solo 等执行池的任务就在主进程中运行
+@worker_process_init.connect
+def start_child_metrics_exporter(**kwargs):
+    from executor.metrics import start_worker_exporter
+    start_worker_exporter()
+
+
+@worker_ready.connect
+def start_metrics_exporter(sender=None, **kwargs):
+    pool = getattr(getattr(sender, 'controller', None), 'pool', None)
+    if pool is not None and type(pool).__module__.endswith('.prefork'):
+        return
+    from executor.metrics import start_worker_exporter
+    start_worker_exporter()
@@ -156,6 +156,151 @@ CELERY_RESULT_SERIALIZER = 'json'
 
 # 建议设置时区，与Django的TIME_ZONE保持一致
 CELERY_TIMEZONE = 'Asia/Shanghai'
+# 定期任务，需要另外启动 celery beat
+CELERY_BEAT_SCHEDULE = {
+    'prune-screenshots': {
+        'task': 'executor.tasks.prune_screenshots_task',
+        'schedule': 60 * 60,
+    },
+    'archive-task-logs': {
+        'task': 'executor.tasks.archive_task_logs_task',
+        'schedule': 6 * 60 * 60,
+    },
+    'purge-tasks': {
+        'task': 'executor.tasks.purge_tasks_task',
+        'schedule': 24 * 60 * 60,
+    },
+}
+
+# --- 任务日志 ---
+# 写后缓冲：日志先进入内存队列，由后台线程按时间或条数批量写库并广播；状态变更和截图仍立即刷新
+TASK_LOG_BUFFERED = True
+# 最长刷新间隔（秒）
+TASK_LOG_FLUSH_INTERVAL = 0.2
+# 队列中积攒到该条数时立即触发一次刷新
+TASK_LOG_FLUSH_BATCH_SIZE = 50
+# 增量日志接口单次最多返回的条数
+LOG_TAIL_MAX_ENTRIES = 1000
+# 日志 SSE 流的保活间隔（秒）和单个连接的最长时长（秒）
+LOG_STREAM_KEEPALIVE = 15
+LOG_STREAM_MAX_SECONDS = 60 * 60
+# 已结束超过该天数的任务，其日志被压缩归档并从 TaskLogEntry 表中删除（见 executor/log_archive.py）
+LOG_ARCHIVE_AFTER_DAYS = 7
+# 归档存储：'local' 保存在 LOG_ARCHIVE_ROOT 目录下（不要放在 MEDIA_ROOT 中，否则可被直接下载）
+LOG_ARCHIVE_BACKEND = 'local'
+LOG_ARCHIVE_ROOT = os.path.join(BASE_DIR, 'log_archives')
+# gzip 压缩级别（1-9），以及每批查询的任务数
+LOG_ARCHIVE_COMPRESS_LEVEL = 6
+LOG_ARCHIVE_BATCH_SIZE = 200
+# 已结束超过该天数的任务连同日志、日志归档和 media_files/task_logs/<任务ID> 一起删除；None 表示不自动删除
+TASK_RETENTION_DAYS = None
+# 删除时每批处理的任务数、每条 DELETE 删除的日志行数，以及批次之间的暂停时间（秒）
+TASK_PURGE_BATCH_SIZE = 200
+TASK_PURGE_LOG_CHUNK_SIZE = 5000
+TASK_PURGE_PAUSE = 0.5
+# 一次批量运行最多创建的任务数（脚本数 × 设备数）
+BATCH_MAX_TASKS = 500
+
+# --- 任务控制信号 ---
+# 存放取消标记等控制信号的 Redis
+TASK_CONTROL_REDIS_URL = CELERY_BROKER_URL
+# 执行器检查取消标记和控制指令的间隔（秒），即取消生效的最大延迟
+TASK_CANCEL_POLL_INTERVAL = 0.5
+# 手动截图时，若轮询截到的最近一帧不超过该时间（秒），直接复用而不重新截图
+MANUAL_SCREENSHOT_MAX_AGE = 1.0
+
+# --- 模板图片缓存（每个 worker 进程一份） ---
+# 解码后模板图片占用内存的上限（字节）
+TEMPLATE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# 缓存命中后多少秒内不再检查文件是否被修改
+TEMPLATE_CACHE_REVALIDATE_INTERVAL = 30
+
+# --- validate / 条件判断的截图轮询 ---
+# 画面变化时的轮询间隔（秒）
+POLL_MIN_INTERVAL = 0.2
+# 画面静止时逐步退避到的最长轮询间隔（秒）
+POLL_MAX_INTERVAL = 1.0
+# 画面静止时每轮间隔的放大倍数
+POLL_BACKOFF = 1.5
+# 64x64 灰度缩略图中任意一格的灰度差超过该值即视为画面发生了变化（按格判断，小按钮、弹窗也能察觉）
+POLL_CHANGE_THRESHOLD = 12
+
+# --- 模板匹配引擎（见 executor/matchers.py） ---
+# 'airtest'：Airtest 默认匹配流程；'pyramid'：每帧共用灰度金字塔，先粗定位再在精细层确认
+TEMPLATE_MATCHER = 'airtest'
+# pyramid：粗糙层上模板短边的最小像素数，以及最多下采样的层数
+MATCHER_PYRAMID_MIN_TEMPLATE_SIZE = 24
+MATCHER_PYRAMID_MAX_LEVEL = 3
+# pyramid：粗糙层上保留、再到精细层确认的候选位置数
+MATCHER_PYRAMID_CANDIDATES = 3
+# 'inline'：在执行任务的线程/协程中匹配；'process'：交给匹配进程池（见 executor/match_pool.py），
+# 适用于 gevent 执行池，匹配不再占用 worker 进程的 GIL，同一 worker 的并发任务可以用上多个 CPU 核心
+MATCH_EXECUTION = 'inline'
+# 每个 worker 进程最多启动的匹配进程数，None 表示 CPU 核心数
+MATCH_POOL_SIZE = None
+# 单次匹配的最长等待时间（秒），超时的匹配进程会被终止并重新启动
+MATCH_POOL_TIMEOUT = 30
+
+# --- 执行器指标（见 executor/metrics.py，Django 端导出地址为 /api/metrics/） ---
+# 每个 worker 进程的 Prometheus 导出端口，None 表示不开启（只通过 Redis 汇总到 Django）
+METRICS_WORKER_PORT = 9808
+METRICS_WORKER_HOST = ''
+# worker 把指标快照推送到 Redis 的间隔（秒），0 表示不推送；超过 3 个间隔未更新的 worker 视为已退出，其累计值仍保留在汇总中
+METRICS_PUSH_INTERVAL = 15
+# 允许不带令牌访问 /api/metrics/ 和 worker 导出端口的来源地址（经反向代理时为代理的地址）
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')
+# 其他地址需在 Authorization 头中携带 Bearer <METRICS_TOKEN>（Prometheus 的 authorization 配置），None 表示不允许
+METRICS_TOKEN = None
+
+# --- 设备调度 ---
+# 'redis'：跨 worker 进程的设备租约；'local'：只在单个 worker 进程内互斥（开发/单进程部署）
+DEVICE_LEASE_BACKEND = 'redis'
+# 设备租约的有效期（秒），持有者会在后台定期续期；worker 崩溃后租约最多在该时间后自动释放
+DEVICE_LEASE_TTL = 60
+# 排队等待设备时检查租约的间隔（秒）
+DEVICE_LEASE_POLL_INTERVAL = 1.0
+
+# --- 设备连接池（每个 worker 进程一份） ---
+# 连接空闲超过该时间（秒）后自动断开
+DEVICE_POOL_IDLE_TIMEOUT = 600
+# 复用前若距上次检查已超过该时间（秒），先检查连接是否仍然可用
+DEVICE_POOL_HEALTHCHECK_INTERVAL = 30
+# 是否注册 SyntheticDevice:/// 和 ReplayDevice:/// 测试设备（见 executor/devices.py）；生产环境必须关闭，基准测试会自行注册
+ENABLE_TEST_DEVICES = False
+
+# --- 设备注册表 ---
+# adb server 地址，注册表通过 track-devices 长连接跟踪设备变化
+ADB_SERVER_HOST = '127.0.0.1'
+ADB_SERVER_PORT = 5037
+# adb server 不可用时退回轮询 `adb devices -l` 的间隔（秒）
+DEVICE_REGISTRY_POLL_INTERVAL = 2
+
+# --- 实时画面推流 ---
+# 关闭后任务执行期间不再启动推流线程（例如离线基准测试）
+STREAM_ENABLED = True
+# 推流的最高帧率，客户端可以通过 ?fps= 要求更低的帧率
+STREAM_FPS = 5
+# 推流画面缩放后的最大宽度（像素）
+STREAM_MAX_WIDTH = 480
+# 推流画面的编码格式：'jpeg' 或 'webp'，以及编码质量（1-100）
+STREAM_FORMAT = 'jpeg'
+STREAM_QUALITY = 70
+# 每个客户端最多允许多少帧尚未确认，超出后只保留最新一帧，中间的帧丢弃
+STREAM_MAX_IN_FLIGHT = 2
+# 观看者登记的有效期（秒），连接期间自动续期
+STREAM_VIEWER_TTL = 15
+
+# --- 截图存储（MEDIA_ROOT/screenshots，按画面内容去重） ---
+# 截图编码格式：'jpeg' / 'webp' / 'png'，以及 jpeg / webp 的编码质量（1-100）
+SCREENSHOT_FORMAT = 'jpeg'
+SCREENSHOT_QUALITY = 80
+# 缩略图宽度（像素）和编码质量
+SCREENSHOT_THUMBNAIL_WIDTH = 320
+SCREENSHOT_THUMBNAIL_QUALITY = 70
+# 保留策略：最后使用超过该天数的截图会被删除
+SCREENSHOT_RETENTION_DAYS = 30
+# 保留策略：总大小超过该值（字节）时，从最久未使用的截图开始删除
+SCREENSHOT_STORE_MAX_BYTES = 5 * 1024 * 1024 * 1024
 
 MEDIA_URL = '/media/'
 # 我们将所有任务日志和截图都存放在项目根目录下的 'media_files' 文件夹中
@@ -0,0 +1,305 @@
+"""
+执行器基准测试：在回放设备（executor/replay_device.py）上运行 benchmarks/scripts 中的代表性
+v2.1 脚本，测量 execute_script_flow 的吞吐和开销，并与保存的基线比较。
+
+不需要真机、Redis 或数据库服务：脚本默认运行在 Django 创建的 SQLite 内存测试库中，频道层换成
+内存实现，实时画面推流关闭，截图写入临时目录，Airtest 的操作后等待（ST.OPDELAY）默认置为 0。
+加 --use-configured-db 时改为在 settings.DATABASES 配置的数据库（MySQL）中创建临时测试库
+（test_<库名>，需要建库权限），用于测量真实数据库上的写日志开销；两种数据库的结果不能互相比较。
+
+报告的指标（每个脚本）：
+- steps_per_sec：每秒执行的节点数（含循环、条件等控制节点）；
+- match_p50_ms / match_p95_ms：单次匹配（一帧对一组模板）的耗时分位数；
+- log_ms_per_step：每个节点在 TaskLogger.log 上花费的时间（调用方一侧）；
+- db_queries_per_step / db_ms_per_step：每个节点产生的数据库查询数和耗时（含后台写日志线程）；
+- peak_traced_mb：单独再运行一遍时 tracemalloc 记录的 Python 内存峰值。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_executor                     # 与 benchmarks/baseline.json 比较，退步时返回 1
+    python -m benchmarks.bench_executor --update-baseline   # 用本次结果覆盖基线
+    python -m benchmarks.bench_executor --execution process # 匹配交给匹配进程池（MATCH_EXECUTION）
+    python -m benchmarks.bench_executor --use-configured-db # 使用配置的数据库，而不是 SQLite
+基线与机器相关，CI 中应在同一类机器上生成基线。
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+# 必须在 django.setup() 之前替换，之后创建的数据库连接才会使用它
+USE_CONFIGURED_DB = '--use-configured-db' in sys.argv
+if not USE_CONFIGURED_DB:
+    settings.DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}}
+
+django.setup()
+
+from airtest.core.settings import Settings as ST  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.db.backends.signals import connection_created  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+from executor import airtest_runner, match_pool, matchers  # noqa: E402
+from executor.compiler import compile_script  # noqa: E402
+from executor.devices import device_pool, register_test_devices  # noqa: E402
+from executor.task_logger import TaskLogger  # noqa: E402
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_REPLAY = os.path.join(BENCH_DIR, 'replays', 'settings_flow')
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+# 参与基线比较的指标，True 表示越大越好
+COMPARED_METRICS = {
+    'steps_per_sec': True,
+    'match_p95_ms': False,
+    'log_ms_per_step': False,
+    'db_queries_per_step': False,
+    'peak_traced_mb': False,
+}
+
+
+class Probe:
+    """通过包装执行器的扩展点收集耗时，所有计数都是线程安全的"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.nodes = Counter()
+        self.match_ms = []
+        self.log_ms = 0.0
+        self.db_queries = 0
+        self.db_ms = 0.0
+
+    def add(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def install(self):
+        probe = self
+
+        for node_type, executor in list(airtest_runner.NODE_EXECUTORS.items()):
+            def counted(ctx, node, executor=executor, node_type=node_type):
+                probe.nodes[node_type] += 1
+                return executor(ctx, node)
+            airtest_runner.NODE_EXECUTORS[node_type] = counted
+
+        # 进程池模式下 PooledMatcher 的耗时包含传递画面和等待匹配进程的开销
+        for matcher_class in (matchers.Matcher, match_pool.PooledMatcher):
+            def timed_match(self, frame, templates, best=False, original_match=matcher_class.match):
+                started = time.perf_counter()
+                try:
+                    return original_match(self, frame, templates, best)
+                finally:
+                    probe.match_ms.append((time.perf_counter() - started) * 1000)
+            matcher_class.match = timed_match
+
+        original_log = TaskLogger.log
+
+        def timed_log(self, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original_log(self, *args, **kwargs)
+            finally:
+                probe.add(log_ms=(time.perf_counter() - started) * 1000)
+        TaskLogger.log = timed_log
+
+        def db_wrapper(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                probe.add(db_queries=1, db_ms=(time.perf_counter() - started) * 1000)
+
+        # 后台写日志的线程有自己的数据库连接，连接建立时同样挂上计时
+        connection_created.connect(lambda sender, connection, **kwargs: connection.execute_wrappers.append(db_wrapper),
+                                   weak=False)
+        connection.ensure_connection()
+        connection.execute_wrappers.append(db_wrapper)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(int(len(ordered) * fraction), len(ordered) - 1)], 2)
+
+
+def run_script(plan, device_uri, task_id):
+    # 每次运行都从回放的第一帧开始
+    device_pool.discard(device_uri)
+    logger = TaskLogger(task_id)
+    try:
+        airtest_runner.execute_script_flow(plan, device_uri, logger)
+    finally:
+        logger.close()
+
+
+def bench_script(probe, name, content, device_uri, repeat):
+    from api.models import Script, Task
+
+    script = Script.objects.create(name=f"bench-{name}", content=content)
+    plan = compile_script(content)
+    task_ids = [Task.objects.create(script=script, device_uri=device_uri).id for _ in range(repeat + 2)]
+
+    # 预热：模板解码、设备连接等一次性开销不计入结果
+    run_script(plan, device_uri, task_ids[0])
+
+    probe.reset()
+    started = time.perf_counter()
+    for task_id in task_ids[1:-1]:
+        run_script(plan, device_uri, task_id)
+    elapsed = time.perf_counter() - started
+    steps = sum(probe.nodes.values())
+    result = {
+        'runs': repeat,
+        'steps': steps,
+        'nodes': dict(probe.nodes),
+        'seconds': round(elapsed, 3),
+        'steps_per_sec': round(steps / elapsed, 2),
+        'match_count': len(probe.match_ms),
+        'match_p50_ms': percentile(probe.match_ms, 0.5),
+        'match_p95_ms': percentile(probe.match_ms, 0.95),
+        'log_ms_per_step': round(probe.log_ms / steps, 3),
+        'db_queries_per_step': round(probe.db_queries / steps, 3),
+        'db_ms_per_step': round(probe.db_ms / steps, 3),
+    }
+
+    # tracemalloc 会拖慢执行，内存峰值单独再运行一次测量
+    tracemalloc.start()
+    run_script(plan, device_uri, task_ids[-1])
+    result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+    tracemalloc.stop()
+    return result
+
+
+def max_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Windows 上没有 resource 模块
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def compare(report, baseline, tolerance):
+    """返回退步项 [(脚本, 指标, 基线值, 本次值)]，变差超过 tolerance（比例）才算退步"""
+    regressions = []
+    for name, result in report['scripts'].items():
+        base = baseline.get('scripts', {}).get(name)
+        if base is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            if change > tolerance:
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def print_report(report, baseline):
+    print(f"匹配器: {report['matcher']}（{report.get('execution', 'inline')}），数据库: {report['database']}，"
+          f"回放: {report['replay']}，最大 RSS: {report['max_rss_mb']} MB")
+    for name, result in report['scripts'].items():
+        base = baseline.get('scripts', {}).get(name, {}) if baseline else {}
+        print(f"\n[{name}] {result['runs']} 次运行，{result['steps']} 个节点，{result['seconds']} 秒")
+        for metric in ('steps_per_sec', 'match_p50_ms', 'match_p95_ms', 'log_ms_per_step',
+                       'db_queries_per_step', 'db_ms_per_step', 'peak_traced_mb'):
+            old = base.get(metric)
+            suffix = f"  (基线 {old})" if old is not None else ''
+            print(f"  {metric:<22}{result[metric]}{suffix}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="执行器基准测试")
+    parser.add_argument('--scripts', nargs='+', help="要运行的脚本文件，默认为 benchmarks/scripts/*.json")
+    parser.add_argument('--replay', default=DEFAULT_REPLAY, help="回放画面所在目录，必须位于 benchmarks/replays 之内")
+    parser.add_argument('--repeat', type=int, default=3, help="每个脚本计时运行的次数")
+    parser.add_argument('--matcher', default=getattr(settings, 'TEMPLATE_MATCHER', 'airtest'),
+                        choices=list(matchers.MATCHERS))
+    parser.add_argument('--execution', default=getattr(settings, 'MATCH_EXECUTION', 'inline'),
+                        choices=['inline', 'process'], help="匹配在当前进程中进行还是交给匹配进程池")
+    parser.add_argument('--opdelay', type=float, default=0, help="操作后的等待时间（ST.OPDELAY）")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.3, help="允许的退步比例")
+    parser.add_argument('--update-baseline', action='store_true', help="用本次结果覆盖基线文件")
+    parser.add_argument('--json', help="把结果另存为 JSON 文件")
+    parser.add_argument('--use-configured-db', action='store_true',
+                        help="在 settings.DATABASES 配置的数据库中创建测试库，默认使用 SQLite 内存库")
+    args = parser.parse_args()
+
+    script_paths = args.scripts or sorted(glob.glob(os.path.join(BENCH_DIR, 'scripts', '*.json')))
+    # Airtest 解析 URI 时会去掉路径开头的 /，回放目录以相对 BASE_DIR 的路径传入
+    device_uri = f"ReplayDevice:///{os.path.relpath(args.replay, settings.BASE_DIR)}?loop=1"
+    ST.OPDELAY = args.opdelay
+    register_test_devices()
+
+    report = {'matcher': args.matcher, 'execution': args.execution, 'database': connection.vendor,
+              'replay': os.path.relpath(args.replay, BENCH_DIR), 'scripts': {}}
+
+    # 先建测试库再打开连接：SQLite 内存库的连接不会被关闭，提前打开的连接会停留在私有的 :memory: 上，
+    # 写日志线程连接的共享内存库中则没有表
+    old_db_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    probe = Probe()
+    probe.install()
+    try:
+        with tempfile.TemporaryDirectory() as media_root, override_settings(
+                CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+                STREAM_ENABLED=False, MEDIA_ROOT=media_root, TEMPLATE_MATCHER=args.matcher,
+                MATCH_EXECUTION=args.execution):
+            for path in script_paths:
+                name = os.path.splitext(os.path.basename(path))[0]
+                with open(path, encoding='utf-8') as f:
+                    content = json.load(f)
+                report['scripts'][name] = bench_script(probe, name, content, device_uri, args.repeat)
+    finally:
+        device_pool.discard(device_uri)
+        connection.creation.destroy_test_db(old_db_name, verbosity=0)
+    report['max_rss_mb'] = max_rss_mb()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已更新: {args.baseline}")
+        return 0
+    if baseline is None:
+        print("\n没有基线文件，跳过比较（使用 --update-baseline 生成）")
+        return 0
+    if baseline.get('database', 'sqlite') != report['database']:
+        print(f"\n基线在 {baseline.get('database', 'sqlite')} 上生成，与本次的数据库不同，跳过比较")
+        return 0
+
+    regressions = compare(report, baseline, args.tolerance)
+    if not regressions:
+        print(f"\n与基线相比没有超过 {args.tolerance:.0%} 的退步")
+        return 0
+    print(f"\n发现 {len(regressions)} 项退步：")
+    for name, metric, old, new in regressions:
+        print(f"  {name}.{metric}: {old} -> {new}")
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+模板匹配引擎基准测试：比较 executor/matchers.py 中各匹配器的耗时和准确率。
+
+画面取自录制的任务截图（默认为 media_files 下的 jpg / png），模板取自 script_assets：
+- 正样本：把模板随机贴到录制画面上，真实位置已知，命中且中心误差不超过 --tolerance 像素才算正确；
+- 原始画面：不做修改直接匹配，以 airtest 匹配器的结果为参照，统计与之一致的比例；
+- 批量：一帧画面与全部模板匹配一次（best 模式），即 switch 节点的场景。
+
+在 backend 目录下运行：
+    python -m benchmarks.bench_matchers
+    python -m benchmarks.bench_matchers --frames media_files/task_logs --samples 5 --json result.json
+"""
+import argparse
+import glob
+import json
+import os
+import random
+import statistics
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from airtest import aircv  # noqa: E402
+from django.conf import settings  # noqa: E402
+from executor.matchers import MATCHERS, create_matcher  # noqa: E402
+from executor.template_cache import CachedTemplate  # noqa: E402
+
+IMAGE_PATTERNS = ('*.jpg', '*.jpeg', '*.png')
+
+
+def find_images(directories, limit=None):
+    paths = []
+    for directory in directories:
+        for pattern in IMAGE_PATTERNS:
+            paths.extend(glob.glob(os.path.join(directory, '**', pattern), recursive=True))
+    # 截图存储中的缩略图不是真实画面
+    paths = sorted(path for path in set(paths) if f"{os.sep}thumbs{os.sep}" not in path)
+    return paths[:limit] if limit else paths
+
+
+def make_positive(frame, template_image, rng):
+    """把模板贴到画面的随机位置，返回 (新画面, 模板中心坐标)；画面放不下时返回 None"""
+    frame_h, frame_w = frame.shape[:2]
+    tmpl_h, tmpl_w = template_image.shape[:2]
+    if tmpl_h > frame_h or tmpl_w > frame_w:
+        return None
+    x = rng.randint(0, frame_w - tmpl_w)
+    y = rng.randint(0, frame_h - tmpl_h)
+    sample = frame.copy()
+    sample[y:y + tmpl_h, x:x + tmpl_w] = template_image
+    return sample, (x + tmpl_w / 2, y + tmpl_h / 2)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def close_enough(pos, expected, tolerance):
+    return pos is not None and expected is not None and \
+        abs(pos[0] - expected[0]) <= tolerance and abs(pos[1] - expected[1]) <= tolerance
+
+
+def summarize(latencies):
+    if not latencies:
+        return {'count': 0}
+    ordered = sorted(latencies)
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.mean(ordered), 2),
+        'p50_ms': round(ordered[len(ordered) // 2], 2),
+        'p95_ms': round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 2),
+    }
+
+
+def run(frames, template_paths, matcher_names, samples, tolerance, seed):
+    rng = random.Random(seed)
+    templates = [CachedTemplate(os.path.abspath(path)) for path in template_paths]
+    template_images = [aircv.imread(path) for path in template_paths]
+    matchers = {name: create_matcher(name) for name in matcher_names}
+    results = {name: {'positive': [], 'raw': [], 'batch': [], 'correct': 0, 'raw_positions': {}}
+               for name in matcher_names}
+
+    positives = []
+    for frame in frames:
+        for template, image in zip(templates, template_images):
+            for _ in range(samples):
+                sample = make_positive(frame, image, rng)
+                if sample is not None:
+                    positives.append((sample[0], template, sample[1]))
+
+    for name, matcher in matchers.items():
+        stats = results[name]
+        # 预热：模板解码和缩放只在第一次匹配时发生，不计入耗时
+        matcher.match(frames[0], templates)
+        for sample, template, expected in positives:
+            (_, pos), elapsed = timed(matcher.match, sample, [template])
+            stats['positive'].append(elapsed)
+            stats['correct'] += close_enough(pos, expected, tolerance)
+        for frame_index, frame in enumerate(frames):
+            _, elapsed = timed(matcher.match, frame, templates, True)
+            stats['batch'].append(elapsed)
+            for template_index, template in enumerate(templates):
+                (_, pos), elapsed = timed(matcher.match, frame, [template])
+                stats['raw'].append(elapsed)
+                stats['raw_positions'][frame_index, template_index] = pos
+
+    # 原始画面上没有真实位置，以 airtest 匹配器的结果为参照
+    reference = results['airtest']['raw_positions'] if 'airtest' in results else None
+    report = {'frames': len(frames), 'templates': len(templates), 'positives': len(positives), 'matchers': {}}
+    for name in matcher_names:
+        stats = results[name]
+        agreement = None
+        if reference:
+            agree = sum((pos is None and reference[key] is None) or close_enough(pos, reference[key], tolerance)
+                        for key, pos in stats['raw_positions'].items())
+            agreement = round(agree / len(reference), 4)
+        report['matchers'][name] = {
+            'positive': summarize(stats['positive']),
+            'accuracy': round(stats['correct'] / len(positives), 4) if positives else None,
+            'raw': summarize(stats['raw']),
+            'agreement_with_airtest': agreement,
+            'batch_per_frame': summarize(stats['batch']),
+        }
+    return report
+
+
+def print_report(report):
+    print(f"画面 {report['frames']} 张，模板 {report['templates']} 个，正样本 {report['positives']} 个")
+    header = f"{'匹配器':<10}{'正样本均值':>12}{'p95':>10}{'准确率':>10}{'原图均值':>12}{'与airtest一致':>16}{'批量/帧':>12}"
+    print(header)
+    for name, stats in report['matchers'].items():
+        def fmt(value, suffix=''):
+            return '-' if value is None else f"{value}{suffix}"
+        print(f"{name:<10}{fmt(stats['positive'].get('mean_ms'), 'ms'):>12}{fmt(stats['positive'].get('p95_ms'), 'ms'):>10}"
+              f"{fmt(stats['accuracy']):>10}{fmt(stats['raw'].get('mean_ms'), 'ms'):>12}"
+              f"{fmt(stats['agreement_with_airtest']):>16}{fmt(stats['batch_per_frame'].get('mean_ms'), 'ms'):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模板匹配引擎基准测试")
+    parser.add_argument('--frames', nargs='+', default=[settings.MEDIA_ROOT], help="录制画面所在目录")
+    parser.add_argument('--templates', default=os.path.join(settings.BASE_DIR, 'script_assets'), help="模板目录")
+    parser.add_argument('--max-frames', type=int, default=30)
+    parser.add_argument('--samples', type=int, default=3, help="每个 (画面, 模板) 生成的正样本数")
+    parser.add_argument('--tolerance', type=int, default=5, help="命中位置允许的误差（像素）")
+    parser.add_argument('--matchers', nargs='+', default=list(MATCHERS), choices=list(MATCHERS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="把结果另存为 JSON 文件")
+    args = parser.parse_args()
+
+    frame_paths = find_images(args.frames, args.max_frames)
+    template_paths = find_images([args.templates])
+    if not frame_paths or not template_paths:
+        parser.error("没有找到录制画面或模板图片")
+    frames = [aircv.imread(path) for path in frame_paths]
+
+    report = run(frames, template_paths, args.matchers, args.samples, args.tolerance, args.seed)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存到 {args.json}")
+
+
+if __name__ == '__main__':
+    main()
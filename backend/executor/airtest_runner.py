@@ -1,181 +1,297 @@
-import os
 import time
 from django.conf import settings
-from airtest.core.api import auto_setup, touch, swipe, sleep, snapshot, Template, text, exists
+from airtest.core.api import sleep
 from airtest.core.error import TargetNotFoundError
+from airtest.core.settings import Settings as ST
 from .task_logger import TaskLogger
+from .cancellation import CancellationToken
+from .template_cache import CachedTemplate, template_cache
+from .polling import FramePoller
+from .devices import device_pool
+from .streaming import FrameStreamer
+from .screenshot_store import screenshot_store
+from .metrics import NODE_SECONDS, ACTION_SECONDS, VALIDATE_WAIT_SECONDS, RETRIES
+from .compiler import ScriptPlan, ActionNode, LoopNode, ConditionNode, SwitchNode
 
+MAX_STEP_RETRIES = 3
 
-def execute_script_flow(script_content: dict, device_uri: str, logger: TaskLogger, cancellation_check_func=None):
-    # 移除了 ST.FIND_TIMEOUT 的设置
-    auto_setup(logdir=False, devices=[device_uri])
-    logger.log(f"Airtest已连接到设备: {device_uri}")
-    variables = script_content.get("variables", {})
-    steps = script_content.get("steps", [])
+
+class ExecutionContext:
+    """一次脚本执行过程中各节点共享的对象"""
+    __slots__ = ('logger', 'cancellation_check_func', 'device', 'poller', 'resolution_scale', 'labels')
+
+    def __init__(self, logger: TaskLogger, cancellation_check_func, device, poller: FramePoller,
+                 resolution_scale=None, labels=None):
+        self.logger = logger
+        self.cancellation_check_func = cancellation_check_func
+        # 本任务独占的设备对象，不经过 Airtest 的全局 G.DEVICE
+        self.device = device
+        self.poller = poller
+        # 设备分辨率相对脚本 reference_resolution 的缩放比例；脚本未声明时为 None
+        self.resolution_scale = resolution_scale
+        # 指标的公共标签 {'script', 'device'}，见 metrics.py
+        self.labels = labels or {}
+
+    def check_cancellation(self):
+        if self.cancellation_check_func:
+            self.cancellation_check_func()
+
+
+def execute_script_flow(plan: ScriptPlan, device_uri: str, logger: TaskLogger, cancellation_check_func=None,
+                        script_name=None):
+    # 不使用 auto_setup：同一 worker 中并发的任务各自持有设备对象，互不覆盖；
+    # 连接由 device_pool 在 worker 内复用，同一设备上的后续任务无需重新连接
+    with device_pool.connection(device_uri) as device:
+        logger.log(f"Airtest已连接到设备: {device_uri}")
+        cancel_token = cancellation_check_func if isinstance(cancellation_check_func, CancellationToken) else None
+        resolution_scale = None
+        if plan.reference_resolution:
+            resolution = device_pool.resolution(device_uri)
+            resolution_scale = resolution_scale_for(plan.reference_resolution, resolution)
+            logger.log(f"设备分辨率 {resolution[0]}x{resolution[1]}，模板按 {resolution_scale} 倍预缩放后单尺度匹配")
+            _prepare_templates(plan, resolution_scale)
+        labels = {'script': script_name or plan.name, 'device': device_uri}
+        poller = FramePoller(device, cancel_token, metric_labels=labels)
+        ctx = ExecutionContext(logger, cancellation_check_func, device, poller, resolution_scale, labels)
+        if cancel_token:
+            # 手动截图等控制指令在本线程中、检查取消的间隙处理，复用本任务的设备连接
+            cancel_token.command_handler = lambda command: _handle_control_command(ctx, command)
+        # 有人在看实时画面时才会截图推流
+        streamer = FrameStreamer(logger.task_id, ctx.poller) if getattr(settings, 'STREAM_ENABLED', True) else None
+        if streamer:
+            streamer.start()
+        try:
+            _execute_steps(ctx, plan.steps)
+        finally:
+            if streamer:
+                streamer.stop()
+        logger.log(f"截图与匹配统计: {ctx.poller.stats()}，实时画面推流: {streamer.stats() if streamer else '未启用'}")
+
+
+def resolution_scale_for(reference_resolution, resolution):
+    """模板从 reference_resolution 缩放到 resolution 的比例，与屏幕方向无关（按长边 / 短边分别比较）"""
+    ref_long, ref_short = max(reference_resolution), min(reference_resolution)
+    long_side, short_side = max(resolution), min(resolution)
+    return round(min(long_side / ref_long, short_side / ref_short), 4)
+
+
+def _prepare_templates(plan: ScriptPlan, resolution_scale):
+    """执行前把脚本用到的模板按设备分辨率缩放好，放入 template_cache"""
+    for template_path, match_scale in plan.templates:
+        try:
+            template_cache.get_scaled(template_path, match_scale * resolution_scale)
+        except Exception as e:
+            # 图片缺失等问题留到真正匹配时按节点的失败策略处理
+            print(f"预缩放模板 {template_path} 失败: {e}")
+
+
+def _execute_steps(ctx: ExecutionContext, steps):
     for node in steps:
-        if cancellation_check_func:
-            cancellation_check_func()
-        _process_node(node, variables, logger, cancellation_check_func)
-
-
-# _process_node 和 _resolve_value 函数无变化
-def _process_node(node: dict, variables: dict, logger: TaskLogger, cancellation_check_func=None):
-    node_type = node.get("type")
-    description = node.get("description", "无描述")
-    logger.log(f"--- [执行节点] {description} (类型: {node_type}) ---")
-    if node_type == "action":
-        _execute_action_node(node, variables, logger, cancellation_check_func)
-    elif node_type == "loop":
-        _execute_loop_node(node, variables, logger, cancellation_check_func)
-    elif node_type == "condition":
-        _execute_condition_node(node, variables, logger, cancellation_check_func)
-    else:
-        logger.log(f"警告：跳过未知的节点类型 '{node_type}'")
+        ctx.check_cancellation()
+        _process_node(ctx, node)
 
 
-def _resolve_value(value, variables):
-    if isinstance(value, str) and value.startswith("{{") and value.endswith("}}"):
-        var_name = value[2:-2].strip()
-        return variables.get(var_name, value)
-    return value
+def _process_node(ctx: ExecutionContext, node):
+    with ctx.logger.node_scope(node.path):
+        ctx.logger.log(f"--- [执行节点] {node.description} (类型: {node.node_type}) ---")
+        with NODE_SECONDS.time(node_type=node.node_type, action=getattr(node, 'action', ''), result='error',
+                               **ctx.labels) as labels:
+            NODE_EXECUTORS[node.node_type](ctx, node)
+            labels['result'] = 'ok'
 
 
-def _execute_action_node(node: dict, variables: dict, logger: TaskLogger, cancellation_check_func=None):
-    max_step_retries = 3
-    step_retry_count = 0
-    while step_retry_count <= max_step_retries:
-        if step_retry_count > 0:
-            logger.log(f"--- [步骤重试 {step_retry_count}/{max_step_retries}] ---")
+def _asset_template(ctx: ExecutionContext, template_path, match_options=None):
+    """script_assets 中的模板图片，解码及缩放结果由 template_cache 在进程内复用"""
+    return CachedTemplate(template_path, match_options, ctx.resolution_scale)
+
+
+def _interruptible_sleep(duration, cancellation_check_func=None):
+    """等待 duration 秒；若传入的是取消令牌，取消信号会立即打断等待"""
+    if isinstance(cancellation_check_func, CancellationToken):
+        cancellation_check_func.sleep(duration)
+        return
+    for _ in range(int(duration)):
+        if cancellation_check_func: cancellation_check_func()
+        sleep(1)
+    remaining_sleep = duration - int(duration)
+    if remaining_sleep > 0: sleep(remaining_sleep)
+
+
+def _action_sleep(ctx: ExecutionContext, node: ActionNode):
+    _interruptible_sleep(node.params['duration'], ctx.cancellation_check_func)
+
+
+def _action_touch(ctx: ExecutionContext, node: ActionNode):
+    # 与 airtest.core.api.touch 相同：在 ST.FIND_TIMEOUT 内查找目标，点击后等待 ST.OPDELAY
+    template = _asset_template(ctx, node.template_path, node.match_options)
+    match_pos = ctx.poller.wait_for(template, ST.FIND_TIMEOUT)
+    if not match_pos:
+        raise TargetNotFoundError(f"Picture {template} not found in screen")
+    ctx.device.touch(match_pos)
+    sleep(ST.OPDELAY)
+
+
+def _action_swipe(ctx: ExecutionContext, node: ActionNode):
+    ctx.device.swipe(node.params['start'], node.params['end'])
+    sleep(ST.OPDELAY)
+
 
-        action = node.get("action")
-        params = node.get("params", {})
-        on_action_failure = node.get("on_failure", "abort")
-        resolved_params = {k: _resolve_value(v, variables) for k, v in params.items()}
-        logger.log(f"执行动作: {action}，参数: {resolved_params}")
+def _action_text(ctx: ExecutionContext, node: ActionNode):
+    ctx.device.text(node.params['content'])
+    sleep(ST.OPDELAY)
 
+
+def _action_snapshot(ctx: ExecutionContext, node: ActionNode):
+    # 截图存入按内容寻址的截图存储，filename 仅作为日志中的标签
+    frame = ctx.poller.capture()
+    if frame is None:
+        raise ValueError("未能从设备获取画面")
+    snapshot_path = screenshot_store.save(frame)
+    ctx.logger.update_screenshot(snapshot_path)
+    ctx.logger.log(f"截图已保存: {node.params.get('filename') or snapshot_path}")
+
+
+ACTION_HANDLERS = {
+    'sleep': _action_sleep,
+    'touch': _action_touch,
+    'swipe': _action_swipe,
+    'text': _action_text,
+    'snapshot': _action_snapshot,
+}
+
+
+def _perform_action(ctx: ExecutionContext, node: ActionNode):
+    handler = ACTION_HANDLERS[node.action]
+    if node.on_failure != 'retry':
+        handler(ctx, node)
+        return
+
+    for i in range(node.retry_count + 1):
         try:
-            def perform_action():
-                if action == "sleep":
-                    duration = resolved_params.get("duration", 1)
-                    # ★ 统一使用 airtest.sleep
-                    for _ in range(int(duration)):
-                        if cancellation_check_func: cancellation_check_func()
-                        sleep(1)
-                    remaining_sleep = duration - int(duration)
-                    if remaining_sleep > 0: sleep(remaining_sleep)
-                elif action == "touch":
-                    # ★ 回溯: 恢复到直接调用 touch，让 Airtest 自行处理查找
-                    target_path = os.path.join(settings.BASE_DIR, 'script_assets', resolved_params['target'])
-                    touch(Template(target_path))
-                elif action == "swipe":
-                    start_pos = tuple(resolved_params['start'])
-                    end_pos = tuple(resolved_params['end'])
-                    swipe(start_pos, end_pos)
-                elif action == "text":
-                    text_to_input = resolved_params.get("content", "")
-                    text(text_to_input)
-                elif action == "snapshot":
-                    filename = resolved_params.get("filename", f"snapshot_{int(time.time())}.png")
-                    snapshot_path = os.path.join('task_logs', str(logger.task_id), filename)
-                    snapshot(filename=os.path.join(settings.MEDIA_ROOT, snapshot_path))
-                    logger.update_screenshot(snapshot_path)
-                else:
-                    raise ValueError(f"未知的原子动作: {action}")
-
-            if isinstance(on_action_failure, dict) and "retry" in on_action_failure:
-                # ... (重试逻辑保持不变)
-                retry_config = on_action_failure["retry"]
-                for i in range(retry_config.get("count", 1) + 1):
-                    try:
-                        perform_action()
-                        break
-                    except TargetNotFoundError as e:
-                        if i < retry_config.get("count", 1):
-                            logger.log(f"动作失败 (尝试 {i + 1}/{retry_config['count']}): {e}")
-                            sleep(retry_config.get("delay", 1))
-                        else:
-                            raise e
+            handler(ctx, node)
+            return
+        except TargetNotFoundError as e:
+            if i < node.retry_count:
+                RETRIES.inc(action=node.action, kind='action', **ctx.labels)
+                ctx.logger.log(f"动作失败 (尝试 {i + 1}/{node.retry_count}): {e}", level='WARNING')
+                _interruptible_sleep(node.retry_delay, ctx.cancellation_check_func)
             else:
-                perform_action()
+                raise e
+
+
+def _execute_action_node(ctx: ExecutionContext, node: ActionNode):
+    logger = ctx.logger
+    step_retry_count = 0
+    while step_retry_count <= MAX_STEP_RETRIES:
+        if step_retry_count > 0:
+            logger.log(f"--- [步骤重试 {step_retry_count}/{MAX_STEP_RETRIES}] ---")
+
+        logger.log(f"执行动作: {node.action}，参数: {node.params}")
+        try:
+            with ACTION_SECONDS.time(action=node.action, result='error', **ctx.labels) as labels:
+                _perform_action(ctx, node)
+                labels['result'] = 'ok'
         except Exception as e:
-            # ... (异常处理逻辑不变)
             if isinstance(e, InterruptedError): raise e
-            logger.log(f"动作执行失败，策略: '{on_action_failure}'。错误: {e}")
-            if on_action_failure == "ignore":
+            logger.log(f"动作执行失败，策略: '{node.on_failure}'。错误: {e}", level='ERROR')
+            if node.on_failure == "ignore":
                 logger.log(f"动作失败，已忽略。")
                 return
             else:
                 raise e
 
-        validation_node = node.get("validate")
-        if not validation_node:
+        validation = node.validate
+        if validation is None:
             logger.log("步骤无验证环节，执行成功。")
             return
 
-        # ... (validate 验证逻辑不变，但内部使用的是正确的 exists 函数)
+        # validate 通过 FramePoller 轮询，画面不变时跳过重复匹配
         logger.log(f"开始执行验证...")
-        v_type = validation_node.get("type")
-        v_target = validation_node.get("target")
-        v_timeout = validation_node.get("timeout", 5)
-        v_on_failure = validation_node.get("on_failure", "abort")
-        is_valid = False
-        start_time = time.time()
-        while time.time() - start_time < v_timeout:
-            if cancellation_check_func: cancellation_check_func()
-            if v_type == "image_exists":
-                target_path = os.path.join(settings.BASE_DIR, 'script_assets', v_target)
-                if exists(Template(target_path)):
-                    is_valid = True
-                    logger.log(f"验证成功：图片 '{v_target}' 已在屏幕上找到。")
-                    break
-            sleep(1)
-
-        if is_valid:
+        template = _asset_template(ctx, validation.template_path, validation.match_options)
+        with VALIDATE_WAIT_SECONDS.time(result='failure', **ctx.labels) as labels:
+            matched = ctx.poller.wait_for(template, validation.timeout)
+            if matched:
+                labels['result'] = 'success'
+        if matched:
+            logger.log(f"验证成功：图片 '{validation.target}' 已在屏幕上找到。")
             return
 
-        logger.log(f"验证失败：在 {v_timeout} 秒内未能满足条件。")
-        if v_on_failure == "retry_step":
+        logger.log(f"验证失败：在 {validation.timeout} 秒内未能满足条件。", level='WARNING')
+        if validation.on_failure == "retry_step":
             step_retry_count += 1
-            if step_retry_count < max_step_retries:
+            if step_retry_count < MAX_STEP_RETRIES:
+                RETRIES.inc(action=node.action, kind='step', **ctx.labels)
                 logger.log("策略为 'retry_step'，准备重试整个步骤。")
                 continue
             else:
-                logger.log(f"已达到最大步骤重试次数 ({max_step_retries})，任务中止。")
+                logger.log(f"已达到最大步骤重试次数 ({MAX_STEP_RETRIES})，任务中止。")
                 raise ValueError("验证失败且已达到最大重试次数。")
-        elif v_on_failure == "ignore":
+        elif validation.on_failure == "ignore":
             logger.log("策略为 'ignore'，已忽略验证失败。")
             return
         else:
             raise ValueError("验证失败，任务中止。")
 
 
-def _execute_loop_node(node: dict, variables: dict, logger: TaskLogger, cancellation_check_func=None):
-    # ... (此函数无变化) ...
-    if node.get("loop_type") == "count":
-        count = node.get("count", 0)
-        for i in range(count):
-            if cancellation_check_func: cancellation_check_func()
-            logger.log(f"--- [循环 {i + 1}/{count}] ---")
-            for sub_node in node.get("steps", []):
-                _process_node(sub_node, variables, logger, cancellation_check_func)
-
-
-def _execute_condition_node(node: dict, variables: dict, logger: TaskLogger, cancellation_check_func=None):
-    # ... (此函数无变化, 内部使用正确的 exists 函数) ...
-    condition_met = False
-    if node.get("condition_type") == "if_image_exists":
-        params = node.get("params", {})
-        target_path = os.path.join(settings.BASE_DIR, 'script_assets', params['target'])
-        if exists(Template(target_path)):
-            condition_met = True
-
-    if condition_met:
-        logger.log("条件为真 (True)，执行 if_true 分支")
-        for sub_node in node.get("if_true", []):
-            if cancellation_check_func: cancellation_check_func()
-            _process_node(sub_node, variables, logger, cancellation_check_func)
+def _execute_loop_node(ctx: ExecutionContext, node: LoopNode):
+    for i in range(node.count):
+        ctx.check_cancellation()
+        ctx.logger.log(f"--- [循环 {i + 1}/{node.count}] ---")
+        for sub_node in node.steps:
+            _process_node(ctx, sub_node)
+
+
+def _execute_condition_node(ctx: ExecutionContext, node: ConditionNode):
+    # 条件判断同样通过 FramePoller 轮询，默认等待时间与 Airtest 的 exists 一致
+    if ctx.poller.wait_for(_asset_template(ctx, node.template_path, node.match_options), node.timeout):
+        ctx.logger.log("条件为真 (True)，执行 if_true 分支")
+        _execute_steps(ctx, node.if_true)
     else:
-        logger.log("条件为假 (False)，执行 if_false 分支")
-        for sub_node in node.get("if_false", []):
-            if cancellation_check_func: cancellation_check_func()
-            _process_node(sub_node, variables, logger, cancellation_check_func)
+        ctx.logger.log("条件为假 (False)，执行 if_false 分支")
+        _execute_steps(ctx, node.if_false)
+
+
+def _execute_switch_node(ctx: ExecutionContext, node: SwitchNode):
+    # 每次只截一帧，所有分支的模板都与同一帧匹配；timeout 大于 0 时轮询直到任一分支命中
+    templates = [_asset_template(ctx, case.template_path, case.match_options) for case in node.cases]
+    index, _ = ctx.poller.wait_for_any(templates, node.timeout, best=node.match == 'best')
+    if index is None:
+        ctx.logger.log("没有分支命中，执行 default 分支")
+        _execute_steps(ctx, node.default)
+        return
+    ctx.logger.log(f"命中分支 {index + 1}/{len(node.cases)}（图片 '{node.cases[index].target}'）")
+    _execute_steps(ctx, node.cases[index].steps)
+
+
+def _control_screenshot(ctx: ExecutionContext, command):
+    """手动截图：优先复用轮询刚截到的画面，过旧时才重新截图"""
+    poller = ctx.poller
+    frame = poller.last_frame
+    if frame is None or time.monotonic() - poller.last_frame_at > getattr(settings, 'MANUAL_SCREENSHOT_MAX_AGE', 1.0):
+        frame = poller.capture()
+    if frame is None:
+        ctx.logger.log("手动截图失败：未能从设备获取画面。", level='WARNING')
+        return
+    ctx.logger.update_screenshot(screenshot_store.save(frame))
+    ctx.logger.log("手动截图成功。")
+
+
+CONTROL_HANDLERS = {
+    'screenshot': _control_screenshot,
+}
+
+
+def _handle_control_command(ctx: ExecutionContext, command):
+    handler = CONTROL_HANDLERS.get(command.get('type'))
+    if handler is None:
+        ctx.logger.log(f"收到未知的控制指令: {command}", level='WARNING')
+        return
+    handler(ctx, command)
+
+
+NODE_EXECUTORS = {
+    'action': _execute_action_node,
+    'loop': _execute_loop_node,
+    'condition': _execute_condition_node,
+    'switch': _execute_switch_node,
+}
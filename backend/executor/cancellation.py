@@ -0,0 +1,178 @@
+"""
+任务取消信号。
+
+cancel_task 视图调用 request_cancel() 在 Redis 中写入取消标记；worker 为每个运行中的任务
+注册一个 CancellationToken，由进程内唯一的 CancellationWatcher 每隔 TASK_CANCEL_POLL_INTERVAL
+秒用一次 Redis 往返批量检查所有已注册的任务。执行器在节点之间调用 token() 只读取本地的
+Event，不产生任何 I/O，取消生效的最大延迟即为该轮询间隔。
+
+Redis 不可用时，watcher 退回到用一条 SQL 批量检查任务状态是否已被置为 CANCELED。
+
+同一轮询还会取出发给运行中任务的控制指令（如手动截图，见 send_command），交给令牌排队；
+执行器在下一次检查取消或等待时，在自己的线程中处理这些指令，因此指令可以直接使用任务
+已经持有的设备连接。
+"""
+import json
+import threading
+import time
+from collections import deque
+import redis
+from django.conf import settings
+from django.db import connection
+from .redis_client import get_redis
+
+CANCEL_KEY_PREFIX = 'autoplay:cancel:'
+# 取消标记的过期时间，避免任务从未被执行时标记一直残留
+CANCEL_KEY_TTL = 24 * 60 * 60
+CONTROL_KEY_PREFIX = 'autoplay:control:'
+# 控制指令只对正在执行的任务有意义，过期后丢弃
+CONTROL_KEY_TTL = 60
+
+def cancel_key(task_id):
+    return f"{CANCEL_KEY_PREFIX}{task_id}"
+
+
+def request_cancel(task_id):
+    """写入取消标记。Redis 写入失败时 watcher 仍能通过数据库状态发现取消。"""
+    try:
+        get_redis().set(cancel_key(task_id), 1, ex=CANCEL_KEY_TTL)
+    except redis.RedisError as e:
+        print(f"写入任务 #{task_id} 的取消标记失败，将依赖数据库状态: {e}")
+
+
+def control_key(task_id):
+    return f"{CONTROL_KEY_PREFIX}{task_id}"
+
+
+def send_command(task_id, command_type, **payload):
+    """向执行该任务的 worker 发送控制指令。Redis 不可用时抛出 redis.RedisError。"""
+    key = control_key(task_id)
+    pipe = get_redis().pipeline()
+    pipe.rpush(key, json.dumps({'type': command_type, **payload}))
+    pipe.expire(key, CONTROL_KEY_TTL)
+    pipe.execute()
+
+
+class CancellationToken:
+    """
+    单个任务的取消令牌。调用令牌本身即为一次取消检查，已取消时抛出 InterruptedError；
+    同时会在调用方线程中依次交给 command_handler 处理已收到的控制指令。
+    """
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self._event = threading.Event()
+        # 取消或收到指令时置位，用于唤醒 sleep
+        self._signal = threading.Event()
+        self._commands = deque()
+        self.command_handler = None
+
+    def __call__(self):
+        if self._event.is_set():
+            raise InterruptedError("Task was canceled by user.")
+        if self._commands:
+            self.dispatch_commands()
+
+    @property
+    def is_canceled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+        self._signal.set()
+
+    def post(self, command):
+        self._commands.append(command)
+        self._signal.set()
+
+    def dispatch_commands(self):
+        while self._commands:
+            command = self._commands.popleft()
+            if self.command_handler is None:
+                print(f"任务 #{self.task_id} 未注册指令处理器，忽略指令: {command}")
+                continue
+            try:
+                self.command_handler(command)
+            except InterruptedError:
+                raise
+            except Exception as e:
+                print(f"任务 #{self.task_id} 处理指令 {command} 失败: {e}")
+
+    def sleep(self, seconds):
+        """等待 seconds 秒，期间一旦收到取消信号立即抛出 InterruptedError，收到的指令随时处理"""
+        deadline = time.monotonic() + seconds
+        while True:
+            self()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if self._signal.wait(remaining):
+                self._signal.clear()
+
+
+class CancellationWatcher:
+    """
+    为本进程中所有运行中的任务轮询取消标记。没有注册任务时后台线程自动退出。
+    """
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def poll_interval(self):
+        return getattr(settings, 'TASK_CANCEL_POLL_INTERVAL', 0.5)
+
+    def register(self, task_id):
+        token = CancellationToken(task_id)
+        with self._lock:
+            self._tokens[task_id] = token
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cancellation-watcher', daemon=True)
+                self._thread.start()
+        return token
+
+    def unregister(self, token):
+        with self._lock:
+            if self._tokens.get(token.task_id) is token:
+                del self._tokens[token.task_id]
+
+    def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self._tokens:
+                        self._thread = None
+                        return
+                    tokens = dict(self._tokens)
+
+                try:
+                    canceled, commands = self._poll(list(tokens))
+                    for task_id in canceled:
+                        tokens[task_id].cancel()
+                    for task_id, command in commands:
+                        tokens[task_id].post(command)
+                except Exception as e:
+                    print(f"检查任务取消标记失败: {e}")
+                time.sleep(self.poll_interval)
+        finally:
+            connection.close()
+
+    def _poll(self, task_ids):
+        """返回 (已被取消的任务ID, [(任务ID, 控制指令)])，每个任务每轮最多取出一条指令"""
+        try:
+            pipe = get_redis().pipeline()
+            pipe.mget([cancel_key(task_id) for task_id in task_ids])
+            for task_id in task_ids:
+                pipe.lpop(control_key(task_id))
+            values, *commands = pipe.execute()
+            return (
+                [task_id for task_id, value in zip(task_ids, values) if value],
+                [(task_id, json.loads(command)) for task_id, command in zip(task_ids, commands) if command],
+            )
+        except redis.RedisError:
+            from api.models import Task
+            canceled = Task.objects.filter(id__in=task_ids, status='CANCELED').values_list('id', flat=True)
+            return list(canceled), []
+
+
+watcher = CancellationWatcher()
@@ -0,0 +1,419 @@
+"""
+脚本编译器。
+
+把 Script.content（v2.0 / v2.1 JSON）编译为 ScriptPlan：一棵由带 __slots__ 的节点对象组成的树。
+编译时完成结构校验、{{变量}} 替换和模板图片路径拼接，执行器只需按节点类型分派，
+不再在每次访问节点时解析 JSON。不合法的脚本会抛出 ScriptCompileError，
+ScriptSerializer 在保存时即可拒绝它们。
+
+图像匹配（touch / validate / if_image_exists / switch）可以用 region 限定搜索区域，
+用 match_scale（脚本级或节点级）在匹配前缩小画面，两者编译为 MatchOptions。
+脚本声明 reference_resolution（模板截取时的设备分辨率）时，执行器按设备分辨率预缩放模板，
+并改用单尺度匹配；ScriptPlan.templates 记录脚本用到的全部模板，供执行前预热。
+
+编译结果按 (script.id, script.updated_at) 缓存在进程内，脚本被修改后自动失效。
+"""
+import os
+import threading
+from collections import OrderedDict
+from numbers import Number
+from django.conf import settings
+
+SUPPORTED_VERSIONS = ('2.0', '2.1')
+ASSETS_DIR = os.path.join(settings.BASE_DIR, 'script_assets')
+PLAN_CACHE_SIZE = 128
+
+
+class ScriptCompileError(ValueError):
+    def __init__(self, message, node_path=''):
+        self.node_path = node_path
+        super().__init__(f"{node_path}: {message}" if node_path else message)
+
+
+class MatchRegion:
+    """匹配区域 (left, top, right, bottom)；relative 为 True 时是相对屏幕宽高的比例"""
+    __slots__ = ('left', 'top', 'right', 'bottom', 'relative')
+
+    def __init__(self, left, top, right, bottom, relative):
+        self.left = left
+        self.top = top
+        self.right = right
+        self.bottom = bottom
+        self.relative = relative
+
+    def box(self, width, height):
+        """换算为 width x height 画面中的像素区域，超出画面的部分被裁掉"""
+        if self.relative:
+            left, top, right, bottom = (round(self.left * width), round(self.top * height),
+                                        round(self.right * width), round(self.bottom * height))
+        else:
+            left, top, right, bottom = (int(v) for v in (self.left, self.top, self.right, self.bottom))
+        return max(left, 0), max(top, 0), min(right, width), min(bottom, height)
+
+    def __repr__(self):
+        return f"MatchRegion({self.left}, {self.top}, {self.right}, {self.bottom}, relative={self.relative})"
+
+
+class MatchOptions:
+    """模板匹配的附加选项：只在 region 内搜索，并把画面按 scale 缩小后再匹配"""
+    __slots__ = ('region', 'scale')
+
+    def __init__(self, region=None, scale=1):
+        self.region = region
+        self.scale = scale
+
+
+class ValidateSpec:
+    __slots__ = ('type', 'target', 'template_path', 'timeout', 'on_failure', 'match_options')
+
+    def __init__(self, type, target, template_path, timeout, on_failure, match_options):
+        self.type = type
+        self.target = target
+        self.template_path = template_path
+        self.timeout = timeout
+        self.on_failure = on_failure
+        self.match_options = match_options
+
+
+class ActionNode:
+    node_type = 'action'
+    __slots__ = ('path', 'description', 'action', 'params', 'template_path', 'match_options', 'on_failure',
+                 'retry_count', 'retry_delay', 'validate')
+
+    def __init__(self, path, description, action, params, template_path, match_options, on_failure, retry_count,
+                 retry_delay, validate):
+        self.path = path
+        self.description = description
+        self.action = action
+        self.params = params
+        self.template_path = template_path
+        self.match_options = match_options
+        # on_failure 为 'abort' / 'ignore' / 'retry'，retry 时重试次数和间隔见 retry_count / retry_delay
+        self.on_failure = on_failure
+        self.retry_count = retry_count
+        self.retry_delay = retry_delay
+        self.validate = validate
+
+
+class LoopNode:
+    node_type = 'loop'
+    __slots__ = ('path', 'description', 'count', 'steps')
+
+    def __init__(self, path, description, count, steps):
+        self.path = path
+        self.description = description
+        self.count = count
+        self.steps = steps
+
+
+class ConditionNode:
+    node_type = 'condition'
+    __slots__ = ('path', 'description', 'condition_type', 'target', 'template_path', 'match_options', 'timeout',
+                 'if_true', 'if_false')
+
+    def __init__(self, path, description, condition_type, target, template_path, match_options, timeout, if_true,
+                 if_false):
+        self.path = path
+        self.description = description
+        self.condition_type = condition_type
+        self.target = target
+        self.template_path = template_path
+        self.match_options = match_options
+        self.timeout = timeout
+        self.if_true = if_true
+        self.if_false = if_false
+
+
+class SwitchCase:
+    __slots__ = ('target', 'template_path', 'match_options', 'steps')
+
+    def __init__(self, target, template_path, match_options, steps):
+        self.target = target
+        self.template_path = template_path
+        self.match_options = match_options
+        self.steps = steps
+
+
+class SwitchNode:
+    node_type = 'switch'
+    __slots__ = ('path', 'description', 'match', 'timeout', 'cases', 'default')
+
+    def __init__(self, path, description, match, timeout, cases, default):
+        self.path = path
+        self.description = description
+        # 'first' 按顺序取第一个命中的分支，'best' 取置信度最高的分支
+        self.match = match
+        # 0 表示只检查一帧；大于 0 时在该时间内轮询，直到任一分支命中
+        self.timeout = timeout
+        self.cases = cases
+        self.default = default
+
+
+class ScriptPlan:
+    __slots__ = ('name', 'version', 'variables', 'match_scale', 'reference_resolution', 'templates', 'steps',
+                 'node_count')
+
+    def __init__(self, name, version, variables, match_scale, reference_resolution, templates, steps, node_count):
+        self.name = name
+        self.version = version
+        self.variables = variables
+        self.match_scale = match_scale
+        self.reference_resolution = reference_resolution
+        # {(模板路径, match_scale)}
+        self.templates = templates
+        self.steps = steps
+        self.node_count = node_count
+
+
+def asset_path(filename):
+    return os.path.join(ASSETS_DIR, filename)
+
+
+class _Compiler:
+    def __init__(self, content):
+        self.content = content
+        self.variables = {}
+        self.match_scale = 1
+        self.templates = set()
+        self.node_count = 0
+
+    def compile(self):
+        content = self.content
+        if not isinstance(content, dict):
+            raise ScriptCompileError("脚本内容必须是一个 JSON 对象")
+
+        version = content.get('version')
+        if version is not None and str(version) not in SUPPORTED_VERSIONS:
+            raise ScriptCompileError(f"不支持的脚本版本 '{version}'，支持的版本: {', '.join(SUPPORTED_VERSIONS)}")
+
+        variables = content.get('variables', {})
+        if not isinstance(variables, dict):
+            raise ScriptCompileError("'variables' 必须是一个对象")
+        self.variables = variables
+        # 脚本级的 match_scale 作为所有图像匹配的默认值，节点中可以单独覆盖
+        self.match_scale = self._match_scale(content.get('match_scale', 1), 'match_scale')
+        reference_resolution = self._reference_resolution(content.get('reference_resolution'))
+
+        steps = self._compile_steps(content.get('steps'), 'steps', required=True)
+        return ScriptPlan(content.get('name', ''), version, variables, self.match_scale, reference_resolution,
+                          frozenset(self.templates), steps, self.node_count)
+
+    def _reference_resolution(self, value):
+        if value is None:
+            return None
+        if (not isinstance(value, (list, tuple)) or len(value) != 2
+                or any(not isinstance(v, int) or isinstance(v, bool) or v <= 0 for v in value)):
+            raise ScriptCompileError("'reference_resolution' 必须是 [宽, 高] 形式的正整数", 'reference_resolution')
+        return tuple(value)
+
+    def _template(self, target, match_options):
+        """模板图片的绝对路径，同时记录到 ScriptPlan.templates"""
+        template_path = asset_path(target)
+        self.templates.add((template_path, match_options.scale if match_options else 1))
+        return template_path
+
+    def _compile_steps(self, steps, path, required=False):
+        if steps is None and not required:
+            return ()
+        if not isinstance(steps, list):
+            raise ScriptCompileError("必须是一个节点数组", path)
+        return tuple(self._compile_node(node, f"{path}.{index}") for index, node in enumerate(steps))
+
+    def _compile_node(self, node, path):
+        if not isinstance(node, dict):
+            raise ScriptCompileError("节点必须是一个对象", path)
+        node_type = node.get('type')
+        compile_func = self.NODE_COMPILERS.get(node_type)
+        if compile_func is None:
+            raise ScriptCompileError(f"未知的节点类型 '{node_type}'", path)
+        self.node_count += 1
+        return compile_func(self, node, path)
+
+    def _resolve(self, value, path):
+        if isinstance(value, str) and value.startswith("{{") and value.endswith("}}"):
+            var_name = value[2:-2].strip()
+            if var_name not in self.variables:
+                raise ScriptCompileError(f"引用了未定义的变量 '{var_name}'", path)
+            return self.variables[var_name]
+        return value
+
+    def _require(self, params, key, expected_type, path):
+        value = params.get(key)
+        if not isinstance(value, expected_type) or isinstance(value, bool):
+            raise ScriptCompileError(f"参数 '{key}' 缺失或类型不正确", path)
+        return value
+
+    def _number(self, value, key, path, minimum=0):
+        if not isinstance(value, Number) or isinstance(value, bool) or value < minimum:
+            raise ScriptCompileError(f"'{key}' 必须是不小于 {minimum} 的数字", path)
+        return value
+
+    def _match_scale(self, value, path):
+        if not isinstance(value, Number) or isinstance(value, bool) or not 0 < value <= 1:
+            raise ScriptCompileError("'match_scale' 必须是 (0, 1] 之间的数字", path)
+        return value
+
+    def _match_region(self, value, path):
+        """[left, top, right, bottom]：全部在 0~1 之间时按屏幕比例解释，否则为像素坐标"""
+        if (not isinstance(value, (list, tuple)) or len(value) != 4
+                or any(not isinstance(v, Number) or isinstance(v, bool) or v < 0 for v in value)):
+            raise ScriptCompileError("'region' 必须是 [left, top, right, bottom] 形式的非负数字", path)
+        left, top, right, bottom = value
+        if left >= right or top >= bottom:
+            raise ScriptCompileError("'region' 的右下角必须位于左上角的右下方", path)
+        return MatchRegion(left, top, right, bottom, relative=all(v <= 1 for v in value))
+
+    def _match_options(self, params, path):
+        """从节点参数中取出 region / match_scale；都未指定时返回 None"""
+        region = params.pop('region', None)
+        scale = params.pop('match_scale', None)
+        if region is not None:
+            region = self._match_region(region, f"{path}.region")
+        scale = self.match_scale if scale is None else self._match_scale(scale, f"{path}.match_scale")
+        if region is None and scale == 1:
+            return None
+        return MatchOptions(region, scale)
+
+    def _compile_action(self, node, path):
+        action = node.get('action')
+        params = node.get('params', {})
+        if not isinstance(params, dict):
+            raise ScriptCompileError("'params' 必须是一个对象", path)
+        params = {key: self._resolve(value, f"{path}.params.{key}") for key, value in params.items()}
+
+        template_path = match_options = None
+        if action == 'touch':
+            match_options = self._match_options(params, f"{path}.params")
+            template_path = self._template(self._require(params, 'target', str, path), match_options)
+        elif action == 'swipe':
+            for key in ('start', 'end'):
+                point = params.get(key)
+                if not isinstance(point, (list, tuple)) or len(point) != 2:
+                    raise ScriptCompileError(f"参数 '{key}' 必须是 [x, y] 坐标", path)
+                params[key] = tuple(point)
+        elif action == 'sleep':
+            params['duration'] = self._number(params.get('duration', 1), 'duration', path)
+        elif action == 'text':
+            params['content'] = str(params.get('content', ''))
+        elif action == 'snapshot':
+            filename = params.get('filename')
+            if filename is not None and not isinstance(filename, str):
+                raise ScriptCompileError("参数 'filename' 必须是字符串", path)
+        else:
+            raise ScriptCompileError(f"未知的原子动作 '{action}'", path)
+
+        on_failure = node.get('on_failure', 'abort')
+        retry_count = retry_delay = 0
+        if isinstance(on_failure, dict) and 'retry' in on_failure:
+            retry_config = on_failure['retry'] or {}
+            retry_count = int(self._number(retry_config.get('count', 1), 'retry.count', path))
+            retry_delay = self._number(retry_config.get('delay', 1), 'retry.delay', path)
+            on_failure = 'retry'
+        elif on_failure not in ('abort', 'ignore'):
+            raise ScriptCompileError(f"无效的 on_failure 策略 '{on_failure}'", path)
+
+        return ActionNode(path, node.get('description', '无描述'), action, params, template_path, match_options,
+                          on_failure, retry_count, retry_delay, self._compile_validate(node.get('validate'), f"{path}.validate"))
+
+    def _compile_validate(self, validate, path):
+        if validate is None:
+            return None
+        if not isinstance(validate, dict):
+            raise ScriptCompileError("'validate' 必须是一个对象", path)
+        v_type = validate.get('type')
+        if v_type != 'image_exists':
+            raise ScriptCompileError(f"未知的验证类型 '{v_type}'", path)
+        target = self._resolve(validate.get('target'), f"{path}.target")
+        if not isinstance(target, str):
+            raise ScriptCompileError("'target' 必须是图片文件名", path)
+        on_failure = validate.get('on_failure', 'abort')
+        if on_failure not in ('abort', 'retry_step', 'ignore'):
+            raise ScriptCompileError(f"无效的 on_failure 策略 '{on_failure}'", path)
+        timeout = self._number(validate.get('timeout', 5), 'timeout', path)
+        match_options = self._match_options(
+            {key: self._resolve(validate.get(key), f"{path}.{key}") for key in ('region', 'match_scale')
+             if key in validate}, path)
+        return ValidateSpec(v_type, target, self._template(target, match_options), timeout, on_failure,
+                            match_options)
+
+    def _compile_loop(self, node, path):
+        if node.get('loop_type') != 'count':
+            raise ScriptCompileError(f"未知的循环类型 '{node.get('loop_type')}'", path)
+        count = int(self._number(self._resolve(node.get('count', 0), f"{path}.count"), 'count', path))
+        steps = self._compile_steps(node.get('steps'), f"{path}.steps")
+        return LoopNode(path, node.get('description', '无描述'), count, steps)
+
+    def _compile_condition(self, node, path):
+        condition_type = node.get('condition_type')
+        if condition_type != 'if_image_exists':
+            raise ScriptCompileError(f"未知的条件类型 '{condition_type}'", path)
+        params = node.get('params', {})
+        if not isinstance(params, dict):
+            raise ScriptCompileError("'params' 必须是一个对象", path)
+        params = {key: self._resolve(value, f"{path}.params.{key}") for key, value in params.items()}
+        target = self._require(params, 'target', str, path)
+        timeout = self._number(params.get('timeout', 3), 'timeout', path)
+        match_options = self._match_options(params, f"{path}.params")
+        return ConditionNode(path, node.get('description', '无描述'), condition_type, target,
+                             self._template(target, match_options), match_options, timeout, self._compile_steps(node.get('if_true'), f"{path}.if_true"),
+                             self._compile_steps(node.get('if_false'), f"{path}.if_false"))
+
+    def _compile_switch(self, node, path):
+        match = node.get('match', 'first')
+        if match not in ('first', 'best'):
+            raise ScriptCompileError(f"无效的匹配方式 '{match}'，可选 'first' / 'best'", path)
+        timeout = self._number(self._resolve(node.get('timeout', 0), f"{path}.timeout"), 'timeout', path)
+        cases = node.get('cases')
+        if not isinstance(cases, list) or not cases:
+            raise ScriptCompileError("'cases' 必须是非空数组", path)
+        compiled_cases = []
+        for index, case in enumerate(cases):
+            case_path = f"{path}.cases.{index}"
+            if not isinstance(case, dict):
+                raise ScriptCompileError("分支必须是一个对象", case_path)
+            target = self._resolve(case.get('target'), f"{case_path}.target")
+            if not isinstance(target, str):
+                raise ScriptCompileError("'target' 必须是图片文件名", case_path)
+            match_options = self._match_options(
+                {key: self._resolve(case.get(key), f"{case_path}.{key}") for key in ('region', 'match_scale')
+                 if key in case}, case_path)
+            compiled_cases.append(SwitchCase(target, self._template(target, match_options), match_options,
+                                             self._compile_steps(case.get('steps'), f"{case_path}.steps")))
+        return SwitchNode(path, node.get('description', '无描述'), match, timeout, tuple(compiled_cases),
+                          self._compile_steps(node.get('default'), f"{path}.default"))
+
+    NODE_COMPILERS = {
+        'action': _compile_action,
+        'loop': _compile_loop,
+        'condition': _compile_condition,
+        'switch': _compile_switch,
+    }
+
+
+def compile_script(content):
+    """校验并编译脚本内容，失败时抛出 ScriptCompileError"""
+    return _Compiler(content).compile()
+
+
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+
+def get_plan(script):
+    """返回 Script 实例的执行计划，按 (id, updated_at) 缓存"""
+    key = (script.id, script.updated_at)
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+
+    plan = compile_script(script.content)
+    with _plan_cache_lock:
+        # 同一脚本的旧版本计划不会再被使用，直接移除
+        for stale_key in [k for k in _plan_cache if k[0] == script.id]:
+            del _plan_cache[stale_key]
+        _plan_cache[key] = plan
+        while len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
@@ -0,0 +1,223 @@
+"""
+设备连接。
+
+Airtest 的 connect_device / auto_setup 会把设备注册为进程全局的 G.DEVICE，
+gevent worker 中同时运行的多个任务会互相覆盖。这里按同样的 URI 规则创建设备对象，
+但不注册到 G，每个任务只操作自己持有的设备对象。
+
+建立连接（ADB 握手、启动截图和触控服务）需要数秒，因此每个 worker 进程通过 device_pool
+按 URI 保留已连接的设备：连续在同一设备上执行的任务直接复用连接；
+空闲超过 DEVICE_POOL_HEALTHCHECK_INTERVAL 秒的连接在复用前做一次健康检查，失败则重连；
+空闲超过 DEVICE_POOL_IDLE_TIMEOUT 秒的连接由后台线程断开。
+设备分辨率在每个连接上只查询一次，供模板按分辨率预缩放使用。
+
+测试设备（SyntheticDevice:///、ReplayDevice:///）只在 ENABLE_TEST_DEVICES 为 True 或基准测试调用
+register_test_devices() 时注册，用户提交的设备 URI 默认无法使用它们。
+"""
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from airtest.core.error import AdbError, DeviceConnectionError
+from airtest.core.helper import import_device_cls
+from airtest.utils.snippet import parse_device_uri
+
+# 出现这些异常说明连接本身已不可用，归还时直接丢弃
+CONNECTION_ERRORS = (AdbError, DeviceConnectionError, ConnectionError)
+
+
+def register_test_devices():
+    """注册 SyntheticDevice:/// 和 ReplayDevice:/// 测试设备（导入即注册），只供基准测试和单元测试使用"""
+    from . import synthetic_device, replay_device  # noqa: F401
+
+
+if getattr(settings, 'ENABLE_TEST_DEVICES', False):
+    register_test_devices()
+
+
+def connect_device(device_uri):
+    """根据 Airtest 设备 URI 创建一个独立的设备对象"""
+    platform, uuid, params = parse_device_uri(device_uri)
+    device_cls = import_device_cls(platform)
+    return device_cls(uuid, **params)
+
+
+def disconnect_device(device):
+    """停止设备对象占用的截图 / 触控 / 旋转监听服务，失败时只打印"""
+    disconnect = getattr(device, 'disconnect', None)
+    if disconnect is None:
+        return
+    try:
+        disconnect()
+    except Exception as e:
+        print(f"断开设备连接时出错: {e}")
+
+
+def is_device_healthy(device):
+    """Android 设备通过 adb get-state 检查；其他设备没有廉价的检查手段，视为可用"""
+    adb = getattr(device, 'adb', None)
+    if adb is None:
+        return True
+    try:
+        return adb.get_status() == 'device'
+    except Exception:
+        return False
+
+
+def device_resolution(device):
+    """设备屏幕的 (宽, 高)；设备不支持 get_current_resolution 时以一帧截图的尺寸为准"""
+    try:
+        width, height = device.get_current_resolution()
+        return int(width), int(height)
+    except Exception:
+        frame = device.snapshot(filename=None)
+        return frame.shape[1], frame.shape[0]
+
+
+class PooledDevice:
+    __slots__ = ('uri', 'device', 'resolution', 'users', 'last_used', 'last_checked')
+
+    def __init__(self, uri, device):
+        self.uri = uri
+        self.device = device
+        self.resolution = None
+        self.users = 0
+        self.last_used = self.last_checked = time.monotonic()
+
+
+class DevicePool:
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        # 同一 URI 的连接 / 健康检查串行进行，不同 URI 互不阻塞
+        self._uri_locks = {}
+        self._reaper = None
+        self.connects = 0
+        self.reuses = 0
+        self.reconnects = 0
+        self.evictions = 0
+
+    @property
+    def idle_timeout(self):
+        return getattr(settings, 'DEVICE_POOL_IDLE_TIMEOUT', 600)
+
+    @property
+    def healthcheck_interval(self):
+        return getattr(settings, 'DEVICE_POOL_HEALTHCHECK_INTERVAL', 30)
+
+    def _uri_lock(self, uri):
+        with self._lock:
+            return self._uri_locks.setdefault(uri, threading.Lock())
+
+    def acquire(self, uri):
+        """返回 uri 对应的已连接设备，必要时建立或重建连接。用完后必须调用 release。"""
+        with self._uri_lock(uri):
+            with self._lock:
+                entry = self._entries.get(uri)
+            now = time.monotonic()
+
+            if entry is not None and entry.users == 0 and now - entry.last_checked >= self.healthcheck_interval:
+                if is_device_healthy(entry.device):
+                    entry.last_checked = now
+                else:
+                    print(f"设备 {uri} 的连接已失效，重新连接")
+                    self._remove(entry)
+                    self.reconnects += 1
+                    entry = None
+
+            if entry is None:
+                entry = PooledDevice(uri, connect_device(uri))
+                self.connects += 1
+                with self._lock:
+                    self._entries[uri] = entry
+                    self._start_reaper()
+            else:
+                self.reuses += 1
+
+            with self._lock:
+                entry.users += 1
+            return entry.device
+
+    def release(self, uri, broken=False):
+        with self._lock:
+            entry = self._entries.get(uri)
+            if entry is None:
+                return
+            entry.users = max(entry.users - 1, 0)
+            entry.last_used = time.monotonic()
+        if broken:
+            self.discard(uri)
+
+    def resolution(self, uri):
+        """uri 对应连接的屏幕分辨率，同一连接只查询一次"""
+        with self._lock:
+            entry = self._entries.get(uri)
+        if entry is None:
+            raise KeyError(f"设备 {uri} 不在连接池中")
+        if entry.resolution is None:
+            entry.resolution = device_resolution(entry.device)
+        return entry.resolution
+
+    def discard(self, uri):
+        """断开并移除 uri 的连接，下次 acquire 时重新连接"""
+        with self._lock:
+            entry = self._entries.get(uri)
+        if entry is not None:
+            self._remove(entry)
+
+    def _remove(self, entry):
+        with self._lock:
+            if self._entries.get(entry.uri) is entry:
+                del self._entries[entry.uri]
+        disconnect_device(entry.device)
+
+    @contextmanager
+    def connection(self, uri):
+        """with device_pool.connection(uri) as device: ...，连接层面的异常会让该连接被丢弃"""
+        device = self.acquire(uri)
+        broken = False
+        try:
+            yield device
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(uri, broken)
+
+    def _start_reaper(self):
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._run_reaper, name='device-pool-reaper', daemon=True)
+            self._reaper.start()
+
+    def _run_reaper(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 60))
+            now = time.monotonic()
+            with self._lock:
+                if not self._entries:
+                    self._reaper = None
+                    return
+                idle = [entry for entry in self._entries.values()
+                        if entry.users == 0 and now - entry.last_used >= self.idle_timeout]
+            for entry in idle:
+                with self._uri_lock(entry.uri):
+                    # 拿到锁之前可能刚被某个任务取走
+                    if entry.users:
+                        continue
+                    print(f"设备 {entry.uri} 空闲超过 {self.idle_timeout} 秒，断开连接")
+                    self._remove(entry)
+                    self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'devices': len(self._entries),
+                'in_use': sum(1 for entry in self._entries.values() if entry.users),
+                'connects': self.connects,
+                'reuses': self.reuses,
+                'reconnects': self.reconnects,
+                'evictions': self.evictions,
+            }
+
+
+device_pool = DevicePool()
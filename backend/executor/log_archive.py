@@ -0,0 +1,163 @@
+"""
+已结束任务的日志冷归档。
+
+任务结束超过 LOG_ARCHIVE_AFTER_DAYS 天后，archive_task_logs() 把它在 TaskLogEntry 中的全部日志
+按序号写成 JSON Lines 并 gzip 压缩，存入归档存储，随后删除数据库中的日志行；Task 只保留归档键
+（log_archive）和压缩后的大小（log_archive_size）。读取日志时由 Task.archived_log_entries()
+按需取回并解压，接口返回的格式与未归档时相同。
+
+归档存储由 LOG_ARCHIVE_BACKEND 选择，默认 'local' 保存在 LOG_ARCHIVE_ROOT 目录下；
+其他存储（对象存储等）只需实现 save / load / delete 并注册到 ARCHIVE_STORES。
+"""
+import gzip
+import json
+import os
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+FINISHED_STATUSES = ('SUCCESS', 'FAILED', 'CANCELED')
+ENTRY_FIELDS = ('seq', 'timestamp', 'level', 'node_path', 'message')
+
+
+def archive_key(task_id):
+    """按任务 ID 分目录，避免单个目录下文件过多"""
+    return f"tasks/{task_id // 1000:05d}/task-{task_id}.jsonl.gz"
+
+
+def encode_entries(entries):
+    """[{seq, timestamp, level, node_path, message}] -> gzip 压缩的 JSON Lines"""
+    lines = []
+    for entry in entries:
+        record = dict(entry)
+        record['timestamp'] = record['timestamp'].isoformat()
+        lines.append(json.dumps(record, ensure_ascii=False))
+    data = ('\n'.join(lines) + '\n').encode('utf-8')
+    return gzip.compress(data, compresslevel=getattr(settings, 'LOG_ARCHIVE_COMPRESS_LEVEL', 6))
+
+
+def decode_entries(data):
+    entries = []
+    for line in gzip.decompress(data).decode('utf-8').splitlines():
+        if line:
+            record = json.loads(line)
+            record['timestamp'] = parse_datetime(record['timestamp'])
+            entries.append(record)
+    return entries
+
+
+class LocalArchiveStore:
+    """把归档保存为 root 目录下的文件，键即相对路径"""
+
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        return self._root or getattr(settings, 'LOG_ARCHIVE_ROOT', os.path.join(settings.BASE_DIR, 'log_archives'))
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def save(self, key, data):
+        # 先写临时文件再重命名，读取方不会看到写了一半的归档
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+ARCHIVE_STORES = {
+    'local': LocalArchiveStore,
+}
+
+_archive_store = None
+
+
+def get_archive_store():
+    """按 LOG_ARCHIVE_BACKEND 返回进程内唯一的归档存储"""
+    global _archive_store
+    if _archive_store is None:
+        _archive_store = ARCHIVE_STORES[getattr(settings, 'LOG_ARCHIVE_BACKEND', 'local')]()
+    return _archive_store
+
+
+def load_entries(key):
+    return decode_entries(get_archive_store().load(key))
+
+
+def archivable_tasks(max_age_days=None):
+    """已结束超过 max_age_days 天、尚未归档且仍有日志行的任务"""
+    from api.models import Task, TaskLogEntry
+
+    if max_age_days is None:
+        max_age_days = getattr(settings, 'LOG_ARCHIVE_AFTER_DAYS', 7)
+    cutoff = timezone.now() - timedelta(days=max_age_days)
+    return (Task.objects
+            .filter(status__in=FINISHED_STATUSES, completed_at__lt=cutoff, log_archive__isnull=True)
+            .filter(Exists(TaskLogEntry.objects.filter(task_id=OuterRef('pk'))))
+            .order_by('id'))
+
+
+def archive_task(task_id):
+    """归档单个任务的日志，返回 (归档的日志行数, 压缩后的字节数)；没有日志或已被其他进程归档时返回 None"""
+    from api.models import Task, TaskLogEntry
+
+    entries = list(TaskLogEntry.objects.filter(task_id=task_id).order_by('seq').values(*ENTRY_FIELDS))
+    if not entries:
+        return None
+    key = archive_key(task_id)
+    data = encode_entries(entries)
+    get_archive_store().save(key, data)
+
+    with transaction.atomic():
+        updated = Task.objects.filter(id=task_id, log_archive__isnull=True).update(
+            log_archive=key, log_archive_size=len(data))
+        if not updated:
+            return None
+        # 只删除已写入归档的日志行，归档期间新追加的日志（如果有）保留在数据库中
+        TaskLogEntry.objects.filter(task_id=task_id, seq__lte=entries[-1]['seq']).delete()
+    return len(entries), len(data)
+
+
+def archive_task_logs(max_age_days=None, limit=None):
+    """归档符合条件的任务日志，返回 (归档的任务数, 删除的日志行数, 压缩后的总字节数)"""
+    batch_size = getattr(settings, 'LOG_ARCHIVE_BATCH_SIZE', 200)
+    archived = rows = total_bytes = 0
+    while limit is None or archived < limit:
+        size = batch_size if limit is None else min(batch_size, limit - archived)
+        task_ids = list(archivable_tasks(max_age_days).values_list('id', flat=True)[:size])
+        if not task_ids:
+            break
+        progressed = False
+        for task_id in task_ids:
+            try:
+                result = archive_task(task_id)
+            except Exception as e:
+                print(f"归档任务 #{task_id} 的日志失败: {e}")
+                continue
+            if result is not None:
+                archived += 1
+                rows += result[0]
+                total_bytes += result[1]
+                progressed = True
+        if not progressed:
+            # 这一批全部失败，避免反复重试同一批任务
+            break
+    return archived, rows, total_bytes
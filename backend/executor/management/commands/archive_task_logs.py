@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from executor.log_archive import archivable_tasks, archive_task_logs
+
+
+class Command(BaseCommand):
+    help = "把已结束任务的日志压缩归档，并从 TaskLogEntry 表中删除（默认使用 LOG_ARCHIVE_AFTER_DAYS）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=None, help="归档结束时间早于该天数的任务")
+        parser.add_argument('--limit', type=int, default=None, help="本次最多归档的任务数")
+        parser.add_argument('--dry-run', action='store_true', help="只统计符合条件的任务数，不做归档")
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            count = archivable_tasks(options['days']).count()
+            self.stdout.write(f"符合归档条件的任务: {count} 个")
+            return
+        archived, rows, total_bytes = archive_task_logs(options['days'], options['limit'])
+        self.stdout.write(self.style.SUCCESS(
+            f"已归档 {archived} 个任务的 {rows} 条日志，压缩后 {total_bytes / 1024 / 1024:.2f} MB"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from executor.screenshot_store import screenshot_store
+
+
+class Command(BaseCommand):
+    help = "按保留策略清理截图存储（默认使用 SCREENSHOT_RETENTION_DAYS / SCREENSHOT_STORE_MAX_BYTES）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=None, help="删除最后使用时间早于该天数的截图")
+        parser.add_argument('--max-bytes', type=int, default=None, help="截图存储的总大小上限（字节）")
+
+    def handle(self, *args, **options):
+        removed, freed = screenshot_store.prune(options['days'], options['max_bytes'])
+        self.stdout.write(self.style.SUCCESS(f"已删除 {removed} 张截图，释放 {freed / 1024 / 1024:.1f} MB"))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from executor.retention import purgeable_tasks, purge_tasks
+
+
+class Command(BaseCommand):
+    help = "分批删除已结束超过指定天数的任务及其日志、日志归档和截图目录（默认使用 TASK_RETENTION_DAYS）"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float, default=None, help="删除结束时间早于该天数的任务")
+        parser.add_argument('--limit', type=int, default=None, help="本次最多删除的任务数")
+        parser.add_argument('--dry-run', action='store_true', help="只统计符合条件的任务数，不做删除")
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else getattr(settings, 'TASK_RETENTION_DAYS', None)
+        if days is None:
+            raise CommandError("未设置 TASK_RETENTION_DAYS，请通过 --days 指定保留天数")
+        if options['dry_run']:
+            self.stdout.write(f"符合删除条件的任务: {purgeable_tasks(days).count()} 个")
+            return
+        tasks, rows, files = purge_tasks(days, options['limit'])
+        self.stdout.write(self.style.SUCCESS(f"已删除 {tasks} 个任务、{rows} 条日志、{files} 个归档文件和截图目录"))
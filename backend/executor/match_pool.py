@@ -0,0 +1,268 @@
+"""
+模板匹配进程池（MATCH_EXECUTION = 'process'）。
+
+gevent 执行池中同一 worker 的所有任务共享一个进程和一把 GIL，OpenCV 匹配期间其他协程的设备 I/O
+和写库都会被卡住。该模式下截图、设备操作和流程编排仍在协程中进行，匹配交给最多 MATCH_POOL_SIZE
+个匹配进程：
+- 画面通过共享内存传递：每个匹配进程对应一块可复用的共享内存，父进程把画面复制进去，管道中只发送
+  段名、形状和模板（CachedTemplate 本身，模板图片由子进程的 template_cache 各自解码缓存）；
+- 等待结果时以很短的间隔检查管道，time.sleep 在 gevent 下会让出给其他协程，Windows 上同样可用；
+- 空闲的匹配进程放在队列中，同时进行的匹配不超过池的大小，多出的请求排队等待。
+
+匹配进程异常退出时会被丢弃并在下次使用时重新启动，本次匹配改在当前进程中进行；
+超过 MATCH_POOL_TIMEOUT 秒没有结果时同样丢弃该进程，并抛出 TimeoutError。
+"""
+import atexit
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+from django.conf import settings
+from .matchers import Matcher, create_matcher
+
+# 等待匹配结果时检查管道的间隔（秒），从最短逐步放大到最长
+POLL_MIN_INTERVAL = 0.001
+POLL_MAX_INTERVAL = 0.01
+# 匹配进程启动（初始化 Django、导入 Airtest / OpenCV）的最长等待时间（秒），不计入单次匹配的超时
+STARTUP_TIMEOUT = 120
+
+
+def _worker_main(conn, settings_module):
+    """匹配进程的主循环：收到 None 或管道关闭时退出"""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    import django
+    django.setup()
+    conn.send('ready')
+
+    matchers = {}
+    shm = None
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request is None:
+                break
+
+            segment, shape, dtype, matcher_name, templates, best = request
+            frame = None
+            try:
+                if shm is None or shm.name != segment:
+                    if shm is not None:
+                        shm.close()
+                    # spawn 启动的匹配进程与父进程共用同一个 resource_tracker，附加不会导致共享内存被提前回收
+                    shm = shared_memory.SharedMemory(name=segment)
+                frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                matcher = matchers.get(matcher_name)
+                if matcher is None:
+                    matcher = matchers[matcher_name] = create_matcher(matcher_name, execution='inline')
+                before = matcher.matches
+                index, pos = matcher.match(frame, templates, best)
+                reply = ('ok', index, pos, matcher.matches - before)
+            except Exception as e:
+                reply = ('error', e)
+            finally:
+                # 共享内存关闭前不能还有指向它的数组
+                frame = None
+
+            try:
+                conn.send(reply)
+            except Exception as e:
+                # 异常对象无法序列化时只传回描述
+                conn.send(('error', RuntimeError(f"{type(reply[1]).__name__}: {reply[1]}")))
+    finally:
+        if shm is not None:
+            shm.close()
+
+
+class _MatchProcess:
+    """一个匹配进程，连同与它通信的管道和传递画面的共享内存"""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        settings_module = os.environ.get('DJANGO_SETTINGS_MODULE', 'backend.settings')
+        self.process = context.Process(target=_worker_main, args=(child_conn, settings_module),
+                                       name='template-matcher', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.shm = None
+
+    def _segment(self, nbytes):
+        if self.shm is None or self.shm.size < nbytes:
+            self._release_segment()
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        return self.shm
+
+    def _release_segment(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def match(self, matcher_name, frame, templates, best, timeout):
+        """返回匹配进程的回复 ('ok', 下标, 坐标, 匹配次数) 或 ('error', 异常)"""
+        if not self.ready:
+            self._receive(STARTUP_TIMEOUT, "匹配进程启动")
+            self.ready = True
+
+        frame = np.ascontiguousarray(frame)
+        shm = self._segment(frame.nbytes)
+        np.ndarray(frame.shape, dtype=frame.dtype, buffer=shm.buf)[...] = frame
+        self.conn.send((shm.name, frame.shape, frame.dtype.str, matcher_name, list(templates), best))
+        return self._receive(timeout, "模板匹配")
+
+    def _receive(self, timeout, action):
+        deadline = time.monotonic() + timeout
+        interval = POLL_MIN_INTERVAL
+        while not self.conn.poll():
+            if not self.process.is_alive():
+                raise EOFError(f"匹配进程已退出 (exitcode={self.process.exitcode})")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{action}超过 {timeout} 秒没有结果")
+            time.sleep(interval)
+            interval = min(interval * 2, POLL_MAX_INTERVAL)
+        return self.conn.recv()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+        self.conn.close()
+        self._release_segment()
+
+
+class MatchPool:
+    """按需启动、数量有上限的匹配进程池，每个 worker 进程一份"""
+
+    def __init__(self):
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._processes = set()
+        self._started = 0
+        self._context = multiprocessing.get_context('spawn')
+        self.dispatched = 0
+        self.fallbacks = 0
+        self.restarts = 0
+
+    @property
+    def size(self):
+        return getattr(settings, 'MATCH_POOL_SIZE', None) or os.cpu_count() or 1
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'MATCH_POOL_TIMEOUT', 30)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._started < self.size
+            if create:
+                self._started += 1
+        if not create:
+            return self._idle.get()
+        try:
+            process = _MatchProcess(self._context)
+        except Exception:
+            with self._lock:
+                self._started -= 1
+            raise
+        with self._lock:
+            self._processes.add(process)
+        return process
+
+    def _release(self, process, healthy):
+        if healthy:
+            self._idle.put(process)
+            return
+        with self._lock:
+            self._processes.discard(process)
+            self._started -= 1
+            self.restarts += 1
+        process.close()
+
+    def match(self, matcher_name, frame, templates, best=False):
+        """
+        在匹配进程中用 matcher_name 匹配器匹配，返回 (模板下标, 坐标, 参与匹配的模板次数)。
+        匹配进程不可用时返回 None，由调用方在当前进程中匹配。
+        """
+        try:
+            process = self._acquire()
+        except Exception as e:
+            print(f"启动匹配进程失败，在当前进程中匹配: {e}")
+            self.fallbacks += 1
+            return None
+
+        try:
+            reply = process.match(matcher_name, frame, templates, best, self.timeout)
+        except TimeoutError:
+            self._release(process, False)
+            raise
+        except (EOFError, OSError) as e:
+            self._release(process, False)
+            print(f"匹配进程不可用，已丢弃，本次在当前进程中匹配: {e}")
+            self.fallbacks += 1
+            return None
+        self._release(process, True)
+        self.dispatched += 1
+
+        if reply[0] == 'error':
+            raise reply[1]
+        return reply[1:]
+
+    def close(self):
+        with self._lock:
+            processes, self._processes = list(self._processes), set()
+            self._started = 0
+        self._idle = queue.Queue()
+        for process in processes:
+            process.close()
+
+    def stats(self):
+        return {
+            'size': self.size,
+            'processes': self._started,
+            'dispatched': self.dispatched,
+            'fallbacks': self.fallbacks,
+            'restarts': self.restarts,
+        }
+
+
+match_pool = MatchPool()
+atexit.register(match_pool.close)
+
+
+class PooledMatcher(Matcher):
+    """把匹配交给 match_pool 的匹配器，inner 为匹配进程中实际使用的匹配器"""
+
+    def __init__(self, inner=None):
+        super().__init__()
+        self.inner = inner or getattr(settings, 'TEMPLATE_MATCHER', 'airtest')
+        self.name = f"{self.inner}@process"
+        self._local = None
+
+    def match(self, frame, templates, best=False):
+        result = match_pool.match(self.inner, frame, templates, best)
+        if result is not None:
+            index, pos, matches = result
+            self.matches += matches
+            return index, pos
+
+        if self._local is None:
+            self._local = create_matcher(self.inner, execution='inline')
+        before = self._local.matches
+        index, pos = self._local.match(frame, templates, best)
+        self.matches += self._local.matches - before
+        return index, pos
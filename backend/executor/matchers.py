@@ -0,0 +1,189 @@
+"""
+模板匹配引擎。
+
+FramePoller 通过匹配器把一帧画面与一个或多个模板（CachedTemplate）进行匹配，
+使用哪种匹配器由 TEMPLATE_MATCHER 决定：
+
+- airtest（默认）：逐个模板走 Airtest 自身的匹配流程（Template._cv_match），与 touch / exists 行为一致；
+- pyramid：每帧只做一次灰度转换并按需构建图像金字塔，供所有模板共用。每个模板先在金字塔的
+  粗糙层上做一次 TM_CCOEFF_NORMED 匹配，取得分最高的几个候选位置，再回到精细层，只在候选位置
+  附近的小窗口内确认并取置信度最高者，置信度阈值取各模板自身的 threshold。
+  region / match_scale / 分辨率预缩放同样生效。
+
+每个 FramePoller 持有自己的匹配器实例，matches 统计参与匹配的模板次数。
+MATCH_EXECUTION 为 'process' 时，以上匹配器在独立的匹配进程中运行，见 match_pool.py。
+"""
+import math
+import numpy as np
+from airtest.aircv import cv2
+from airtest.utils.transform import TargetPos
+from django.conf import settings
+from .template_cache import template_cache
+
+
+class Matcher:
+    name = None
+
+    def __init__(self):
+        self.matches = 0
+
+    def prepare(self, frame):
+        """每帧调用一次，返回值传给 match_one，供所有模板共用"""
+        return frame
+
+    def match_one(self, prepared, template):
+        """返回 Airtest 格式的匹配结果 {'result', 'rectangle', 'confidence'}，未命中时返回 None"""
+        raise NotImplementedError
+
+    def match(self, frame, templates, best=False):
+        """
+        返回 (模板下标, 坐标)，没有命中时返回 (None, None)。
+        best 为 False 时按顺序返回第一个命中的模板，为 True 时返回置信度最高的模板。
+        """
+        prepared = self.prepare(frame)
+        best_index, best_result = None, None
+        for index, template in enumerate(templates):
+            self.matches += 1
+            result = self.match_one(prepared, template)
+            if not result:
+                continue
+            if not best:
+                return index, TargetPos().getXY(result, template.target_pos)
+            if best_result is None or result['confidence'] > best_result['confidence']:
+                best_index, best_result = index, result
+        if best_result is None:
+            return None, None
+        return best_index, TargetPos().getXY(best_result, templates[best_index].target_pos)
+
+
+class AirtestMatcher(Matcher):
+    name = 'airtest'
+
+    def match_one(self, frame, template):
+        return template._cv_match(frame)
+
+
+class FramePyramid:
+    """一帧画面的灰度金字塔，level(k) 为原图缩小 2**k 倍，用到时才生成"""
+
+    def __init__(self, frame):
+        self.levels = [cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame]
+        self.height, self.width = self.levels[0].shape[:2]
+
+    def level(self, k):
+        while len(self.levels) <= k:
+            self.levels.append(cv2.pyrDown(self.levels[-1]))
+        return self.levels[k]
+
+
+def _best_locations(image, template, count=1):
+    """
+    TM_CCOEFF_NORMED 匹配，按得分从高到低返回最多 count 个 (置信度, 左上角坐标)，
+    相邻候选之间至少相距半个模板大小。图像比模板小时返回空列表。
+    """
+    if image.shape[0] < template.shape[0] or image.shape[1] < template.shape[1]:
+        return []
+    result = cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED)
+    # 纯色模板的归一化相关系数没有意义
+    result[~np.isfinite(result)] = -1
+    half_h, half_w = max(template.shape[0] // 2, 1), max(template.shape[1] // 2, 1)
+    locations = []
+    for _ in range(count):
+        _, confidence, _, (x, y) = cv2.minMaxLoc(result)
+        if confidence <= 0:
+            break
+        locations.append((confidence, (x, y)))
+        result[max(y - half_h, 0):y + half_h + 1, max(x - half_w, 0):x + half_w + 1] = -1
+    return locations
+
+
+class PyramidMatcher(Matcher):
+    name = 'pyramid'
+
+    def __init__(self):
+        super().__init__()
+        # 粗糙层上模板的短边不小于该像素数，否则特征太少、定位不可靠
+        self.min_template_size = getattr(settings, 'MATCHER_PYRAMID_MIN_TEMPLATE_SIZE', 24)
+        self.max_level = getattr(settings, 'MATCHER_PYRAMID_MAX_LEVEL', 3)
+        # 粗糙层上保留的候选位置数，画面中有多个相似元素时由精细层选出最佳者
+        self.candidates = getattr(settings, 'MATCHER_PYRAMID_CANDIDATES', 3)
+        self.pyramids_built = 0
+
+    def prepare(self, frame):
+        self.pyramids_built += 1
+        return FramePyramid(frame)
+
+    def match_one(self, pyramid, template):
+        options = template.match_options
+        base_scale = template.resolution_scale or 1
+        match_scale = options.scale if options is not None else 1
+        if options is not None and options.region is not None:
+            left, top, right, bottom = options.region.box(pyramid.width, pyramid.height)
+        else:
+            left, top, right, bottom = 0, 0, pyramid.width, pyramid.height
+
+        # 精细层对应 match_scale（取不比它更粗的金字塔层），粗糙层在模板足够大时尽量往上取
+        fine = max(int(math.floor(math.log2(1 / match_scale) + 1e-9)), 0)
+        template_side = min(template_cache.get(template.filepath).gray.shape[:2]) * base_scale
+        coarse = fine
+        while coarse < self.max_level and template_side / 2 ** (coarse + 1) >= self.min_template_size:
+            coarse += 1
+
+        factor = 0.5 ** coarse
+        image = pyramid.level(coarse)[round(top * factor):round(bottom * factor),
+                                      round(left * factor):round(right * factor)]
+        tmpl = template_cache.get_scaled(template.filepath, base_scale * factor, gray=True)
+        locations = _best_locations(image, tmpl, 1 if coarse == fine else self.candidates)
+        if not locations:
+            return None
+        confidence, (x, y) = locations[0]
+        x, y = x / factor + left, y / factor + top
+
+        if coarse != fine:
+            # 回到精细层，在每个粗定位结果周围几个像素的窗口内确认，取置信度最高者
+            coarse_factor, factor = factor, 0.5 ** fine
+            fine_image = pyramid.level(fine)
+            tmpl = template_cache.get_scaled(template.filepath, base_scale * factor, gray=True)
+            margin = 2 ** (coarse - fine) * 2
+            confidence = None
+            for _, (cx, cy) in locations:
+                cx, cy = (cx / coarse_factor + left) * factor, (cy / coarse_factor + top) * factor
+                x0 = max(round(cx) - margin, round(left * factor))
+                y0 = max(round(cy) - margin, round(top * factor))
+                x1 = min(round(cx) + tmpl.shape[1] + margin, round(right * factor))
+                y1 = min(round(cy) + tmpl.shape[0] + margin, round(bottom * factor))
+                refined = _best_locations(fine_image[y0:y1, x0:x1], tmpl)
+                if refined and (confidence is None or refined[0][0] > confidence):
+                    confidence = refined[0][0]
+                    x, y = (refined[0][1][0] + x0) / factor, (refined[0][1][1] + y0) / factor
+            if confidence is None:
+                return None
+
+        if confidence < template.threshold:
+            return None
+        width, height = tmpl.shape[1] / factor, tmpl.shape[0] / factor
+        x_max, y_max = round(x + width), round(y + height)
+        x, y = round(x), round(y)
+        return {
+            'result': (round(x + width / 2), round(y + height / 2)),
+            'rectangle': ((x, y), (x, y_max), (x_max, y_max), (x_max, y)),
+            'confidence': confidence,
+        }
+
+
+MATCHERS = {
+    'airtest': AirtestMatcher,
+    'pyramid': PyramidMatcher,
+}
+
+
+def create_matcher(name=None, execution=None):
+    """
+    按名称（默认取 TEMPLATE_MATCHER）创建一个匹配器实例。
+    execution（默认取 MATCH_EXECUTION）为 'process' 时，匹配交给 match_pool.py 中的匹配进程池。
+    """
+    name = name or getattr(settings, 'TEMPLATE_MATCHER', 'airtest')
+    if (execution or getattr(settings, 'MATCH_EXECUTION', 'inline')) == 'process':
+        from .match_pool import PooledMatcher
+        return PooledMatcher(name)
+    return MATCHERS[name]()
@@ -0,0 +1,393 @@
+"""
+执行器指标：按脚本、动作类型和设备统计的耗时直方图与计数器，以及模板缓存等进程内状态的
+当前值（gauge），以 Prometheus 文本格式导出。
+
+每个进程持有一份 registry，指标只在内存中累加：
+- Celery worker 启动时调用 start_worker_exporter()：METRICS_WORKER_PORT 不为空时开启一个只读的
+  HTTP 端口（/metrics），供 Prometheus 直接抓取本进程；并每隔 METRICS_PUSH_INTERVAL 秒把本进程
+  的指标快照写入 Redis。prefork 执行池的多个子进程中只有第一个能绑定端口，其余只写 Redis。
+- Django 的 /api/metrics/ 把本进程的指标与 Redis 中各 worker 未过期的快照合并（同名、同标签的
+  样本相加）后导出，抓取这一个地址即可比较整个设备集群中的慢脚本和慢设备。
+- 超过 3 个推送周期没有更新的 worker 视为已退出，它的快照并入 RETIRED_KEY 中的累计快照后删除，
+  合并时始终计入，因此 worker 退出或重启不会让汇总后的计数器变小。已被并入的 worker 重新推送时
+  先清零本进程的指标，避免重复计数。只有 Django 进程自身的指标会随 Django 重启归零。
+  gauge 是当前值而不是累计量：汇总时各 worker 相加（如所有 worker 的模板缓存总字节数），
+  已退出 worker 的 gauge 不并入累计快照，清零时也保留本进程的当前值。
+
+两个导出地址都只允许 METRICS_ALLOWED_IPS 中的地址访问，或在 Authorization 头中携带
+Bearer METRICS_TOKEN。
+"""
+import bisect
+import hmac
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import redis
+from django.conf import settings
+from .redis_client import get_redis
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SNAPSHOTS_KEY = 'autoplay:metrics:workers'
+RETIRED_KEY = 'autoplay:metrics:retired'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+MATCH_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Metric:
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        unknown = set(labels) - set(self.labelnames)
+        if unknown:
+            raise ValueError(f"指标 {self.name} 没有标签: {', '.join(sorted(unknown))}")
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            samples = [[list(key), self._dump(value)] for key, value in self._values.items()]
+        return {'type': self.metric_type, 'help': self.documentation, 'labelnames': list(self.labelnames),
+                'samples': samples}
+
+    def _dump(self, value):
+        return value
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def reset(self):
+        # 当前值不随累计值清零
+        pass
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [各区间的计数（非累计）, 总和, 总数]
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """记录 with 块的耗时；块内可修改 yield 出的标签字典（如按执行结果补充 result）"""
+        labels = dict(labels)
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        data = super().snapshot()
+        data['buckets'] = list(self.buckets)
+        return data
+
+    def _dump(self, state):
+        return [list(state[0]), state[1], state[2]]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def snapshot(self):
+        """可 JSON 序列化的指标快照，用于跨进程合并"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def reset(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.reset()
+
+
+def merge_snapshots(snapshots):
+    """把多个进程的快照合并为一个：同名、同标签的计数器、gauge 和直方图逐项相加"""
+    merged = {}
+    for snapshot in snapshots:
+        for name, family in snapshot.items():
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = {key: value for key, value in family.items() if key != 'samples'}
+                target['samples'] = {}
+            elif (target['type'], target['labelnames'], target.get('buckets')) != \
+                    (family['type'], family['labelnames'], family.get('buckets')):
+                # 不同版本的代码定义不一致，无法相加
+                print(f"指标 {name} 的定义不一致，已跳过一份快照")
+                continue
+            samples = target['samples']
+            for labelvalues, value in family['samples']:
+                key = tuple(labelvalues)
+                current = samples.get(key)
+                if current is None:
+                    samples[key] = value
+                elif family['type'] == 'histogram':
+                    samples[key] = [[a + b for a, b in zip(current[0], value[0])],
+                                    current[1] + value[1], current[2] + value[2]]
+                else:
+                    samples[key] = current + value
+    for family in merged.values():
+        family['samples'] = [[list(key), value] for key, value in family['samples'].items()]
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def render(snapshot):
+    """Prometheus 文本格式（0.0.4）"""
+    lines = []
+    for name in sorted(snapshot):
+        family = snapshot[name]
+        names = family['labelnames']
+        lines.append(f"# HELP {name} {_escape(family['help'])}")
+        lines.append(f"# TYPE {name} {family['type']}")
+        for labelvalues, value in sorted(family['samples']):
+            if family['type'] != 'histogram':
+                lines.append(f"{name}{_format_labels(names, labelvalues)} {_format_value(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(family['buckets'], counts):
+                cumulative += bucket_count
+                labels = _format_labels(names, labelvalues, [('le', _format_value(float(bound)))])
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(names, labelvalues, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(names, labelvalues)} {_format_value(float(total))}")
+            lines.append(f"{name}_count{_format_labels(names, labelvalues)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+NODE_SECONDS = registry.histogram(
+    'autoplay_node_seconds', "单个节点的执行耗时（含子节点和 validate）",
+    ('script', 'node_type', 'action', 'device', 'result'))
+ACTION_SECONDS = registry.histogram(
+    'autoplay_action_seconds', "动作本身的执行耗时（含动作级重试，不含 validate）",
+    ('script', 'action', 'device', 'result'))
+MATCH_SECONDS = registry.histogram(
+    'autoplay_match_seconds', "一帧画面与一组模板匹配一次的耗时",
+    ('script', 'device', 'matcher'), MATCH_BUCKETS)
+VALIDATE_WAIT_SECONDS = registry.histogram(
+    'autoplay_validate_wait_seconds', "validate 等待目标出现的耗时",
+    ('script', 'device', 'result'))
+RETRIES = registry.counter(
+    'autoplay_retries_total', "重试次数：action 为动作级重试，step 为 validate 失败后的整步重试",
+    ('script', 'action', 'device', 'kind'))
+LOG_IO_SECONDS = registry.histogram(
+    'autoplay_log_io_seconds', "TaskLogger 写库和广播的耗时",
+    ('script', 'device', 'operation'), MATCH_BUCKETS)
+TASK_SECONDS = registry.histogram(
+    'autoplay_task_seconds', "任务从开始处理到结束的耗时（含排队等待设备）",
+    ('script', 'device', 'status'))
+TEMPLATE_CACHE_HITS = registry.counter(
+    'autoplay_template_cache_hits_total', "模板缓存命中次数")
+TEMPLATE_CACHE_MISSES = registry.counter(
+    'autoplay_template_cache_misses_total', "模板缓存未命中、从磁盘解码的次数（reason 为 reload 表示文件已被替换）",
+    ('reason',))
+TEMPLATE_CACHE_EVICTIONS = registry.counter(
+    'autoplay_template_cache_evictions_total', "模板缓存超出 TEMPLATE_CACHE_MAX_BYTES 后淘汰的图片数")
+TEMPLATE_CACHE_BYTES = registry.gauge(
+    'autoplay_template_cache_bytes', "模板缓存当前占用的字节数（含缩放后的模板）")
+TEMPLATE_CACHE_ENTRIES = registry.gauge(
+    'autoplay_template_cache_entries', "模板缓存当前保存的图片数")
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+_published = False
+
+
+def publish_snapshot():
+    """把本进程的指标快照写入 Redis，供 Django 汇总"""
+    global _published
+    client = get_redis()
+    if _published and not client.hexists(SNAPSHOTS_KEY, worker_id()):
+        # 本进程曾长时间未能推送，已被视为退出，之前的累计值已并入 RETIRED_KEY，从零重新累计
+        print("指标快照已被并入已退出 worker 的累计值，本进程的指标清零后重新累计")
+        registry.reset()
+    payload = json.dumps({'at': time.time(), 'metrics': registry.snapshot()})
+    client.hset(SNAPSHOTS_KEY, worker_id(), payload)
+    _published = True
+
+
+def worker_snapshots():
+    """
+    Redis 中已退出 worker 的累计快照和各 worker 的快照。
+    超过 3 个推送周期没有更新的 worker 视为已退出，其快照并入累计快照后删除。
+    """
+    max_age = getattr(settings, 'METRICS_PUSH_INTERVAL', 15) * 3
+    with get_redis().pipeline() as pipe:
+        # 多个 Django 进程可能同时发现同一个过期快照，WATCH 保证只有一个进程把它并入累计快照
+        pipe.watch(SNAPSHOTS_KEY, RETIRED_KEY)
+        payloads = pipe.hgetall(SNAPSHOTS_KEY)
+        retired = pipe.get(RETIRED_KEY)
+        retired = json.loads(retired) if retired else {}
+        now = time.time()
+        snapshots, stale = [], {}
+        for worker, payload in payloads.items():
+            data = json.loads(payload)
+            if now - data['at'] > max_age:
+                stale[worker] = data['metrics']
+            else:
+                snapshots.append(data['metrics'])
+        if stale:
+            # 已退出 worker 的 gauge 不再是任何进程的当前值，不并入累计快照
+            merged = merge_snapshots([retired, *({name: family for name, family in metrics.items()
+                                                   if family['type'] != 'gauge'} for metrics in stale.values())])
+            try:
+                pipe.multi()
+                pipe.set(RETIRED_KEY, json.dumps(merged))
+                pipe.hdel(SNAPSHOTS_KEY, *stale)
+                pipe.execute()
+                retired = merged
+            except redis.WatchError:
+                # 期间有其他进程写入，本次照常计入这些快照，下次读取时再并入
+                snapshots.extend(stale.values())
+    return [retired] + snapshots
+
+
+def is_authorized(remote_addr, authorization):
+    """来源地址在 METRICS_ALLOWED_IPS 中，或 Authorization 头为 Bearer METRICS_TOKEN"""
+    if remote_addr in getattr(settings, 'METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')):
+        return True
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    return bool(token) and hmac.compare_digest((authorization or '').encode(), f"Bearer {token}".encode())
+
+
+def farm_snapshot():
+    """本进程与所有 worker 合并后的快照；Redis 不可用时只返回本进程的指标"""
+    snapshots = [registry.snapshot()]
+    try:
+        snapshots.extend(worker_snapshots())
+    except Exception as e:
+        print(f"读取 worker 指标快照失败: {e}")
+    return merge_snapshots(snapshots)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        if not is_authorized(self.client_address[0], self.headers.get('Authorization')):
+            self.send_error(403)
+            return
+        body = render(registry.snapshot()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取很频繁，不打印访问日志
+        pass
+
+
+_started_pid = None
+
+
+def start_worker_exporter():
+    """在 worker 进程中启动导出端口和快照推送线程；同一进程重复调用无效"""
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    _started_pid = os.getpid()
+
+    port = getattr(settings, 'METRICS_WORKER_PORT', None)
+    if port:
+        try:
+            server = ThreadingHTTPServer((getattr(settings, 'METRICS_WORKER_HOST', ''), port), _MetricsHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='metrics-exporter', daemon=True).start()
+            print(f"指标导出端口已启动: {port}")
+        except OSError as e:
+            print(f"指标导出端口 {port} 不可用，只通过 Redis 汇总: {e}")
+
+    interval = getattr(settings, 'METRICS_PUSH_INTERVAL', 15)
+    if interval:
+        threading.Thread(target=_run_publisher, args=(interval,), name='metrics-publisher', daemon=True).start()
+
+
+def _run_publisher(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            publish_snapshot()
+        except Exception as e:
+            print(f"推送指标快照失败: {e}")
@@ -0,0 +1,119 @@
+"""
+基于画面变化的自适应轮询。
+
+validate 和条件判断需要反复截图、反复做模板匹配。FramePoller 为每一帧计算一个很小的
+灰度缩略图作为签名：画面与上次匹配时相比没有变化就跳过匹配，并逐步拉长轮询间隔；
+画面一旦变化立即匹配，并把间隔恢复到最短。
+变化按格判断：缩略图中任意一格的灰度差超过 POLL_CHANGE_THRESHOLD 即视为变化，整帧的平均差
+会把小按钮、小图标的出现平摊到几乎为零。即使判断为没有变化，距上次匹配超过 POLL_MAX_INTERVAL
+秒也会重新匹配一次，避免漏掉阈值以下的变化。
+"""
+import threading
+import time
+import numpy as np
+from airtest.aircv import cv2
+from airtest.core.settings import Settings as ST
+from django.conf import settings
+from .matchers import create_matcher
+from .metrics import MATCH_SECONDS
+
+SIGNATURE_SIZE = (64, 64)
+
+
+def frame_signature(frame):
+    """把一帧缩成 64x64 的灰度图，作为判断画面是否变化的签名"""
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    return cv2.resize(gray, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+class FramePoller:
+    def __init__(self, device, cancel_token=None, matcher=None, metric_labels=None):
+        self.device = device
+        self.cancel_token = cancel_token
+        # 模板匹配引擎，默认按 TEMPLATE_MATCHER 创建，见 matchers.py
+        self.matcher = matcher or create_matcher()
+        # 匹配耗时指标的标签 {'script', 'device'}
+        self.metric_labels = dict(metric_labels or {}, matcher=self.matcher.name)
+        self.min_interval = getattr(settings, 'POLL_MIN_INTERVAL', 0.2)
+        self.max_interval = getattr(settings, 'POLL_MAX_INTERVAL', 1.0)
+        self.backoff = getattr(settings, 'POLL_BACKOFF', 1.5)
+        self.change_threshold = getattr(settings, 'POLL_CHANGE_THRESHOLD', 12)
+        # 最近一次截到的画面，可供其他功能复用（手动截图、实时画面）
+        self._capture_lock = threading.Lock()
+        self.last_frame = None
+        self.last_frame_at = 0
+        self.frames_captured = 0
+        self.matches_skipped = 0
+
+    def capture(self):
+        # 推流线程与执行线程可能同时截图，同一设备的截图串行进行
+        with self._capture_lock:
+            frame = self.device.snapshot(filename=None, quality=ST.SNAPSHOT_QUALITY)
+            if frame is not None:
+                self.last_frame = frame
+                self.last_frame_at = time.monotonic()
+                self.frames_captured += 1
+        return frame
+
+    def is_changed(self, signature, previous_signature):
+        if previous_signature is None:
+            return True
+        # 每一格是原画面一小块区域的平均灰度，取各格差值的最大值
+        return int(np.max(np.abs(signature - previous_signature))) > self.change_threshold
+
+    def wait_for(self, template, timeout):
+        """
+        在 timeout 秒内等待 template 出现，返回匹配到的坐标；超时返回 None。
+        至少会截图并匹配一次，因此 timeout 为 0 时相当于单次检查。
+        """
+        return self.wait_for_any((template,), timeout)[1]
+
+    def wait_for_any(self, templates, timeout, best=False):
+        """
+        在 timeout 秒内等待任意一个模板出现，返回 (模板下标, 坐标)；超时返回 (None, None)。
+        每次只截一帧，所有模板都与这一帧匹配：best 为 False 时按顺序返回第一个命中的模板，
+        为 True 时返回置信度最高的模板。
+        """
+        deadline = time.monotonic() + timeout
+        interval = self.min_interval
+        matched_signature = None
+        matched_at = None
+        while True:
+            if self.cancel_token:
+                self.cancel_token()
+
+            frame = self.capture()
+            if frame is not None:
+                signature = frame_signature(frame)
+                if (self.is_changed(signature, matched_signature)
+                        or time.monotonic() - matched_at >= self.max_interval):
+                    with MATCH_SECONDS.time(**self.metric_labels):
+                        index, match_pos = self.matcher.match(frame, templates, best)
+                    if match_pos:
+                        return index, match_pos
+                    matched_signature = signature
+                    matched_at = time.monotonic()
+                    interval = self.min_interval
+                else:
+                    # 画面没有变化，匹配结果也不会变化，放慢轮询
+                    self.matches_skipped += len(templates)
+                    interval = min(interval * self.backoff, self.max_interval)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None, None
+            self._sleep(min(interval, remaining))
+
+    def _sleep(self, seconds):
+        if self.cancel_token:
+            self.cancel_token.sleep(seconds)
+        else:
+            time.sleep(seconds)
+
+    def stats(self):
+        return {
+            'frames': self.frames_captured,
+            'matcher': self.matcher.name,
+            'matches': self.matcher.matches,
+            'skipped': self.matches_skipped,
+        }
@@ -0,0 +1,13 @@
+import redis
+from django.conf import settings
+
+_redis_client = None
+
+
+def get_redis():
+    """进程内共享的 Redis 客户端（连接池由 redis-py 自行维护），用于任务控制信号和设备调度"""
+    global _redis_client
+    if _redis_client is None:
+        redis_url = getattr(settings, 'TASK_CONTROL_REDIS_URL', None) or settings.CELERY_BROKER_URL
+        _redis_client = redis.Redis.from_url(redis_url)
+    return _redis_client
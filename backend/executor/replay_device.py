@@ -0,0 +1,103 @@
+"""
+回放录制画面的测试设备，用于在没有真机的环境下运行脚本和基准测试。
+
+注册为 Airtest 自定义设备后（见 devices.register_test_devices），通过 URI 使用（目录为相对 BASE_DIR
+的路径，且必须位于 REPLAY_ROOT 之内）：
+    ReplayDevice:///benchmarks/replays/settings_flow?loop=1&interval=0
+
+目录中的图片按文件名排序，依次作为设备画面。默认每次触控、滑动或输入都前进到下一帧，
+模拟"操作后界面跳转"；interval 大于 0 时画面还会每隔 interval 秒自动前进。
+播放到最后一帧后，loop 为 1 时回到第一帧，否则停留在最后一帧。
+"""
+import glob
+import os
+import threading
+import time
+from airtest import aircv
+from airtest.core.device import Device
+from airtest.core.helper import G
+from django.conf import settings
+
+IMAGE_PATTERNS = ('*.png', '*.jpg', '*.jpeg')
+# 只允许回放这个目录下的录制画面
+REPLAY_ROOT = os.path.join(settings.BASE_DIR, 'benchmarks', 'replays')
+
+# 同一目录的画面在进程内只解码一次，设备重连时复用
+_frames_cache = {}
+_frames_lock = threading.Lock()
+
+
+def resolve_directory(directory):
+    """回放目录的真实路径；解析符号链接和 .. 之后不在 REPLAY_ROOT 之内时抛出 ValueError"""
+    root = os.path.realpath(REPLAY_ROOT)
+    directory = os.path.realpath(os.path.join(settings.BASE_DIR, directory))
+    if os.path.commonpath([root, directory]) != root:
+        raise ValueError(f"回放目录必须位于 {root} 之内")
+    return directory
+
+
+def load_frames(directory):
+    directory = resolve_directory(directory)
+    with _frames_lock:
+        frames = _frames_cache.get(directory)
+        if frames is None:
+            paths = sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(directory, pattern)))
+            if not paths:
+                raise FileNotFoundError(f"回放目录 {directory} 中没有图片")
+            frames = _frames_cache[directory] = tuple(aircv.imread(path) for path in paths)
+        return frames
+
+
+class ReplayDevice(Device):
+    def __init__(self, serialno=None, loop=1, interval=0, **kwargs):
+        super().__init__()
+        self.serialno = serialno or ''
+        self.frames = load_frames(self.serialno)
+        self.loop = str(loop) not in ('0', 'false', 'False')
+        self.interval = float(interval)
+        self.index = 0
+        self.changed_at = time.monotonic()
+        self.operations = []
+
+    @property
+    def uuid(self):
+        return self.serialno
+
+    def _advance(self):
+        if self.index + 1 < len(self.frames):
+            self.index += 1
+        elif self.loop:
+            self.index = 0
+        self.changed_at = time.monotonic()
+
+    def snapshot(self, filename=None, quality=10, max_size=None, **kwargs):
+        if self.interval > 0:
+            for _ in range(int((time.monotonic() - self.changed_at) / self.interval)):
+                self._advance()
+        # 缓存中的画面由所有回放设备共享，调用方可能就地修改截图，返回副本
+        frame = self.frames[self.index].copy()
+        if filename:
+            aircv.imwrite(filename, frame, quality, max_size=max_size)
+        return frame
+
+    def touch(self, pos, **kwargs):
+        self.operations.append(('touch', tuple(pos)))
+        self._advance()
+
+    def swipe(self, p1, p2, **kwargs):
+        self.operations.append(('swipe', tuple(p1), tuple(p2)))
+        self._advance()
+
+    def text(self, text, enter=True, **kwargs):
+        self.operations.append(('text', text))
+        self._advance()
+
+    def get_current_resolution(self):
+        height, width = self.frames[self.index].shape[:2]
+        return width, height
+
+    def disconnect(self):
+        pass
+
+
+G.register_custom_device(ReplayDevice)
@@ -0,0 +1,103 @@
+"""
+已结束任务的保留策略。
+
+purge_tasks() 删除结束超过 TASK_RETENTION_DAYS 天的任务，连同它们的日志行、日志归档（见 log_archive.py）
+和旧版截图目录 MEDIA_ROOT/task_logs/<任务ID>。为了不长时间锁表、不集中产生大量 I/O：
+- 每批最多处理 TASK_PURGE_BATCH_SIZE 个任务，日志行按 TASK_PURGE_LOG_CHUNK_SIZE 行分块删除；
+- 每批提交后才删除对应的文件，批次之间暂停 TASK_PURGE_PAUSE 秒。
+截图存储（screenshots/）中的截图按画面内容共享，由 screenshot_store.prune() 按自己的保留策略清理。
+"""
+import os
+import shutil
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .log_archive import FINISHED_STATUSES, get_archive_store
+
+LEGACY_MEDIA_DIR = 'task_logs'
+
+
+def _cutoff(max_age_days):
+    return timezone.now() - timedelta(days=max_age_days)
+
+
+def purgeable_tasks(max_age_days):
+    """已结束超过 max_age_days 天的任务；没有结束时间的旧任务按创建时间计算"""
+    from api.models import Task
+
+    cutoff = _cutoff(max_age_days)
+    return (Task.objects
+            .filter(status__in=FINISHED_STATUSES)
+            .filter(Q(completed_at__lt=cutoff) | Q(completed_at__isnull=True, created_at__lt=cutoff))
+            .order_by('id'))
+
+
+def _delete_log_entries(task_ids, chunk_size):
+    """分块删除日志行，每块一条短小的 DELETE，返回删除的行数"""
+    from api.models import TaskLogEntry
+
+    deleted = 0
+    while True:
+        entry_ids = list(TaskLogEntry.objects.filter(task_id__in=task_ids).values_list('id', flat=True)[:chunk_size])
+        if not entry_ids:
+            return deleted
+        deleted += TaskLogEntry.objects.filter(id__in=entry_ids).delete()[0]
+
+
+def _delete_task_files(task_id, archive_key):
+    removed = 0
+    if archive_key:
+        get_archive_store().delete(archive_key)
+        removed += 1
+    media_dir = os.path.join(settings.MEDIA_ROOT, LEGACY_MEDIA_DIR, str(task_id))
+    if os.path.isdir(media_dir):
+        shutil.rmtree(media_dir, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def purge_tasks(max_age_days=None, limit=None):
+    """
+    按保留策略删除任务，返回 (删除的任务数, 删除的日志行数, 删除的归档文件和截图目录数)。
+    max_age_days 为 None 时取 TASK_RETENTION_DAYS，两者都为空时不删除任何任务。
+    """
+    from api.models import Task, TaskBatch
+
+    if max_age_days is None:
+        max_age_days = getattr(settings, 'TASK_RETENTION_DAYS', None)
+    if max_age_days is None:
+        return 0, 0, 0
+
+    batch_size = getattr(settings, 'TASK_PURGE_BATCH_SIZE', 200)
+    chunk_size = getattr(settings, 'TASK_PURGE_LOG_CHUNK_SIZE', 5000)
+    pause = getattr(settings, 'TASK_PURGE_PAUSE', 0.5)
+    tasks_deleted = rows_deleted = files_deleted = 0
+
+    while limit is None or tasks_deleted < limit:
+        size = batch_size if limit is None else min(batch_size, limit - tasks_deleted)
+        batch = list(purgeable_tasks(max_age_days).values_list('id', 'log_archive')[:size])
+        if not batch:
+            break
+        task_ids = [task_id for task_id, _ in batch]
+
+        rows_deleted += _delete_log_entries(task_ids, chunk_size)
+        with transaction.atomic():
+            # 日志行已删除，这里只剩任务本身
+            tasks_deleted += Task.objects.filter(id__in=task_ids).delete()[1].get(Task._meta.label, 0)
+
+        # 数据库中的记录删除后才删文件：中途失败只会留下无主文件，不会留下指向已删除文件的任务
+        for task_id, archive_key in batch:
+            try:
+                files_deleted += _delete_task_files(task_id, archive_key)
+            except OSError as e:
+                print(f"删除任务 #{task_id} 的文件失败: {e}")
+
+        if len(batch) == size and pause:
+            time.sleep(pause)
+
+    # 任务全部被删除的批次也一并删除
+    TaskBatch.objects.filter(created_at__lt=_cutoff(max_age_days), tasks__isnull=True).delete()
+    return tasks_deleted, rows_deleted, files_deleted
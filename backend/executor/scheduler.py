@@ -0,0 +1,294 @@
+"""
+设备调度。
+
+同一台设备同一时刻只允许一个任务使用，不同设备的任务互不影响、并行执行。
+任务开始执行前先取得设备租约：
+
+* redis 后端：每台设备一个 owner 键（SET NX PX），持有者在后台线程中定期续期，
+  worker 崩溃后租约最多 DEVICE_LEASE_TTL 秒后自动失效；等待者按入队时间排在
+  每台设备的 ZSET 队列中，只有队首才能尝试获取租约，保证先到先得。
+  每个等待者还有一个带过期时间的心跳键，崩溃的等待者会被自动移出队列。
+* local 后端：只在当前 worker 进程内互斥，供开发和单进程部署使用。
+
+两个后端都记录每台设备的排队深度和等待时间，见 stats()。
+"""
+import threading
+import time
+from collections import deque
+import redis
+from django.conf import settings
+from .redis_client import get_redis
+
+DEVICE_KEY_PREFIX = 'autoplay:device:'
+DEVICES_KEY = 'autoplay:devices'
+
+# 只有租约仍属于自己时才续期 / 删除，避免误操作已被他人取得的租约
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def device_key(device_uri, suffix):
+    return f"{DEVICE_KEY_PREFIX}{device_uri}:{suffix}"
+
+
+class DeviceLease:
+    """一台设备的使用权，可作为上下文管理器使用，退出时释放"""
+
+    def __init__(self, manager, device_uri, owner, wait_time):
+        self.manager = manager
+        self.device_uri = device_uri
+        self.owner = owner
+        self.wait_time = wait_time
+        # 通知续期线程停止
+        self.stop_event = threading.Event()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.manager.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class _DeviceStats:
+    """单台设备的租约与等待时间统计"""
+    __slots__ = ('leases', 'total_wait', 'max_wait', 'last_wait')
+
+    def __init__(self):
+        self.leases = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.last_wait = 0.0
+
+    def record(self, wait_time):
+        self.leases += 1
+        self.total_wait += wait_time
+        self.max_wait = max(self.max_wait, wait_time)
+        self.last_wait = wait_time
+
+
+def _device_summary(device_uri, owner, waiting, leases, total_wait, max_wait, last_wait):
+    return {
+        'device_uri': device_uri,
+        'owner_task_id': owner,
+        'queue_depth': len(waiting),
+        'waiting': waiting,
+        'leases': leases,
+        'avg_wait_seconds': round(total_wait / leases, 2) if leases else 0,
+        'max_wait_seconds': round(max_wait, 2),
+        'last_wait_seconds': round(last_wait, 2),
+    }
+
+
+def _wait(seconds, cancel_token=None):
+    if cancel_token:
+        cancel_token.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+class RedisDeviceLeaseManager:
+    def __init__(self):
+        self._renew = None
+        self._release = None
+
+    @property
+    def ttl_ms(self):
+        return int(getattr(settings, 'DEVICE_LEASE_TTL', 60) * 1000)
+
+    @property
+    def poll_interval(self):
+        return getattr(settings, 'DEVICE_LEASE_POLL_INTERVAL', 1.0)
+
+    def _scripts(self):
+        if self._renew is None:
+            client = get_redis()
+            self._renew = client.register_script(RENEW_SCRIPT)
+            self._release = client.register_script(RELEASE_SCRIPT)
+        return self._renew, self._release
+
+    def acquire(self, device_uri, task_id, cancel_token=None, on_wait=None):
+        """
+        阻塞直到取得 device_uri 的租约。等待期间任务被取消时抛出 InterruptedError 并退出队列。
+        第一次需要等待时调用 on_wait(前面排队的任务数, 当前持有者)。
+        """
+        client = get_redis()
+        owner = str(task_id)
+        owner_key = device_key(device_uri, 'owner')
+        queue_key = device_key(device_uri, 'queue')
+        waiter_key = device_key(device_uri, f'waiter:{owner}')
+        enqueued_at = time.time()
+
+        client.sadd(DEVICES_KEY, device_uri)
+        client.zadd(queue_key, {owner: enqueued_at}, nx=True)
+        notified = False
+        try:
+            while True:
+                client.set(waiter_key, 1, px=self.ttl_ms)
+                if self._queue_head(client, device_uri) == owner and \
+                        client.set(owner_key, owner, nx=True, px=self.ttl_ms):
+                    break
+                if not notified and on_wait:
+                    notified = True
+                    holder = client.get(owner_key)
+                    on_wait(client.zrank(queue_key, owner) or 0, holder.decode() if holder else None)
+                _wait(self.poll_interval, cancel_token)
+        finally:
+            client.zrem(queue_key, owner)
+            client.delete(waiter_key)
+
+        wait_time = time.time() - enqueued_at
+        stats_key = device_key(device_uri, 'stats')
+        pipe = client.pipeline()
+        pipe.hincrby(stats_key, 'leases', 1)
+        pipe.hincrbyfloat(stats_key, 'total_wait', wait_time)
+        pipe.hset(stats_key, 'last_wait', wait_time)
+        pipe.execute()
+        if wait_time > float(client.hget(stats_key, 'max_wait') or 0):
+            client.hset(stats_key, 'max_wait', wait_time)
+
+        lease = DeviceLease(self, device_uri, owner, wait_time)
+        threading.Thread(target=self._heartbeat, args=(lease,), name=f'device-lease-{owner}', daemon=True).start()
+        return lease
+
+    def _queue_head(self, client, device_uri):
+        """返回队首的等待者，顺带清理心跳已过期的等待者"""
+        queue_key = device_key(device_uri, 'queue')
+        while True:
+            head = client.zrange(queue_key, 0, 0)
+            if not head:
+                return None
+            head = head[0].decode()
+            if client.exists(device_key(device_uri, f'waiter:{head}')):
+                return head
+            client.zrem(queue_key, head)
+
+    def _heartbeat(self, lease):
+        renew, _ = self._scripts()
+        owner_key = device_key(lease.device_uri, 'owner')
+        while not lease.stop_event.wait(self.ttl_ms / 3000):
+            try:
+                if not renew(keys=[owner_key], args=[lease.owner, self.ttl_ms]):
+                    print(f"设备 {lease.device_uri} 的租约已丢失 (任务 #{lease.owner})")
+                    return
+            except redis.RedisError as e:
+                print(f"续期设备 {lease.device_uri} 的租约失败: {e}")
+
+    def release(self, lease):
+        lease.stop_event.set()
+        _, release = self._scripts()
+        try:
+            release(keys=[device_key(lease.device_uri, 'owner')], args=[lease.owner])
+        except redis.RedisError as e:
+            print(f"释放设备 {lease.device_uri} 的租约失败，将在过期后自动释放: {e}")
+
+    def stats(self):
+        client = get_redis()
+        now = time.time()
+        result = []
+        for device_uri in sorted(uri.decode() for uri in client.smembers(DEVICES_KEY)):
+            pipe = client.pipeline()
+            pipe.get(device_key(device_uri, 'owner'))
+            pipe.zrange(device_key(device_uri, 'queue'), 0, -1, withscores=True)
+            pipe.hgetall(device_key(device_uri, 'stats'))
+            owner, queue, stats = pipe.execute()
+            waiting = [{'task_id': int(member), 'wait_seconds': round(now - score, 1)} for member, score in queue]
+            result.append(_device_summary(
+                device_uri, int(owner) if owner else None, waiting,
+                int(stats.get(b'leases', 0)), float(stats.get(b'total_wait', 0)),
+                float(stats.get(b'max_wait', 0)), float(stats.get(b'last_wait', 0)),
+            ))
+        return result
+
+
+class LocalDeviceLeaseManager:
+    """进程内的设备互斥，行为与 redis 后端一致（按到达顺序排队）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._owners = {}
+        self._queues = {}
+        self._stats = {}
+
+    @property
+    def poll_interval(self):
+        return getattr(settings, 'DEVICE_LEASE_POLL_INTERVAL', 1.0)
+
+    def acquire(self, device_uri, task_id, cancel_token=None, on_wait=None):
+        owner = str(task_id)
+        enqueued_at = time.time()
+        waiter = (owner, enqueued_at)
+        with self._lock:
+            queue = self._queues.setdefault(device_uri, deque())
+            self._stats.setdefault(device_uri, _DeviceStats())
+            queue.append(waiter)
+        notified = False
+        try:
+            while True:
+                with self._lock:
+                    if queue[0] is waiter and device_uri not in self._owners:
+                        self._owners[device_uri] = owner
+                        break
+                    position, holder = queue.index(waiter), self._owners.get(device_uri)
+                if not notified and on_wait:
+                    notified = True
+                    on_wait(position, holder)
+                _wait(self.poll_interval, cancel_token)
+        finally:
+            with self._lock:
+                queue.remove(waiter)
+
+        wait_time = time.time() - enqueued_at
+        with self._lock:
+            self._stats[device_uri].record(wait_time)
+        return DeviceLease(self, device_uri, owner, wait_time)
+
+    def release(self, lease):
+        with self._lock:
+            if self._owners.get(lease.device_uri) == lease.owner:
+                del self._owners[lease.device_uri]
+
+    def stats(self):
+        now = time.time()
+        result = []
+        with self._lock:
+            for device_uri, queue in sorted(self._queues.items()):
+                owner = self._owners.get(device_uri)
+                waiting = [{'task_id': int(member), 'wait_seconds': round(now - at, 1)} for member, at in queue]
+                stats = self._stats[device_uri]
+                result.append(_device_summary(
+                    device_uri, int(owner) if owner else None, waiting,
+                    stats.leases, stats.total_wait, stats.max_wait, stats.last_wait,
+                ))
+        return result
+
+
+LEASE_BACKENDS = {
+    'redis': RedisDeviceLeaseManager,
+    'local': LocalDeviceLeaseManager,
+}
+
+_lease_manager = None
+
+
+def get_lease_manager():
+    """按 DEVICE_LEASE_BACKEND 返回进程内唯一的租约管理器"""
+    global _lease_manager
+    if _lease_manager is None:
+        _lease_manager = LEASE_BACKENDS[getattr(settings, 'DEVICE_LEASE_BACKEND', 'redis')]()
+    return _lease_manager
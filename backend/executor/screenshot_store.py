@@ -0,0 +1,169 @@
+"""
+截图存储。
+
+截图按画面内容寻址：对像素数据求哈希，文件保存在 MEDIA_ROOT/screenshots/<前两位>/<哈希>.<扩展名>，
+同时生成一张缩略图 screenshots/thumbs/<前两位>/<哈希>.jpg 供界面列表使用。
+同一画面重复截图（例如界面静止时的多次快照）只会刷新文件时间，不会再次编码和写盘。
+
+编码格式和质量见 SCREENSHOT_FORMAT / SCREENSHOT_QUALITY；prune() 按文件最后使用时间
+删除超过 SCREENSHOT_RETENTION_DAYS 天的截图，并在总大小超过 SCREENSHOT_STORE_MAX_BYTES 时
+继续删除最久未使用的截图。被删除截图的任务，其 latest_screenshot 会被清空。
+"""
+import hashlib
+import os
+import threading
+import time
+from airtest.aircv import cv2
+from django.conf import settings
+
+STORE_DIR = 'screenshots'
+THUMBNAIL_DIR = 'thumbs'
+
+ENCODINGS = {
+    'jpeg': ('.jpg', [cv2.IMWRITE_JPEG_QUALITY]),
+    'webp': ('.webp', [cv2.IMWRITE_WEBP_QUALITY]),
+    'png': ('.png', []),
+}
+
+
+def thumbnail_path(path):
+    """截图相对路径对应的缩略图相对路径；不是本存储中的截图（旧版 task_logs 截图）时返回 None"""
+    if not path:
+        return None
+    parts = path.replace(os.path.sep, '/').split('/')
+    if len(parts) != 3 or parts[0] != STORE_DIR:
+        return None
+    digest = os.path.splitext(parts[2])[0]
+    return '/'.join((STORE_DIR, THUMBNAIL_DIR, parts[1], f"{digest}.jpg"))
+
+
+def frame_digest(frame):
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(frame.shape).encode())
+    digest.update(frame.tobytes())
+    return digest.hexdigest()
+
+
+def _write_atomic(full_path, data):
+    """先写临时文件再重命名，读取方不会看到写了一半的图片"""
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    tmp_path = f"{full_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, full_path)
+
+
+def _encode(frame, fmt, quality, max_width=None):
+    if max_width and frame.shape[1] > max_width:
+        height = round(frame.shape[0] * max_width / frame.shape[1])
+        frame = cv2.resize(frame, (max_width, height), interpolation=cv2.INTER_AREA)
+    ext, quality_flag = ENCODINGS[fmt]
+    params = [quality_flag[0], int(quality)] if quality_flag else []
+    ok, buffer = cv2.imencode(ext, frame, params)
+    if not ok:
+        raise ValueError(f"无法将截图编码为 {fmt}")
+    return buffer.tobytes()
+
+
+class ScreenshotStore:
+    def __init__(self, media_root=None):
+        self._media_root = media_root
+        self.saved = 0
+        self.deduplicated = 0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+
+    @property
+    def media_root(self):
+        return self._media_root or settings.MEDIA_ROOT
+
+    def save(self, frame):
+        """保存一帧画面（BGR），返回相对 MEDIA_ROOT 的路径"""
+        fmt = getattr(settings, 'SCREENSHOT_FORMAT', 'jpeg')
+        digest = frame_digest(frame)
+        path = '/'.join((STORE_DIR, digest[:2], f"{digest}{ENCODINGS[fmt][0]}"))
+        full_path = os.path.join(self.media_root, path)
+        thumb_full_path = os.path.join(self.media_root, thumbnail_path(path))
+
+        try:
+            # 相同画面已存在：只刷新时间，保留策略按最后使用时间计算
+            os.utime(full_path)
+            os.utime(thumb_full_path)
+        except FileNotFoundError:
+            # 尚未保存过，或刚被 prune() 删除：重新写入
+            pass
+        else:
+            self.deduplicated += 1
+            return path
+
+        started = time.perf_counter()
+        image = _encode(frame, fmt, getattr(settings, 'SCREENSHOT_QUALITY', 80))
+        thumbnail = _encode(frame, 'jpeg', getattr(settings, 'SCREENSHOT_THUMBNAIL_QUALITY', 70),
+                            max_width=getattr(settings, 'SCREENSHOT_THUMBNAIL_WIDTH', 320))
+        _write_atomic(full_path, image)
+        _write_atomic(thumb_full_path, thumbnail)
+        self.write_seconds += time.perf_counter() - started
+        self.bytes_written += len(image) + len(thumbnail)
+        self.saved += 1
+        return path
+
+    def _scan(self):
+        """返回 [(最后使用时间, 大小, 截图相对路径)]，缩略图的大小计入对应截图"""
+        entries = []
+        root = os.path.join(self.media_root, STORE_DIR)
+        if not os.path.isdir(root):
+            return entries
+        for bucket in os.scandir(root):
+            if not bucket.is_dir() or bucket.name == THUMBNAIL_DIR:
+                continue
+            for item in os.scandir(bucket.path):
+                if not item.is_file() or item.name.endswith('.tmp'):
+                    continue
+                path = '/'.join((STORE_DIR, bucket.name, item.name))
+                stat = item.stat()
+                size = stat.st_size
+                thumb_full_path = os.path.join(self.media_root, thumbnail_path(path))
+                if os.path.exists(thumb_full_path):
+                    size += os.path.getsize(thumb_full_path)
+                entries.append((stat.st_mtime, size, path))
+        return entries
+
+    def prune(self, max_age_days=None, max_bytes=None):
+        """按保留策略删除截图，返回 (删除的数量, 释放的字节数)"""
+        from api.models import Task
+
+        if max_age_days is None:
+            max_age_days = getattr(settings, 'SCREENSHOT_RETENTION_DAYS', 30)
+        if max_bytes is None:
+            max_bytes = getattr(settings, 'SCREENSHOT_STORE_MAX_BYTES', 5 * 1024 * 1024 * 1024)
+
+        entries = sorted(self._scan())
+        total_bytes = sum(size for _, size, _ in entries)
+        cutoff = time.time() - max_age_days * 24 * 60 * 60
+        removed = []
+        freed = 0
+        for mtime, size, path in entries:
+            if mtime >= cutoff and total_bytes - freed <= max_bytes:
+                break
+            for remove_path in (path, thumbnail_path(path)):
+                try:
+                    os.remove(os.path.join(self.media_root, remove_path))
+                except FileNotFoundError:
+                    pass
+            removed.append(path)
+            freed += size
+
+        for start in range(0, len(removed), 500):
+            Task.objects.filter(latest_screenshot__in=removed[start:start + 500]).update(latest_screenshot=None)
+        return len(removed), freed
+
+    def stats(self):
+        return {
+            'saved': self.saved,
+            'deduplicated': self.deduplicated,
+            'bytes_written': self.bytes_written,
+            'write_seconds': round(self.write_seconds, 3),
+        }
+
+
+screenshot_store = ScreenshotStore()
@@ -0,0 +1,150 @@
+"""
+任务实时画面推流（执行器一侧）。
+
+观看者由 TaskStreamConsumer 登记在 Redis 的 ZSET 中（score 为登记的过期时间，连接期间定期续期）。
+任务执行期间 FrameStreamer 在后台线程中检查是否有观看者：没有观看者时不截图、不编码；
+有观看者时按 STREAM_FPS 取帧（优先复用 FramePoller 刚截到的画面），缩放到 STREAM_MAX_WIDTH
+并编码为 JPEG/WebP，只有画面发生变化或有新观看者加入时才推送到频道层。
+慢速客户端的丢帧由 TaskStreamConsumer 按确认（ack）情况处理。
+"""
+import threading
+import time
+import redis
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from airtest.aircv import cv2
+from django.conf import settings
+from .redis_client import get_redis
+from .polling import frame_signature
+
+# 没有观看者时，多久检查一次是否有人开始观看（秒）
+VIEWER_CHECK_INTERVAL = 1.0
+
+ENCODINGS = {
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 'image/jpeg'),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 'image/webp'),
+}
+
+
+def stream_group_name(task_id):
+    return f"task_{task_id}_stream"
+
+
+def viewers_key(task_id):
+    return f"autoplay:stream:{task_id}:viewers"
+
+
+def register_viewer(task_id, viewer_id):
+    """登记 / 续期一个观看者，STREAM_VIEWER_TTL 秒内未续期即视为离开"""
+    key = viewers_key(task_id)
+    ttl = getattr(settings, 'STREAM_VIEWER_TTL', 15)
+    pipe = get_redis().pipeline()
+    pipe.zadd(key, {viewer_id: time.time() + ttl})
+    pipe.expire(key, int(ttl) * 2)
+    pipe.execute()
+
+
+def unregister_viewer(task_id, viewer_id):
+    get_redis().zrem(viewers_key(task_id), viewer_id)
+
+
+def active_viewers(task_id):
+    pipe = get_redis().pipeline()
+    pipe.zremrangebyscore(viewers_key(task_id), '-inf', time.time())
+    pipe.zrange(viewers_key(task_id), 0, -1)
+    return set(pipe.execute()[1])
+
+
+def encode_frame(frame, max_width, fmt='jpeg', quality=70):
+    """缩放到不超过 max_width 的宽度并编码，返回 (图片数据, 宽, 高, MIME 类型)"""
+    height, width = frame.shape[:2]
+    if width > max_width:
+        frame = cv2.resize(frame, (max_width, round(height * max_width / width)), interpolation=cv2.INTER_AREA)
+    ext, quality_flag, mime = ENCODINGS[fmt]
+    ok, buffer = cv2.imencode(ext, frame, [quality_flag, int(quality)])
+    if not ok:
+        raise ValueError(f"无法将画面编码为 {fmt}")
+    return buffer.tobytes(), frame.shape[1], frame.shape[0], mime
+
+
+class FrameStreamer:
+    def __init__(self, task_id, poller):
+        self.task_id = task_id
+        self.poller = poller
+        self.fps = getattr(settings, 'STREAM_FPS', 5)
+        self.max_width = getattr(settings, 'STREAM_MAX_WIDTH', 480)
+        self.format = getattr(settings, 'STREAM_FORMAT', 'jpeg')
+        self.quality = getattr(settings, 'STREAM_QUALITY', 70)
+        self._stop = threading.Event()
+        self._thread = None
+        self.frames_sent = 0
+        self.frames_unchanged = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f'frame-streamer-{self.task_id}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        channel_layer = get_channel_layer()
+        group = stream_group_name(self.task_id)
+        known_viewers = set()
+        sent_signature = None
+        seq = 0
+        while not self._stop.is_set():
+            try:
+                viewers = active_viewers(self.task_id)
+            except redis.RedisError as e:
+                print(f"读取任务 #{self.task_id} 的观看者失败: {e}")
+                viewers = set()
+            if not viewers:
+                known_viewers = set()
+                self._stop.wait(VIEWER_CHECK_INTERVAL)
+                continue
+
+            started = time.monotonic()
+            # 有新观看者时，即使画面没有变化也要推送一帧作为起始画面
+            keyframe = bool(viewers - known_viewers)
+            known_viewers = viewers
+            try:
+                frame = self._grab()
+                if frame is not None:
+                    signature = frame_signature(frame)
+                    if keyframe or sent_signature is None or self.poller.is_changed(signature, sent_signature):
+                        data, width, height, mime = encode_frame(frame, self.max_width, self.format, self.quality)
+                        seq += 1
+                        async_to_sync(channel_layer.group_send)(group, {
+                            'type': 'stream.frame',
+                            'seq': seq,
+                            'width': width,
+                            'height': height,
+                            'mime': mime,
+                            'data': data,
+                        })
+                        sent_signature = signature
+                        self.frames_sent += 1
+                    else:
+                        self.frames_unchanged += 1
+            except Exception as e:
+                print(f"任务 #{self.task_id} 推流出错: {e}")
+            self._stop.wait(max(1 / self.fps - (time.monotonic() - started), 0))
+
+        try:
+            async_to_sync(channel_layer.group_send)(group, {'type': 'stream.end'})
+        except Exception as e:
+            print(f"通知任务 #{self.task_id} 推流结束失败: {e}")
+
+    def _grab(self):
+        """执行线程刚截过图就直接复用，否则自己截一帧"""
+        poller = self.poller
+        if poller.last_frame is not None and time.monotonic() - poller.last_frame_at < 1 / self.fps:
+            return poller.last_frame
+        return poller.capture()
+
+    def stats(self):
+        return {'sent': self.frames_sent, 'unchanged': self.frames_unchanged}
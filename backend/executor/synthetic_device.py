@@ -0,0 +1,69 @@
+"""
+合成画面的测试设备，用于在没有真机的环境下运行脚本和实时画面推流。
+
+注册为 Airtest 自定义设备后（见 devices.register_test_devices），通过 URI 使用：
+    SyntheticDevice:///?width=720&height=1280&change_interval=0.5
+
+画面每隔 change_interval 秒变化一次（移动的色块 + 帧号），其余时间保持不变，
+便于验证"画面不变就不匹配 / 不推流"的逻辑。触控、滑动和输入只被记录下来。
+"""
+import time
+import numpy as np
+from airtest import aircv
+from airtest.aircv import cv2
+from airtest.core.device import Device
+from airtest.core.helper import G
+
+
+class SyntheticDevice(Device):
+    def __init__(self, serialno=None, width=720, height=1280, change_interval=0.5, **kwargs):
+        super().__init__()
+        self.serialno = serialno or 'synthetic'
+        self.width = int(width)
+        self.height = int(height)
+        self.change_interval = float(change_interval)
+        self.started_at = time.monotonic()
+        self.operations = []
+
+    @property
+    def uuid(self):
+        return self.serialno
+
+    def _frame_index(self):
+        return int((time.monotonic() - self.started_at) / self.change_interval)
+
+    def render(self, index):
+        """生成第 index 帧画面（BGR）"""
+        frame = np.full((self.height, self.width, 3), 40, dtype=np.uint8)
+        frame[:, :, 0] = np.linspace(40, 120, self.width, dtype=np.uint8)
+        size = min(self.width, self.height) // 5
+        x = (index * size // 2) % max(self.width - size, 1)
+        y = (index * size // 3) % max(self.height - size, 1)
+        color = ((index * 50) % 256, (index * 90) % 256, 200)
+        cv2.rectangle(frame, (x, y), (x + size, y + size), color, -1)
+        cv2.putText(frame, f"#{index}", (20, 60), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+        return frame
+
+    def snapshot(self, filename=None, quality=10, max_size=None, **kwargs):
+        frame = self.render(self._frame_index())
+        if filename:
+            aircv.imwrite(filename, frame, quality, max_size=max_size)
+        return frame
+
+    def touch(self, pos, **kwargs):
+        self.operations.append(('touch', tuple(pos)))
+
+    def swipe(self, p1, p2, **kwargs):
+        self.operations.append(('swipe', tuple(p1), tuple(p2)))
+
+    def text(self, text, enter=True, **kwargs):
+        self.operations.append(('text', text))
+
+    def get_current_resolution(self):
+        return self.width, self.height
+
+    def disconnect(self):
+        pass
+
+
+G.register_custom_device(SyntheticDevice)
@@ -1,60 +1,183 @@
+import threading
+from contextlib import contextmanager
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.db import IntegrityError, connection
 from django.utils import timezone
-from api.models import Task  # 从 api 应用导入 Task 模型
-from api.serializers import TaskSerializer # 从 api 应用导入 Task 序列化器
+from api.models import Task, TaskLogEntry  # 从 api 应用导入 Task 模型
+from api.serializers import TaskSummarySerializer, TaskLogEntrySerializer
+from api.consumers import task_group_name, owner_group_name
+from .metrics import LOG_IO_SECONDS
 
 class TaskLogger:
     """
     一个专门用于处理任务日志记录、状态更新和WebSocket广播的类。
+    日志以 TaskLogEntry 的形式只追加写入，每条日志只需要一次小的 INSERT。
+
+    缓冲模式下（默认），log() 只把日志放进内存队列，由后台线程每隔
+    TASK_LOG_FLUSH_INTERVAL 秒、或积攒满 TASK_LOG_FLUSH_BATCH_SIZE 条时批量写库并广播一次；
+    状态变更和截图更新仍会立即刷新。使用完毕后必须调用 close() 以写出剩余日志。
+
+    广播只发往订阅了该任务的客户端：日志以增量（新条目 + 序号）推送，状态变化只推送任务摘要。
     """
-    def __init__(self, task_id):
+    def __init__(self, task_id, buffered=None, metric_labels=None):
         try:
             # 初始加载一次任务，主要为了获取ID
-            self.task = Task.objects.get(id=task_id)
+            self.task = Task.objects.select_related('script').get(id=task_id)
             self.task_id = task_id
             self.channel_layer = get_channel_layer()
+            # 当前正在执行的脚本节点位置，由 node_scope 维护
+            self.node_path = ''
+            self._next_seq = TaskLogEntry.objects.next_seq(task_id)
         except Task.DoesNotExist:
             raise ValueError(f"Task with ID {task_id} does not exist.")
+        # 写库和广播耗时指标的标签 {'script', 'device'}，默认取任务的脚本和设备
+        self.metric_labels = dict({'script': self.task.script.name, 'device': self.task.device_uri or ''},
+                                  **(metric_labels or {}))
+
+        self.buffered = getattr(settings, 'TASK_LOG_BUFFERED', True) if buffered is None else buffered
+        self.flush_interval = getattr(settings, 'TASK_LOG_FLUSH_INTERVAL', 0.2)
+        self.flush_batch_size = getattr(settings, 'TASK_LOG_FLUSH_BATCH_SIZE', 50)
+        self._pending = []
+        # _pending_lock 保护内存队列和序号分配；_flush_lock 保证批次按顺序落库
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher = None
+        self._closed = False
 
-    def log(self, message, status=None):
+    @contextmanager
+    def node_scope(self, node_path):
+        """在 with 块内产生的日志都会标记为来自 node_path 节点"""
+        previous_path = self.node_path
+        self.node_path = node_path
         try:
-            current_task = Task.objects.get(id=self.task_id)
+            yield
+        finally:
+            self.node_path = previous_path
 
-            log_message = f"{message}\n"
-            current_task.log = (current_task.log or '') + log_message
+    def log(self, message, status=None, level='INFO'):
+        with self._pending_lock:
+            self._pending.append(self._make_entry(message, level))
+            pending_count = len(self._pending)
 
-            if status:
-                current_task.status = status
+        if status or not self.buffered or self._closed:
+            # 状态变更必须立即落库并广播
+            self.flush(status=status)
+            return
 
-            if status in ['SUCCESS', 'FAILED']:
-                current_task.completed_at = timezone.now()
+        self._ensure_flusher()
+        if pending_count >= self.flush_batch_size:
+            self._wakeup.set()
 
-            # 保存包含了所有最新信息（包括其他任务可能写入的截图路径）的对象
-            current_task.save()
+    def update_screenshot(self, screenshot_path):
+        self.flush(screenshot_path=screenshot_path)
 
-            # 使用最新的对象进行序列化和广播
-            self.broadcast(current_task)
+    def flush(self, status=None, screenshot_path=None):
+        """把队列中的日志连同状态/截图变更一次性写库，并只广播一次"""
+        with self._flush_lock:
+            with self._pending_lock:
+                entries, self._pending = self._pending, []
+            if not (entries or status or screenshot_path):
+                return
 
-        except Task.DoesNotExist:
-            pass
+            if entries:
+                with LOG_IO_SECONDS.time(operation='write_entries', **self.metric_labels):
+                    self._write_entries(entries)
+                with LOG_IO_SECONDS.time(operation='broadcast_log', **self.metric_labels):
+                    self.broadcast_log(entries)
+            if status or screenshot_path:
+                with LOG_IO_SECONDS.time(operation='update_task', **self.metric_labels):
+                    if status:
+                        self._update_status(status)
+                    if screenshot_path:
+                        Task.objects.filter(id=self.task_id).update(latest_screenshot=screenshot_path)
 
-    def update_screenshot(self, screenshot_path):
-        # 这个方法现在也可以从这个修复中受益
-        try:
-            current_task = Task.objects.get(id=self.task_id)
-            current_task.latest_screenshot = screenshot_path
-            current_task.save()
-            self.broadcast(current_task)
-        except Task.DoesNotExist:
-            pass
+                try:
+                    # 使用最新的对象进行序列化和广播
+                    with LOG_IO_SECONDS.time(operation='broadcast_status', **self.metric_labels):
+                        self.broadcast_status(Task.objects.select_related('script').get(id=self.task_id))
+                except Task.DoesNotExist:
+                    pass
+
+    def close(self):
+        """停止后台刷新线程，并写出队列中剩余的日志"""
+        self._closed = True
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
 
-    def broadcast(self, task_instance):
-        serializer = TaskSerializer(task_instance)
+    def broadcast_status(self, task_instance):
+        """向任务订阅者和所有者推送不含日志的任务摘要"""
+        message = {
+            'type': 'task.status',
+            'task': TaskSummarySerializer(task_instance).data
+        }
+        async_to_sync(self.channel_layer.group_send)(task_group_name(self.task_id), message)
+        if task_instance.owner_id:
+            async_to_sync(self.channel_layer.group_send)(owner_group_name(task_instance.owner_id), message)
+
+    def broadcast_log(self, entries):
+        """只向任务订阅者推送本批新增的日志条目"""
         async_to_sync(self.channel_layer.group_send)(
-            'task_updates',
+            task_group_name(self.task_id),
             {
-                'type': 'task.update',
-                'message': serializer.data
+                'type': 'task.log',
+                'task_id': self.task_id,
+                'entries': TaskLogEntrySerializer(entries, many=True).data,
+                'last_seq': entries[-1].seq,
             }
-        )
\ No newline at end of file
+        )
+
+    def _ensure_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run_flusher, name=f"task-logger-{self.task_id}",
+                                             daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        """后台刷新循环：按时间间隔或被唤醒时刷新，不占用执行 Airtest 步骤的线程"""
+        try:
+            while not self._closed:
+                self._wakeup.wait(self.flush_interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"任务 #{self.task_id} 日志刷新失败: {e}")
+        finally:
+            # 每个线程都有独立的数据库连接，退出前主动关闭
+            connection.close()
+
+    def _make_entry(self, message, level):
+        entry = TaskLogEntry(task_id=self.task_id, seq=self._next_seq, timestamp=timezone.now(),
+                             level=level, node_path=self.node_path, message=str(message))
+        self._next_seq += 1
+        return entry
+
+    def _write_entries(self, entries):
+        """批量写入日志条目；若序号被其他写入方占用，则整体顺延后重试一次"""
+        try:
+            TaskLogEntry.objects.bulk_create(entries)
+        except IntegrityError:
+            with self._pending_lock:
+                self._next_seq = TaskLogEntry.objects.next_seq(self.task_id)
+                for entry in entries + self._pending:
+                    entry.seq = self._next_seq
+                    self._next_seq += 1
+            TaskLogEntry.objects.bulk_create(entries)
+
+    def _update_status(self, status):
+        fields = {'status': status}
+        if status == 'RUNNING':
+            fields['started_at'] = timezone.now()
+        if status in ['SUCCESS', 'FAILED', 'CANCELED']:
+            fields['completed_at'] = timezone.now()
+        tasks = Task.objects.filter(id=self.task_id)
+        if status != 'CANCELED':
+            # 任务一旦被用户取消，执行器随后产生的状态不能再覆盖它
+            tasks = tasks.exclude(status='CANCELED')
+        tasks.update(**fields)
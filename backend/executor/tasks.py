@@ -1,12 +1,20 @@
 from celery import shared_task
-from django.utils import timezone
 from api.models import Task,Script
 from .task_logger import TaskLogger
+from .cancellation import watcher as cancellation_watcher
+from .template_cache import template_cache
+from .screenshot_store import screenshot_store
 from .airtest_runner import execute_script_flow
+from .compiler import get_plan, ScriptCompileError
+from .devices import device_pool
+from .scheduler import get_lease_manager
+from .metrics import TASK_SECONDS
+from .match_pool import match_pool
+from .log_archive import archive_task_logs
+from .retention import purge_tasks
 import os
 import time
 from django.conf import settings
-from airtest.core.api import auto_setup,snapshot
 from celery.exceptions import SoftTimeLimitExceeded
 
 @shared_task
@@ -14,30 +22,37 @@ def execute_automation_task(task_id: int, device_uri: str):
     """
     接收 task_id 和 device_uri，并协调执行流程。
     """
-    logger = TaskLogger(task_id)
-
-    def check_for_cancellation():
-        """从数据库重新获取任务状态，检查是否已被取消。"""
-        # 使用 refresh_from_db 获取最新的状态
-        logger.task.refresh_from_db()
-        if logger.task.status == 'CANCELED':
-            logger.log("检测到任务已被取消，正在终止执行...")
-            # 抛出一个异常来中断任务流程
-            raise InterruptedError("Task was canceled by user.")
+    logger = TaskLogger(task_id, metric_labels={'device': device_uri})
+    started = time.monotonic()
+    final_status = 'FAILED'
+    # 取消令牌：检查只读本地标记，由后台 watcher 按 TASK_CANCEL_POLL_INTERVAL 刷新
+    cancel_token = cancellation_watcher.register(task_id)
 
     try:
         task = logger.task
-        task.started_at = timezone.now()
-        logger.log(f"--- [任务开始] 脚本: {task.script.name} ---", status='RUNNING')
+        if task.status == 'CANCELED':
+            raise InterruptedError("Task was canceled by user.")
+
+        def on_wait(position, holder):
+            logger.log(f"设备 {device_uri} 正被任务 #{holder} 使用，排队等待中 (前方还有 {position} 个任务)...")
+            logger.flush()
 
-        check_for_cancellation()
-        execute_script_flow(task.script.content, device_uri, logger,check_for_cancellation)
+        # 同一设备同一时刻只运行一个任务；等待期间任务保持 PENDING，可被取消
+        with get_lease_manager().acquire(device_uri, task_id, cancel_token, on_wait) as lease:
+            if lease.wait_time >= 1:
+                logger.log(f"已获得设备 {device_uri}，排队等待 {lease.wait_time:.1f} 秒")
+            logger.log(f"--- [任务开始] 脚本: {task.script.name} ---", status='RUNNING')
 
-        logger.log(f"--- [任务成功] ---", status='SUCCESS')
+            execute_script_flow(get_plan(task.script), device_uri, logger, cancel_token, script_name=task.script.name)
+
+            logger.log(f"--- [任务成功] ---", status='SUCCESS')
+            final_status = 'SUCCESS'
 
     except InterruptedError as e:
         # 这是我们自己抛出的异常，表示任务被正常取消了
         print(e)
+        final_status = 'CANCELED'
+        logger.log("检测到任务已被取消，已终止执行。", level='WARNING')
         # 状态已经在 cancel_task 视图中被设置，这里无需再次操作
         pass
 
@@ -50,57 +65,41 @@ def execute_automation_task(task_id: int, device_uri: str):
         error_details = traceback.format_exc()
         print(error_details)  # 在Celery控制台打印完整的错误堆栈
 
-        if isinstance(e, TargetNotFoundError):
-            logger.log(f"--- [任务失败] 找不到目标图片: {e} ---", status='FAILED')
+        if isinstance(e, ScriptCompileError):
+            logger.log(f"--- [任务失败] 脚本校验失败: {e} ---", status='FAILED', level='ERROR')
+        elif isinstance(e, TargetNotFoundError):
+            logger.log(f"--- [任务失败] 找不到目标图片: {e} ---", status='FAILED', level='ERROR')
         else:
-            logger.log(f"--- [任务失败] 发生未知错误: {e} ---", status='FAILED')
+            logger.log(f"--- [任务失败] 发生未知错误: {e} ---", status='FAILED', level='ERROR')
+
+    finally:
+        print(f"任务 #{task_id} 结束，模板缓存统计: {template_cache.stats()}，设备连接池统计: {device_pool.stats()}"
+              + (f"，匹配进程池统计: {match_pool.stats()}" if match_pool.dispatched or match_pool.fallbacks else ''))
+        cancellation_watcher.unregister(cancel_token)
+        # 写出缓冲区中剩余的日志，并停止后台刷新线程
+        logger.close()
+        TASK_SECONDS.observe(time.monotonic() - started, script=logger.task.script.name, device=device_uri,
+                             status=final_status)
 
     return f"任务 {task_id} 执行完毕"
 
+
 @shared_task
-def take_manual_screenshot_task(task_id: int):
-    """
-    一个专门用于手动截图的轻量级任务。
-    它只接收 task_id，然后自己从数据库中查询所有需要的信息。
-    """
-    try:
-        # ★ 1. 从数据库获取任务实例
-        task = Task.objects.get(id=task_id)
-
-        # ★ 2. 检查任务是否有关联的 device_uri
-        if not task.device_uri:
-            print(f"手动截图失败：任务 #{task_id} 没有关联的 device_uri。")
-            # 更新日志，让前端也能看到失败原因
-            logger = TaskLogger(task.id)
-            logger.log("手动截图失败：任务未记录执行设备。")
-            return
-
-        print(f"开始为任务 #{task_id} 执行手动截图，设备: {task.device_uri}")
-
-        # ★ 3. 连接设备 (和之前一样)
-        auto_setup(logdir=False, devices=[task.device_uri])
-
-        # ★ 4. 生成截图路径 (和之前一样)
-        filename = f"manual_snapshot_{int(time.time())}.png"
-        snapshot_relative_path = os.path.join('task_logs', str(task.id), filename)
-        snapshot_full_path = os.path.join(settings.MEDIA_ROOT, snapshot_relative_path)
-        os.makedirs(os.path.dirname(snapshot_full_path), exist_ok=True)
-
-        # ★ 5. 执行截图 (和之前一样)
-        snapshot(filename=snapshot_full_path)
-        print(f"截图已保存到: {snapshot_full_path}")
-
-        # ★ 6. 更新数据库并触发广播 (和之前一样)
-        task.latest_screenshot = snapshot_relative_path
-        task.save()
-
-        # 复用 TaskLogger 来进行广播
-        logger = TaskLogger(task.id)
-        logger.log("手动截图成功。")
-
-    except Task.DoesNotExist:
-        print(f"手动截图失败：找不到任务 #{task_id}")
-    except Exception as e:
-        import traceback
-        print(f"手动截图时发生未知错误: {e}")
-        traceback.print_exc()
+def prune_screenshots_task():
+    """定期按保留策略清理截图存储，由 CELERY_BEAT_SCHEDULE 调度"""
+    removed, freed = screenshot_store.prune()
+    return f"已删除 {removed} 张截图，释放 {freed} 字节"
+
+
+@shared_task
+def archive_task_logs_task():
+    """定期把已结束超过 LOG_ARCHIVE_AFTER_DAYS 天的任务日志压缩归档，由 CELERY_BEAT_SCHEDULE 调度"""
+    archived, rows, total_bytes = archive_task_logs()
+    return f"已归档 {archived} 个任务的 {rows} 条日志，压缩后 {total_bytes} 字节"
+
+
+@shared_task
+def purge_tasks_task():
+    """定期分批删除已结束超过 TASK_RETENTION_DAYS 天的任务，由 CELERY_BEAT_SCHEDULE 调度"""
+    tasks, rows, files = purge_tasks()
+    return f"已删除 {tasks} 个任务、{rows} 条日志、{files} 个归档文件和截图目录"
@@ -0,0 +1,221 @@
+"""
+模板图片缓存。
+
+每个 worker 进程维护一份按路径索引的 LRU 缓存，保存 script_assets 中模板图片解码后的
+图像及匹配时需要的灰度图。缓存项记录文件的 (mtime, size)，在 TEMPLATE_CACHE_REVALIDATE_INTERVAL
+秒内直接命中、不访问文件系统；超过该间隔才 stat 一次确认文件是否被替换。
+缓存总大小受 TEMPLATE_CACHE_MAX_BYTES 限制，超出时淘汰最久未使用的图片。
+命中、未命中、淘汰次数和当前大小同时记录到 executor.metrics 中，随 /api/metrics/ 和 worker 导出端口导出。
+按 match_scale / 设备分辨率缩放后的模板也缓存在对应的缓存项中，随原图一起失效和淘汰。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from airtest import aircv
+from airtest.aircv import cv2
+from airtest.aircv.template_matching import TemplateMatching
+from airtest.core.cv import Template
+from django.conf import settings
+from .metrics import (TEMPLATE_CACHE_BYTES, TEMPLATE_CACHE_ENTRIES, TEMPLATE_CACHE_EVICTIONS,
+                      TEMPLATE_CACHE_HITS, TEMPLATE_CACHE_MISSES)
+
+
+class CachedImage:
+    """一张已解码的模板图片及其派生数据"""
+    __slots__ = ('path', 'signature', 'image', 'gray', 'variants', 'nbytes', 'checked_at')
+
+    def __init__(self, path, signature, image):
+        self.path = path
+        self.signature = signature
+        self.image = image
+        self.gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        # (缩放系数, 是否灰度) -> 缩放后的图像
+        self.variants = {}
+        self.nbytes = image.nbytes + (self.gray.nbytes if self.gray is not image else 0)
+        self.checked_at = time.monotonic()
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class TemplateCache:
+    def __init__(self, max_bytes=None, revalidate_interval=None):
+        self._max_bytes = max_bytes
+        self._revalidate_interval = revalidate_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return getattr(settings, 'TEMPLATE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+
+    @property
+    def revalidate_interval(self):
+        if self._revalidate_interval is not None:
+            return self._revalidate_interval
+        return getattr(settings, 'TEMPLATE_CACHE_REVALIDATE_INTERVAL', 30)
+
+    def get(self, path):
+        """返回 path 对应的 CachedImage，必要时从磁盘读取并解码"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and now - entry.checked_at < self.revalidate_interval:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                TEMPLATE_CACHE_HITS.inc()
+                return entry
+
+        signature = _file_signature(path)
+        with self._lock:
+            if entry is not None and entry.signature == signature:
+                entry.checked_at = now
+                self._entries.move_to_end(path)
+                self.hits += 1
+                TEMPLATE_CACHE_HITS.inc()
+                return entry
+
+        image = aircv.imread(path)
+        new_entry = CachedImage(path, signature, image)
+        with self._lock:
+            old_entry = self._entries.pop(path, None)
+            if old_entry is not None:
+                self.current_bytes -= old_entry.nbytes
+                self.reloads += 1
+                TEMPLATE_CACHE_MISSES.inc(reason='reload')
+            else:
+                self.misses += 1
+                TEMPLATE_CACHE_MISSES.inc(reason='new')
+            self._entries[path] = new_entry
+            self.current_bytes += new_entry.nbytes
+            self._evict()
+            self._update_gauges()
+        return new_entry
+
+    def get_scaled(self, path, scale, gray=False):
+        """返回按 scale 缩放后的模板图像（gray 为 True 时为灰度图），缩放结果随缓存项一起缓存"""
+        entry = self.get(path)
+        source = entry.gray if gray else entry.image
+        if scale == 1:
+            return source
+        key = (scale, gray)
+        image = entry.variants.get(key)
+        if image is not None:
+            return image
+        height, width = source.shape[:2]
+        size = (max(round(width * scale), 1), max(round(height * scale), 1))
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        image = cv2.resize(source, size, interpolation=interpolation)
+        with self._lock:
+            if key not in entry.variants and self._entries.get(path) is entry:
+                entry.variants[key] = image
+                entry.nbytes += image.nbytes
+                self.current_bytes += image.nbytes
+                self._evict()
+                self._update_gauges()
+        return image
+
+    def _evict(self):
+        # 至少保留刚放入的一项，哪怕它本身已超过上限
+        while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.current_bytes -= entry.nbytes
+            self.evictions += 1
+            TEMPLATE_CACHE_EVICTIONS.inc()
+
+    def _update_gauges(self):
+        TEMPLATE_CACHE_BYTES.set(self.current_bytes)
+        TEMPLATE_CACHE_ENTRIES.set(len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self._update_gauges()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'evictions': self.evictions,
+            }
+
+
+template_cache = TemplateCache()
+
+
+class CachedTemplate(Template):
+    """
+    从 template_cache 读取图像的 Template，重复匹配时不再读盘和解码。
+    filename 必须是绝对路径。
+
+    指定 match_options（见 compiler.MatchOptions）时，先把画面裁剪到 region，再与模板一起
+    按 scale 缩小后匹配，匹配结果换算回原画面的坐标。
+
+    指定 resolution_scale（设备分辨率相对脚本 reference_resolution 的比例）时，模板预先按该比例
+    缩放，只做一次单尺度模板匹配，不再按 ST.CVSTRATEGY 依次尝试多尺度和特征点匹配。
+    """
+    def __init__(self, filename, match_options=None, resolution_scale=None, **kwargs):
+        super().__init__(filename, **kwargs)
+        # 跳过 Template.filepath 在 G.BASEDIR 中逐个查找文件的过程
+        self._filepath = filename
+        self.match_options = match_options
+        self.resolution_scale = resolution_scale
+
+    @property
+    def image_scale(self):
+        scale = self.match_options.scale if self.match_options is not None else 1
+        if self.resolution_scale is not None:
+            scale *= self.resolution_scale
+        return scale
+
+    def _imread(self):
+        return template_cache.get_scaled(self.filepath, self.image_scale)
+
+    def _match_screen(self, screen):
+        if self.resolution_scale is None:
+            return super()._cv_match(screen)
+        return self._try_match(TemplateMatching, self._imread(), screen, threshold=self.threshold, rgb=self.rgb)
+
+    def _cv_match(self, screen):
+        options = self.match_options
+        if options is None:
+            return self._match_screen(screen)
+
+        left = top = 0
+        if options.region is not None:
+            height, width = screen.shape[:2]
+            left, top, right, bottom = options.region.box(width, height)
+            if right <= left or bottom <= top:
+                return None
+            screen = screen[top:bottom, left:right]
+        scale = options.scale
+        if scale != 1:
+            screen = cv2.resize(screen, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        ret = self._match_screen(screen)
+        if not ret:
+            return ret
+
+        def to_screen(point):
+            return round(point[0] / scale + left), round(point[1] / scale + top)
+
+        ret['result'] = to_screen(ret['result'])
+        if 'rectangle' in ret:
+            ret['rectangle'] = tuple(to_screen(point) for point in ret['rectangle'])
+        return ret
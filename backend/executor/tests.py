@@ -1,3 +1,427 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+import numpy as np
+from airtest.aircv import cv2
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from api.consumers import TaskStatusConsumer
+from api.models import Script, Task, TaskBatch, TaskLogEntry
+from .cancellation import CancellationToken
+from .compiler import ActionNode, LoopNode, ScriptCompileError, asset_path, compile_script
+from .log_archive import archivable_tasks, archive_key, archive_task, archive_task_logs, get_archive_store
+from .matchers import Matcher
+from .metrics import merge_snapshots, registry
+from .polling import FramePoller, frame_signature
+from .replay_device import ReplayDevice, load_frames
+from .retention import purge_tasks
+from .scheduler import LocalDeviceLeaseManager
+from .screenshot_store import ScreenshotStore, thumbnail_path
+from .template_cache import CachedTemplate, TemplateCache
 
-# Create your tests here.
+REPLAY_FRAME = os.path.join(settings.BASE_DIR, 'benchmarks', 'replays', 'settings_flow', '01_home.jpg')
+
+
+class StaticDevice:
+    """前 static_frames 次截图返回原画面，之后返回贴上小图标的画面"""
+
+    def __init__(self, frame, changed_frame, static_frames):
+        self.frames = [frame] * static_frames
+        self.changed_frame = changed_frame
+        self.snapshots = 0
+
+    def snapshot(self, filename=None, quality=None):
+        self.snapshots += 1
+        if self.frames:
+            return self.frames.pop(0).copy()
+        return self.changed_frame.copy()
+
+
+class MissMatcher(Matcher):
+    """从不命中，只统计匹配次数"""
+    name = 'miss'
+
+    def match(self, frame, templates, best=False):
+        self.matches += len(templates)
+        return None, None
+
+
+class FramePollerTests(SimpleTestCase):
+    def setUp(self):
+        self.frame = cv2.imread(REPLAY_FRAME)
+        # 带纹理的小图标：纯色模板无法做归一化相关匹配
+        self.icon = np.random.RandomState(0).randint(0, 256, (48, 48, 3), dtype=np.uint8)
+        self.changed = self.frame.copy()
+        self.changed[700:748, 900:948] = self.icon
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir, True)
+        path = os.path.join(self.tmpdir, 'icon.png')
+        cv2.imwrite(path, self.icon)
+        self.template = CachedTemplate(path)
+
+    def test_small_change_is_detected(self):
+        poller = FramePoller(device=None)
+        before, after = frame_signature(self.frame), frame_signature(self.changed)
+        # 整帧的平均差几乎为零，按格比较才能察觉
+        self.assertLess(float(np.mean(np.abs(after - before))), 0.5)
+        self.assertTrue(poller.is_changed(after, before))
+        self.assertFalse(poller.is_changed(frame_signature(self.frame.copy()), before))
+
+    @override_settings(POLL_MIN_INTERVAL=0.02, POLL_MAX_INTERVAL=10, POLL_BACKOFF=1.5)
+    def test_small_template_appearing_on_static_frame_is_found(self):
+        device = StaticDevice(self.frame, self.changed, static_frames=5)
+        poller = FramePoller(device)
+
+        started = time.monotonic()
+        pos = poller.wait_for(self.template, timeout=5)
+
+        self.assertIsNotNone(pos)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertAlmostEqual(pos[0], 924, delta=2)
+        self.assertAlmostEqual(pos[1], 724, delta=2)
+        self.assertGreater(poller.matches_skipped, 0)
+
+    @override_settings(POLL_MIN_INTERVAL=0.02, POLL_MAX_INTERVAL=0.1, POLL_BACKOFF=1.5)
+    def test_static_frame_is_rematched_every_max_interval(self):
+        device = StaticDevice(self.frame, self.frame, static_frames=0)
+        poller = FramePoller(device, matcher=MissMatcher())
+
+        self.assertIsNone(poller.wait_for(self.template, timeout=0.5))
+        # 画面始终不变，仍然每隔 POLL_MAX_INTERVAL 秒重新匹配一次
+        self.assertGreaterEqual(poller.matcher.matches, 3)
+
+
+class ReplayDeviceTests(SimpleTestCase):
+    def test_directories_outside_replay_root_are_rejected(self):
+        for directory in ('', 'benchmarks', 'benchmarks/replays/../scripts', '../..', '/etc',
+                          os.path.join(settings.BASE_DIR, 'script_assets')):
+            with self.subTest(directory=directory):
+                with self.assertRaises(ValueError):
+                    load_frames(directory)
+
+    def test_snapshot_returns_a_copy(self):
+        device = ReplayDevice('benchmarks/replays/settings_flow')
+        frame = device.snapshot()
+        frame[:] = 0
+        self.assertGreater(int(device.snapshot().max()), 0)
+
+
+class TemplateCacheMetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        self.paths = []
+        for index in range(2):
+            path = os.path.join(self.directory, f'{index}.png')
+            cv2.imwrite(path, np.full((10, 10, 3), index * 100, dtype=np.uint8))
+            self.paths.append(path)
+
+    def samples(self):
+        snapshot = registry.snapshot()
+        return {name: {tuple(labels): value for labels, value in snapshot[name]['samples']}
+                for name in snapshot if name.startswith('autoplay_template_cache_')}
+
+    def test_cache_activity_is_exported(self):
+        before = self.samples()
+        cache = TemplateCache(max_bytes=450)
+        cache.get(self.paths[0])
+        cache.get(self.paths[0])
+        # 两张图片（各 300 + 100 字节）超出上限，淘汰第一张
+        cache.get(self.paths[1])
+        after = self.samples()
+
+        def delta(name, *labels):
+            return after[name].get(labels, 0) - before.get(name, {}).get(labels, 0)
+
+        self.assertEqual(delta('autoplay_template_cache_hits_total'), 1)
+        self.assertEqual(delta('autoplay_template_cache_misses_total', 'new'), 2)
+        self.assertEqual(delta('autoplay_template_cache_evictions_total'), 1)
+        self.assertEqual(after['autoplay_template_cache_bytes'][()], 400)
+        self.assertEqual(after['autoplay_template_cache_entries'][()], 1)
+
+    def test_gauges_survive_reset_and_are_summed(self):
+        cache = TemplateCache()
+        cache.get(self.paths[0])
+        registry.reset()
+        snapshot = registry.snapshot()
+        self.assertEqual(snapshot['autoplay_template_cache_bytes']['samples'], [[[], 400]])
+        merged = merge_snapshots([snapshot, snapshot])
+        self.assertEqual(merged['autoplay_template_cache_bytes']['samples'], [[[], 800]])
+
+
+class ScreenshotStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, True)
+        self.store = ScreenshotStore(self.media_root)
+        self.frame = np.random.RandomState(1).randint(0, 256, (64, 48, 3), dtype=np.uint8)
+
+    def test_same_frame_is_saved_once(self):
+        path = self.store.save(self.frame)
+        self.assertEqual(self.store.save(self.frame.copy()), path)
+        self.assertEqual((self.store.saved, self.store.deduplicated), (1, 1))
+
+    def test_frame_removed_by_prune_is_written_again(self):
+        path = self.store.save(self.frame)
+        os.remove(os.path.join(self.media_root, thumbnail_path(path)))
+
+        self.assertEqual(self.store.save(self.frame), path)
+        self.assertEqual(self.store.saved, 2)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, path)))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, thumbnail_path(path))))
+
+
+class CompileScriptTests(SimpleTestCase):
+    def test_compiles_nested_script(self):
+        plan = compile_script({
+            'version': '2.1',
+            'name': 'demo',
+            'match_scale': 0.5,
+            'variables': {'rounds': 3, 'icon': 'settings_icon.png'},
+            'steps': [{
+                'type': 'loop', 'loop_type': 'count', 'count': '{{rounds}}',
+                'steps': [{
+                    'type': 'action', 'action': 'touch',
+                    'params': {'target': '{{icon}}', 'region': [0, 0.5, 0.5, 1]},
+                    'on_failure': {'retry': {'count': 2, 'delay': 0.5}},
+                    'validate': {'type': 'image_exists', 'target': 'search_bar.png', 'match_scale': 1},
+                }, {
+                    'type': 'action', 'action': 'swipe', 'params': {'start': [1, 2], 'end': [3, 4]},
+                }],
+            }],
+        })
+
+        self.assertEqual((plan.name, plan.node_count, plan.match_scale), ('demo', 3, 0.5))
+        loop = plan.steps[0]
+        self.assertIsInstance(loop, LoopNode)
+        self.assertEqual(loop.count, 3)
+        touch, swipe = loop.steps
+        self.assertIsInstance(touch, ActionNode)
+        self.assertEqual(touch.path, 'steps.0.steps.0')
+        self.assertEqual(touch.template_path, asset_path('settings_icon.png'))
+        self.assertEqual((touch.on_failure, touch.retry_count, touch.retry_delay), ('retry', 2, 0.5))
+        self.assertEqual(touch.match_options.scale, 0.5)
+        self.assertEqual(touch.match_options.region.box(200, 100), (0, 50, 100, 100))
+        # 节点级的 match_scale 覆盖脚本级的默认值
+        self.assertIsNone(touch.validate.match_options)
+        self.assertEqual(swipe.params['end'], (3, 4))
+        self.assertEqual(plan.templates, {(asset_path('settings_icon.png'), 0.5), (asset_path('search_bar.png'), 1)})
+
+    def test_invalid_scripts(self):
+        touch = {'type': 'action', 'action': 'touch', 'params': {'target': 'a.png'}}
+        cases = [
+            ([], ''),
+            ({'version': '1.0', 'steps': []}, ''),
+            ({'steps': {}}, 'steps'),
+            ({'steps': [{'type': 'goto'}]}, 'steps.0'),
+            ({'steps': [{'type': 'action', 'action': 'fly'}]}, 'steps.0'),
+            ({'steps': [dict(touch, on_failure='explode')]}, 'steps.0'),
+            ({'steps': [{'type': 'action', 'action': 'touch', 'params': {'target': '{{missing}}'}}]},
+             'steps.0.params.target'),
+            ({'steps': [{'type': 'action', 'action': 'touch', 'params': {'target': 'a.png', 'region': [1, 1, 0, 0]}}]},
+             'steps.0.params.region'),
+            ({'steps': [dict(touch, validate={'type': 'image_exists', 'target': 'b.png', 'timeout': -1})]},
+             'steps.0.validate'),
+            ({'steps': [{'type': 'switch', 'cases': []}]}, 'steps.0'),
+            ({'reference_resolution': [1920], 'steps': []}, 'reference_resolution'),
+        ]
+        for content, node_path in cases:
+            with self.subTest(content=content):
+                with self.assertRaises(ScriptCompileError) as cm:
+                    compile_script(content)
+                self.assertEqual(cm.exception.node_path, node_path)
+
+
+@override_settings(DEVICE_LEASE_POLL_INTERVAL=0.01)
+class LocalDeviceLeaseManagerTests(SimpleTestCase):
+    device = 'Android:///serial'
+
+    def setUp(self):
+        self.manager = LocalDeviceLeaseManager()
+
+    def acquire_in_thread(self, task_id, acquired, **kwargs):
+        def run():
+            with self.manager.acquire(self.device, task_id, **kwargs):
+                acquired.append(task_id)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread
+
+    def test_device_is_exclusive_until_released(self):
+        waits, acquired = [], []
+        lease = self.manager.acquire(self.device, 1)
+        thread = self.acquire_in_thread(2, acquired, on_wait=lambda position, holder: waits.append((position, holder)))
+        time.sleep(0.1)
+        self.assertEqual(acquired, [])
+        self.assertEqual(waits, [(0, '1')])
+        self.assertEqual(self.manager.stats()[0]['queue_depth'], 1)
+
+        lease.release()
+        thread.join(1)
+        self.assertEqual(acquired, [2])
+        stats = self.manager.stats()[0]
+        self.assertEqual((stats['owner_task_id'], stats['queue_depth'], stats['leases']), (None, 0, 2))
+
+    def test_other_devices_are_independent(self):
+        with self.manager.acquire(self.device, 1):
+            with self.manager.acquire('Android:///other', 2) as lease:
+                self.assertLess(lease.wait_time, 0.1)
+
+    def test_waiters_are_served_in_arrival_order(self):
+        acquired = []
+        lease = self.manager.acquire(self.device, 1)
+        threads = []
+        for task_id in (2, 3, 4):
+            threads.append(self.acquire_in_thread(task_id, acquired))
+            time.sleep(0.05)
+        lease.release()
+        for thread in threads:
+            thread.join(1)
+        self.assertEqual(acquired, [2, 3, 4])
+
+    def test_canceled_waiter_leaves_the_queue(self):
+        token = CancellationToken(2)
+        errors = []
+
+        def run():
+            try:
+                self.manager.acquire(self.device, 2, token)
+            except InterruptedError as e:
+                errors.append(e)
+
+        with self.manager.acquire(self.device, 1):
+            thread = threading.Thread(target=run)
+            thread.start()
+            time.sleep(0.05)
+            token.cancel()
+            thread.join(1)
+            self.assertEqual(len(errors), 1)
+            self.assertEqual(self.manager.stats()[0]['queue_depth'], 0)
+
+
+class TaskLogTestCase(TestCase):
+    """在临时目录中保存归档和截图的任务日志测试"""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+        self.archive_root = os.path.join(root, 'archives')
+        self.media_root = os.path.join(root, 'media')
+        paths = override_settings(LOG_ARCHIVE_ROOT=self.archive_root, MEDIA_ROOT=self.media_root)
+        paths.enable()
+        self.addCleanup(paths.disable)
+        self.script = Script.objects.create(name='demo', content={'steps': []})
+
+    def create_task(self, days_ago, status='SUCCESS', entries=3):
+        task = Task.objects.create(script=self.script, status=status)
+        finished = timezone.now() - timedelta(days=days_ago)
+        Task.objects.filter(id=task.id).update(created_at=finished, completed_at=finished)
+        TaskLogEntry.objects.bulk_create(
+            TaskLogEntry(task=task, seq=seq, level='WARNING' if seq == 2 else 'INFO', node_path=f"steps.{seq}",
+                         message=f"第 {seq} 行") for seq in range(1, entries + 1))
+        return Task.objects.get(id=task.id)
+
+
+class LogArchiveTests(TaskLogTestCase):
+    def test_archive_round_trip(self):
+        task = self.create_task(days_ago=10)
+        expected = list(task.log_entries.order_by('seq').values('seq', 'timestamp', 'level', 'node_path', 'message'))
+
+        rows, size = archive_task(task.id)
+
+        task = Task.objects.get(id=task.id)
+        self.assertEqual(rows, 3)
+        self.assertEqual((task.log_archive, task.log_archive_size), (archive_key(task.id), size))
+        self.assertFalse(task.log_entries.exists())
+        self.assertEqual(len(get_archive_store().load(task.log_archive)), size)
+        restored = [{field: getattr(entry, field) for field in expected[0]} for entry in task.archived_log_entries()]
+        self.assertEqual(restored, expected)
+        self.assertEqual(task.log, "第 1 行\n第 2 行\n第 3 行\n")
+        # 已归档的任务不会被重复归档
+        self.assertIsNone(archive_task(task.id))
+
+    def test_logs_appended_after_archiving_continue_the_sequence(self):
+        task = self.create_task(days_ago=10)
+        archive_task(task.id)
+
+        self.assertEqual(TaskLogEntry.objects.next_seq(task.id), 4)
+        TaskLogEntry.objects.create(task=task, seq=4, message="第 4 行")
+        task = Task.objects.get(id=task.id)
+        self.assertEqual([entry.seq for entry in task.log_entries_after(1, 10)], [2, 3, 4])
+        self.assertEqual(task.log_last_seq, 4)
+
+    def test_resync_reads_archived_entries(self):
+        task = self.create_task(days_ago=10)
+        archive_task(task.id)
+        TaskLogEntry.objects.create(task=task, seq=4, message="第 4 行")
+        consumer = TaskStatusConsumer()
+        consumer.scope = {'user': None}
+
+        # 绕过 database_sync_to_async，在测试事务内同步执行
+        payload = TaskStatusConsumer.__dict__['build_resync_payload'].func(consumer, task.id, 1)
+
+        self.assertEqual([entry['seq'] for entry in payload['entries']], [2, 3, 4])
+        self.assertEqual(payload['last_seq'], 4)
+
+    def test_only_old_finished_tasks_are_archived(self):
+        old = self.create_task(days_ago=10)
+        self.create_task(days_ago=1)
+        self.create_task(days_ago=10, status='RUNNING')
+        self.create_task(days_ago=10, entries=0)
+
+        self.assertEqual(list(archivable_tasks(7)), [old])
+        self.assertEqual(archive_task_logs(7), (1, 3, Task.objects.get(id=old.id).log_archive_size))
+        self.assertEqual(archive_task_logs(7), (0, 0, 0))
+
+
+@override_settings(TASK_PURGE_BATCH_SIZE=2, TASK_PURGE_LOG_CHUNK_SIZE=2, TASK_PURGE_PAUSE=0.01)
+class PurgeTasksTests(TaskLogTestCase):
+    def setUp(self):
+        super().setUp()
+        sleep = mock.patch('executor.retention.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_purges_old_finished_tasks_in_batches(self):
+        old = [self.create_task(days_ago=40, status=status) for status in ('SUCCESS', 'FAILED', 'CANCELED', 'SUCCESS')]
+        recent = self.create_task(days_ago=5)
+        running = self.create_task(days_ago=40, status='RUNNING')
+
+        archive_task(old[0].id)
+        archive_path = os.path.join(self.archive_root, *archive_key(old[0].id).split('/'))
+        media_dir = os.path.join(self.media_root, 'task_logs', str(old[1].id))
+        os.makedirs(media_dir)
+
+        self.assertEqual(purge_tasks(30), (4, 9, 2))
+        self.assertEqual(set(Task.objects.values_list('id', flat=True)), {recent.id, running.id})
+        self.assertEqual(TaskLogEntry.objects.count(), 6)
+        self.assertFalse(os.path.exists(archive_path))
+        self.assertFalse(os.path.exists(media_dir))
+        # 两个满批次之后各暂停一次，最后一个空批次结束循环
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_limit_and_empty_batches(self):
+        empty_batch = TaskBatch.objects.create()
+        kept_batch = TaskBatch.objects.create()
+        TaskBatch.objects.update(created_at=timezone.now() - timedelta(days=40))
+        for _ in range(3):
+            task = self.create_task(days_ago=40)
+            Task.objects.filter(id=task.id).update(batch=empty_batch)
+        Task.objects.filter(id=self.create_task(days_ago=5).id).update(batch=kept_batch)
+
+        self.assertEqual(purge_tasks(30, limit=2)[0], 2)
+        self.assertTrue(TaskBatch.objects.filter(id=empty_batch.id).exists())
+        self.assertEqual(purge_tasks(30)[0], 1)
+        self.assertEqual(list(TaskBatch.objects.values_list('id', flat=True)), [kept_batch.id])
+
+    @override_settings(TASK_RETENTION_DAYS=None)
+    def test_nothing_is_purged_without_retention(self):
+        self.create_task(days_ago=400)
+        self.assertEqual(purge_tasks(), (0, 0, 0))
+        self.assertEqual(Task.objects.count(), 1)
@@ -59,8 +59,9 @@ const api = {
   },
 
   // --- 任务相关 (Task) ---
-  getTasks() {
-    return apiClient.get('/tasks/')
+  // params: { cursor, page_size, status, script, device_uri }
+  getTasks(params = {}) {
+    return apiClient.get('/tasks/', { params })
   },
   getTask(id) {
     return apiClient.get(`/tasks/${id}/`)
@@ -72,6 +73,14 @@ const api = {
     return apiClient.post(`/tasks/${taskId}/screenshot/`)
   },
 
+  // --- 批量运行 (Batch) ---
+  runBatch(scriptIds, deviceUris) {
+    return apiClient.post('/batches/', { script_ids: scriptIds, device_uris: deviceUris })
+  },
+  getBatch(id) {
+    return apiClient.get(`/batches/${id}/`)
+  },
+
   // --- 设备相关 (Device) ---
   getDevices() {
     return apiClient.get('/devices/')
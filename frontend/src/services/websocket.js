@@ -1,18 +1,23 @@
 import { ref } from 'vue'
 
-export function useWebSocket() {
+export function useWebSocket(path = '/ws/task-updates/') {
   const ws = ref(null)
   const isConnected = ref(false)
+  // 连接建立前发出的指令先暂存，连接后再发送
+  const pendingCommands = []
 
   // 根据当前协议 (http/https) 和主机，构造 WebSocket 的 URL
   const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
-  const wsURL = `${protocol}//${window.location.host}/ws/task_updates/`
+  const wsURL = `${protocol}//${window.location.host}${path}`
 
   ws.value = new WebSocket(wsURL)
 
   ws.value.onopen = () => {
     isConnected.value = true
     console.log('WebSocket连接已建立')
+    while (pendingCommands.length > 0) {
+      ws.value.send(JSON.stringify(pendingCommands.shift()))
+    }
   }
 
   ws.value.onclose = () => {
@@ -24,13 +29,20 @@ export function useWebSocket() {
     console.error('WebSocket错误:', error)
   }
 
-  // 核心：设置消息处理器
+  // 向后端发送订阅 / resync 等指令
+  const send = (command) => {
+    if (ws.value && ws.value.readyState === WebSocket.OPEN) {
+      ws.value.send(JSON.stringify(command))
+    } else {
+      pendingCommands.push(command)
+    }
+  }
+
+  // 核心：设置消息处理器，回调收到的是 {type, ...} 形式的完整消息
   const onMessage = (callback) => {
     if (ws.value) {
       ws.value.onmessage = (event) => {
-        const data = JSON.parse(event.data)
-        // 我们假设后端发送的数据总是有一个 'message' 字段
-        callback(data.message)
+        callback(JSON.parse(event.data))
       }
     }
   }
@@ -41,5 +53,5 @@ export function useWebSocket() {
     }
   }
 
-  return { onMessage, close, isConnected }
+  return { onMessage, send, close, isConnected }
 }
@@ -1,5 +1,9 @@
 import { defineStore } from 'pinia'
 import api from '@/services/api' // 我们稍后会更新api.js
+import { useWebSocket } from '@/services/websocket'
+
+// 设备变化推送的连接，多个组件共用一条
+let deviceSocket = null
 
 export const useDeviceStore = defineStore('devices', {
   // state: 定义这个模块需要“记住”的数据
@@ -32,6 +36,28 @@ export const useDeviceStore = defineStore('devices', {
       }
     },
 
+    // 订阅设备上线/离线推送，之后无需再轮询 /api/devices/
+    subscribeDevices() {
+      if (deviceSocket) return
+      deviceSocket = useWebSocket('/ws/devices/')
+      deviceSocket.onMessage((message) => {
+        if (message.type !== 'devices.snapshot' && message.type !== 'devices.changed') return
+        this.devices = message.devices
+        if (message.type === 'devices.snapshot') this.error = message.error || null
+        // 当前选择的设备下线后，自动改选第一个在线设备
+        if (!this.devices.some((device) => device.uri === this.selectedDeviceUri)) {
+          this.selectedDeviceUri = this.devices.length > 0 ? this.devices[0].uri : null
+        }
+      })
+    },
+
+    unsubscribeDevices() {
+      if (deviceSocket) {
+        deviceSocket.close()
+        deviceSocket = null
+      }
+    },
+
     // 操作2: 允许用户手动选择一个设备
     selectDevice(deviceUri) {
       this.selectedDeviceUri = deviceUri
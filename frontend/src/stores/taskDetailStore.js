@@ -8,6 +8,9 @@ export const useTaskDetailStore = defineStore('taskDetail', {
     isLoading: false,
     error: null,
     ws: null, // 用于存放WebSocket连接实例
+    lastSeq: 0, // 本地已拥有的最后一条日志的序号
+    streamSocket: null, // 实时画面的WebSocket连接
+    streamFrameUrl: null, // 实时画面最新一帧的 object URL
   }),
   actions: {
     // 从后端获取指定ID的任务的初始数据
@@ -17,6 +20,7 @@ export const useTaskDetailStore = defineStore('taskDetail', {
       try {
         const response = await api.getTask(taskId)
         this.task = response.data
+        this.lastSeq = response.data.log_last_seq || 0
       } catch (err) {
         this.error = '无法加载任务详情。'
         console.error(err)
@@ -33,17 +37,34 @@ export const useTaskDetailStore = defineStore('taskDetail', {
 
       // 告诉WebSocket服务当收到消息时该做什么
       this.ws.onMessage((data) => {
-        // 我们只关心与当前正在查看的任务ID相匹配的更新
-        const updatedTask = data.message
+        if (!this.task) return
 
-        // 确保收到的消息是我们需要的任务更新消息
-        if (updatedTask && updatedTask.id === this.task.id) {
-          console.log('收到任务更新:', updatedTask)
-
-          // 直接用收到的新数据替换旧的任务数据，界面就会自动更新
-          this.task = updatedTask
+        if (data.type === 'task.status' && data.task.id === this.task.id) {
+          // 状态消息不含日志，只合并摘要字段
+          this.task = { ...this.task, ...data.task }
+        } else if (data.type === 'task.log' && data.task_id === this.task.id) {
+          // 只追加比本地更新的日志条目
+          const newEntries = data.entries.filter((entry) => entry.seq > this.lastSeq)
+          this.appendLogEntries(newEntries)
+        } else if (data.type === 'task.resync' && data.task.id === this.task.id) {
+          this.task = { ...this.task, ...data.task }
+          this.appendLogEntries(data.entries.filter((entry) => entry.seq > this.lastSeq))
         }
       })
+
+      // 订阅当前任务；after_seq 会让后端补发订阅前已产生的日志
+      this.ws.send({
+        action: 'subscribe',
+        task_ids: [this.task.id],
+        after_seq: { [this.task.id]: this.lastSeq },
+      })
+    },
+
+    appendLogEntries(entries) {
+      if (entries.length === 0) return
+      const text = entries.map((entry) => `${entry.message}\n`).join('')
+      this.task.log = (this.task.log || '') + text
+      this.lastSeq = entries[entries.length - 1].seq
     },
 
     async triggerScreenshot() {
@@ -67,9 +88,47 @@ export const useTaskDetailStore = defineStore('taskDetail', {
       }
     },
 
+    // 打开实时画面：先收到一条描述帧的文本消息，紧接着是图片二进制数据，显示后回复 ack
+    startStream(fps = 5) {
+      if (!this.task || this.streamSocket) return
+      const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:'
+      const socket = new WebSocket(
+        `${protocol}//${window.location.host}/ws/tasks/${this.task.id}/stream/?fps=${fps}`,
+      )
+      let mime = 'image/jpeg'
+      socket.onmessage = (event) => {
+        if (typeof event.data === 'string') {
+          const message = JSON.parse(event.data)
+          if (message.type === 'stream.frame') mime = message.mime
+          else if (message.type === 'stream.end') this.stopStream()
+          return
+        }
+        if (this.streamFrameUrl) URL.revokeObjectURL(this.streamFrameUrl)
+        this.streamFrameUrl = URL.createObjectURL(new Blob([event.data], { type: mime }))
+        socket.send(JSON.stringify({ action: 'ack' }))
+      }
+      socket.onclose = () => {
+        if (this.streamSocket === socket) this.stopStream()
+      }
+      this.streamSocket = socket
+    },
+
+    stopStream() {
+      if (this.streamSocket) {
+        const socket = this.streamSocket
+        this.streamSocket = null
+        socket.close()
+      }
+      if (this.streamFrameUrl) {
+        URL.revokeObjectURL(this.streamFrameUrl)
+        this.streamFrameUrl = null
+      }
+    },
+
     // 清理任务数据（当用户离开页面时调用，为下次进入做准备）
     clearTask() {
       this.task = null
+      this.lastSeq = 0
     },
 
     async cancelTask() {
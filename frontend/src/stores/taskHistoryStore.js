@@ -1,20 +1,25 @@
 import { defineStore } from 'pinia'
 import api from '@/services/api'
 
+// 从后端返回的 next 链接中取出 cursor 参数
+const extractCursor = (url) => (url ? new URL(url, window.location.origin).searchParams.get('cursor') : null)
+
 export const useTaskHistoryStore = defineStore('taskHistory', {
   state: () => ({
     tasks: [],
+    nextCursor: null, // 下一页的游标，为 null 表示没有更多任务
     isLoading: false,
     error: null,
   }),
   actions: {
-    async fetchTasks() {
+    // 后端使用游标分页：响应为 { next, previous, results }
+    async fetchTasks(filters = {}) {
       this.isLoading = true
       this.error = null
       try {
-        const response = await api.getTasks()
-        // 假设后端已禁用分页，直接将返回的数组赋值
-        this.tasks = response.data
+        const response = await api.getTasks(filters)
+        this.tasks = response.data.results
+        this.nextCursor = extractCursor(response.data.next)
       } catch (err) {
         this.error = '无法加载任务历史。'
         console.error(err)
@@ -22,5 +27,20 @@ export const useTaskHistoryStore = defineStore('taskHistory', {
         this.isLoading = false
       }
     },
+
+    async loadMore(filters = {}) {
+      if (!this.nextCursor || this.isLoading) return
+      this.isLoading = true
+      try {
+        const response = await api.getTasks({ ...filters, cursor: this.nextCursor })
+        this.tasks.push(...response.data.results)
+        this.nextCursor = extractCursor(response.data.next)
+      } catch (err) {
+        this.error = '无法加载更多任务。'
+        console.error(err)
+      } finally {
+        this.isLoading = false
+      }
+    },
   },
 })
@@ -19,6 +19,11 @@ export default defineConfig({
         target: 'http://127.0.0.1:8000', // 你的Django后端地址
         changeOrigin: true, // 必须设置为 true
       },
+      // 代理 WebSocket 连接
+      '/ws': {
+        target: 'ws://127.0.0.1:8000',
+        ws: true,
+      },
       // 代理所有以 /media 开头的请求 (用于图片)
       '/media': {
         target: 'http://127.0.0.1:8000', // 你的Django后端地址